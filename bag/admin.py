@@ -1,3 +1,20 @@
 from django.contrib import admin
+from .models import Cart, CartLine
+
 
 # Register your models here.
+class CartLineAdminInline(admin.TabularInline):
+    model = CartLine
+    raw_id_fields = ('product',)
+    extra = 0
+
+
+class CartAdmin(admin.ModelAdmin):
+    inlines = (CartLineAdminInline,)
+    list_display = ('id', 'user', 'token', 'updated_at')
+    list_select_related = ('user',)
+    search_fields = ('user__username', 'token')
+    ordering = ('-updated_at',)
+
+
+admin.site.register(Cart, CartAdmin)
@@ -1,59 +1,127 @@
-from django.shortcuts import get_object_or_404
-from decimal import Decimal
+import hashlib
+import json
 from django.conf import settings
+from django.core.cache import cache
+from boutique_ado.pricing import price_lines, to_pence, to_pounds
+from products.catalogue import PRICE_VERSION_FIELDS, get_price_version
 from products.models import Product
+from .storage import get_bag_storage
 
+# Everything the bag, checkout and toast templates show of a product
+BAG_PRODUCT_FIELDS = ('id', *PRICE_VERSION_FIELDS, 'image_derivatives')
+BAG_SUMMARY_TIMEOUT = 60 * 60
+# Bump when the summary changes shape, so old cached ones are not read
+BAG_SUMMARY_FORMAT = 2
+
+
+def _bag_products(bag):
+    """
+    Fetch every product in the bag in one query
+    """
+    ids = [int(item_id) for item_id in bag if item_id.isdigit()]
+    if not ids:
+        return {}
+    return Product.objects.only(*BAG_PRODUCT_FIELDS).in_bulk(ids)
 
-def bag_contents(request):
 
+def build_bag_summary(bag):
+    """
+    Work out the lines and totals for the contents of a bag.
+    Products that no longer exist are left out.
+    """
+    products = _bag_products(bag)
     bag_items = []
-    total = 0
-    product_count = 0
-    bag = request.session.get('bag', {})
+    unit_prices = []
+    quantities = []
 
     for item_id, item_data in bag.items():
-        product = get_object_or_404(Product, pk=item_id)
+        product = products.get(int(item_id)) if item_id.isdigit() else None
+        if product is None:
+            continue
+        price = to_pence(product.price)
 
         if isinstance(item_data, int):
-            subtotal = item_data * product.price
-            total += subtotal
-            product_count += item_data
-            bag_items.append({
+            sizes = [(None, item_data)]
+        else:
+            sizes = item_data['items_by_size'].items()
+        for size, quantity in sizes:
+            item = {
                 'item_id': item_id,
-                'quantity': item_data,
+                'quantity': quantity,
                 'product': product,
-                'subtotal': subtotal,  # ✅ added
-            })
-        else:
-            for size, quantity in item_data['items_by_size'].items():
-                subtotal = quantity * product.price
-                total += subtotal
-                product_count += quantity
-                bag_items.append({
-                    'item_id': item_id,
-                    'quantity': quantity,
-                    'product': product,
-                    'size': size,
-                    'subtotal': subtotal,  # ✅ added
-                })
-
-    if total < settings.FREE_DELIVERY_THRESHOLD:
-        delivery = total * Decimal(settings.STANDARD_DELIVERY_PERCENTAGE / 100)
-        free_delivery_delta = settings.FREE_DELIVERY_THRESHOLD - total
-    else:
-        delivery = 0
-        free_delivery_delta = 0
-
-    grand_total = delivery + total
-
-    context = {
+            }
+            if size is not None:
+                item['size'] = size
+            bag_items.append(item)
+            unit_prices.append(price)
+            quantities.append(quantity)
+
+    lines, totals = price_lines(unit_prices, quantities)
+    for item, line_total in zip(bag_items, lines):
+        item['subtotal'] = to_pounds(line_total)
+
+    return {
         'bag_items': bag_items,
-        'total': total,
-        'product_count': product_count,
-        'delivery': delivery,
-        'free_delivery_delta': free_delivery_delta,
+        'total': to_pounds(totals.total),
+        'product_count': sum(quantities),
+        'delivery': to_pounds(totals.delivery),
+        'free_delivery_delta': to_pounds(totals.free_delivery_delta),
         'free_delivery_threshold': settings.FREE_DELIVERY_THRESHOLD,
-        'grand_total': grand_total,
+        'grand_total': to_pounds(totals.grand_total),
+        'grand_total_pence': totals.grand_total,
     }
 
-    return context
+
+def bag_summary_key(bag):
+    """
+    Build the cache key for a bag's summary. It changes with the bag's
+    contents, the delivery settings and the price version, so a cached
+    summary is never out of date.
+    """
+    digest = hashlib.md5(json.dumps([
+        bag,
+        str(settings.FREE_DELIVERY_THRESHOLD),
+        str(settings.STANDARD_DELIVERY_PERCENTAGE),
+    ], sort_keys=True).encode()).hexdigest()
+    return (
+        f'bag:summary:{BAG_SUMMARY_FORMAT}:{get_price_version()}:{digest}'
+    )
+
+
+def get_bag_summary(request):
+    """
+    Return the summary of the request's bag from the cache, working it
+    out at most once per request when it is not cached
+    """
+    summary = getattr(request, '_bag_summary', None)
+    if summary is None:
+        bag = get_bag_storage(request).bag
+        if not bag:
+            summary = build_bag_summary(bag)
+        else:
+            key = bag_summary_key(bag)
+            summary = cache.get(key)
+            if summary is None:
+                summary = build_bag_summary(bag)
+                cache.set(key, summary, BAG_SUMMARY_TIMEOUT)
+        request._bag_summary = summary
+    return summary
+
+
+def bag_contents(request):
+    """
+    Make the bag available to every template. Templates call these
+    lazily, so pages that never show the bag never query for it.
+    """
+    def lazy(key):
+        return lambda: get_bag_summary(request)[key]
+
+    return {
+        'bag_items': lazy('bag_items'),
+        'total': lazy('total'),
+        'product_count': lazy('product_count'),
+        'delivery': lazy('delivery'),
+        'free_delivery_delta': lazy('free_delivery_delta'),
+        'free_delivery_threshold': settings.FREE_DELIVERY_THRESHOLD,
+        'grand_total': lazy('grand_total'),
+    }
@@ -0,0 +1,153 @@
+"""
+A compact binary form of the bag for keeping it in a cookie.
+
+The first byte holds the format version, shifted left one bit, and a
+flag saying the bag is too big for the cookie and is in the session
+instead. Then, for each line in product id order:
+
+    varint  product id, less the previous line's product id
+    varint  size code: 0 for no size, 1-5 for XS to XL, or 6 followed
+            by a length byte and the size in UTF-8, for sizes the shop
+            no longer offers
+    varint  quantity
+
+The bytes are base64 encoded without padding, then signed so a shopper
+cannot edit their bag or another's. Anything that does not decode to a
+valid bag decodes to an empty one.
+"""
+import base64
+from django.core import signing
+
+BAG_FORMAT_VERSION = 1
+IN_SESSION = 1
+# Codes for the sizes in bag.models.SIZES. Existing cookies rely on
+# them, so new sizes go on the end.
+SIZES = ('', 'xs', 's', 'm', 'l', 'xl')
+OTHER_SIZE = len(SIZES)
+# No more lines than a bag can hold, so a cookie cannot make us decode
+# an arbitrarily large bag
+MAX_LINES = 200
+
+SIGNING_SALT = 'bag.cookie'
+
+
+class BagDecodeError(ValueError):
+    pass
+
+
+class BagEncodeError(ValueError):
+    pass
+
+
+def _signer():
+    # Built per call so it always signs with the current SECRET_KEY and
+    # accepts the SECRET_KEY_FALLBACKS
+    return signing.Signer(salt=SIGNING_SALT)
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(data) or shift > 35:
+            raise BagDecodeError('Truncated or overlong number')
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def _lines(bag):
+    for item_id, item_data in bag.items():
+        if isinstance(item_data, int):
+            yield int(item_id), '', item_data
+        else:
+            for size, quantity in item_data['items_by_size'].items():
+                yield int(item_id), size, quantity
+
+
+def encode_bag(bag, in_session=False):
+    """
+    Return the bag as signed, cookie-safe text. Raises BagEncodeError
+    if the bag cannot be written in the format.
+    """
+    out = bytearray([
+        BAG_FORMAT_VERSION << 1 | (IN_SESSION if in_session else 0)
+    ])
+    previous = 0
+    lines = sorted(_lines({} if in_session else bag))
+    for product_id, size, quantity in lines:
+        _write_varint(out, product_id - previous)
+        previous = product_id
+        if size in SIZES:
+            _write_varint(out, SIZES.index(size))
+        else:
+            encoded = size.encode()
+            if len(encoded) > 0xff:
+                raise BagEncodeError('Size too long for the bag cookie')
+            _write_varint(out, OTHER_SIZE)
+            out.append(len(encoded))
+            out.extend(encoded)
+        _write_varint(out, quantity)
+    return _signer().sign(base64.urlsafe_b64encode(out).rstrip(b'=').decode())
+
+
+def decode_bag(value):
+    """
+    Return the bag from signed cookie text, and whether it is kept in
+    the session instead. Raises BagDecodeError if the text is invalid.
+    """
+    try:
+        text = _signer().unsign(value)
+        data = base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+    except (signing.BadSignature, ValueError) as e:
+        raise BagDecodeError(str(e))
+    if not data or data[0] >> 1 != BAG_FORMAT_VERSION:
+        raise BagDecodeError('Unknown bag format')
+    in_session = bool(data[0] & IN_SESSION)
+
+    bag = {}
+    position = 1
+    product_id = 0
+    lines = 0
+    while position < len(data):
+        lines += 1
+        if lines > MAX_LINES:
+            raise BagDecodeError('Too many lines')
+        delta, position = _read_varint(data, position)
+        code, position = _read_varint(data, position)
+        if code < OTHER_SIZE:
+            size = SIZES[code]
+        elif code == OTHER_SIZE and position < len(data):
+            length = data[position]
+            size = data[position + 1:position + 1 + length].decode(
+                errors='replace'
+            )
+            position += 1 + length
+        else:
+            raise BagDecodeError('Unknown size')
+        quantity, position = _read_varint(data, position)
+        if not quantity:
+            raise BagDecodeError('Empty line')
+        product_id += delta
+
+        item_id = str(product_id)
+        if size:
+            entry = bag.setdefault(item_id, {'items_by_size': {}})
+            if not isinstance(entry, dict) or size in entry['items_by_size']:
+                raise BagDecodeError('Repeated line')
+            entry['items_by_size'][size] = quantity
+        elif item_id in bag:
+            raise BagDecodeError('Repeated line')
+        else:
+            bag[item_id] = quantity
+    return bag, in_session
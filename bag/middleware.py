@@ -0,0 +1,14 @@
+class BagCookieMiddleware:
+    """
+    Set the bag cookie on the response when the bag is kept in a cookie
+    and the request changed it
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        storage = getattr(request, '_bag_storage', None)
+        if hasattr(storage, 'set_cookie'):
+            storage.set_cookie(response)
+        return response
@@ -1,3 +1,60 @@
 from django.db import models
+from django.contrib.auth.models import User
+from products.models import Product
+
+# The sizes a product with sizes comes in, as offered on its page
+SIZES = ('xs', 's', 'm', 'l', 'xl')
+
 
 # Create your models here.
+class Cart(models.Model):
+    """
+    A bag kept in the database, so it follows a signed in user between
+    devices. Anonymous carts are found by a token kept in the session.
+    """
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='cart'
+        )
+    token = models.CharField(
+        max_length=32, null=True, blank=True, unique=True
+        )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Cart for {self.user or "anonymous " + str(self.token)}'
+
+
+class CartLine(models.Model):
+    """
+    One product in one size in a cart. Products without sizes are kept
+    with a blank size.
+    """
+    cart = models.ForeignKey(
+        Cart,
+        null=False,
+        blank=False,
+        on_delete=models.CASCADE,
+        related_name='lines'
+        )
+    product = models.ForeignKey(
+        Product, null=False, blank=False, on_delete=models.CASCADE
+        )
+    size = models.CharField(
+        max_length=2, null=False, blank=True, default=''
+        )  # XS, S, M, L, XL
+    quantity = models.PositiveIntegerField(null=False, blank=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['cart', 'product', 'size'], name='unique_cart_line'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product.sku} in cart {self.cart_id}'
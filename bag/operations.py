@@ -0,0 +1,373 @@
+"""
+Changes to the shopping bag, shared by the redirecting views and their
+JSON variants.
+
+Each operation reads the bag from its storage (see bag.storage),
+changes it through the storage and queues the messages describing what
+it did. Nothing is written until save_bag is called. Batches of
+operations are checked as a whole before any of them is applied.
+"""
+from django.contrib import messages
+from django.contrib.messages import get_messages
+from products.models import Product
+from .contexts import get_bag_summary
+from .models import SIZES
+from .storage import get_bag_storage
+
+MIN_QUANTITY = 1
+MAX_QUANTITY = 99
+LARGE_QUANTITY = 10
+MAX_BATCH_OPERATIONS = 100
+
+
+def parse_quantity(value, default=1):
+    """
+    Read a quantity from form data, falling back to the default
+    """
+    try:
+        return int(value if value is not None else default)
+    except (TypeError, ValueError):
+        return default
+
+
+def valid_quantity(request, product, quantity):
+    """
+    Check a quantity is in range, queuing an error if it is not
+    """
+    if MIN_QUANTITY <= quantity <= MAX_QUANTITY:
+        return True
+    messages.error(
+        request,
+        f'Invalid quantity for {product.name}. '
+        f'Must be between {MIN_QUANTITY} and {MAX_QUANTITY}.'
+        )
+    return False
+
+
+def valid_size(request, product, size):
+    """
+    Check a size is one products come in, queuing an error if it is not
+    """
+    if not size or size in SIZES:
+        return True
+    messages.error(request, f'Invalid size for {product.name}.')
+    return False
+
+
+def add_item(request, storage, product, quantity, size=None):
+    """
+    Add a quantity of a product, in a size if it has sizes
+    """
+    item_id = str(product.pk)
+    bag = storage.bag
+
+    if not valid_quantity(request, product, quantity):
+        return False
+    if not valid_size(request, product, size):
+        return False
+
+    # Products with sizes
+    if product.has_sizes and size:
+        if not isinstance(bag.get(item_id), dict):
+            messages.info(
+                request,
+                f'Created new entry for {product.name} in '
+                'your bag.'
+                )
+
+        entry = bag.get(item_id)
+        current_qty = (
+            entry['items_by_size'].get(size, 0)
+            if isinstance(entry, dict) else 0
+        )
+        storage.add(item_id, size, quantity)
+        if current_qty:
+            messages.success(
+                request,
+                f'Updated size {size.upper()} {product.name} quantity to '
+                f'{bag[item_id]["items_by_size"][size]}'
+            )
+        else:
+            messages.success(
+                request,
+                f'Added size {size.upper()} '
+                f'{product.name} to your bag'
+                )
+
+        if bag[item_id]['items_by_size'][size] > LARGE_QUANTITY:
+            messages.warning(
+                request,
+                'You have added a large quantity of size '
+                f'{size.upper()} {product.name}.'
+                )
+
+    # Products without sizes
+    else:
+        if isinstance(bag.get(item_id), int):
+            storage.add(item_id, None, quantity)
+            messages.success(
+                request,
+                f'Updated {product.name} quantity to '
+                f'{bag[item_id]}'
+                )
+            messages.info(
+                request,
+                f'{product.name} now has {bag[item_id]} in '
+                'your bag.'
+                )
+
+            if bag[item_id] > LARGE_QUANTITY:
+                messages.warning(
+                    request,
+                    f'You have added a large quantity of '
+                    f'{product.name}.'
+                    )
+        else:
+            storage.set(item_id, None, quantity)
+            messages.success(request, f'Added {product.name} to your bag!')
+            messages.info(
+                request,
+                f'{product.name} was not previously in your '
+                'bag, now added.'
+                )
+    return True
+
+
+def set_item(request, storage, product, quantity, size=None):
+    """
+    Set the quantity of a product already in the bag
+    """
+    item_id = str(product.pk)
+    bag = storage.bag
+
+    if not valid_quantity(request, product, quantity):
+        return False
+    if not valid_size(request, product, size):
+        return False
+
+    if product.has_sizes and size:
+        if isinstance(bag.get(item_id), dict):
+            storage.set(item_id, size, quantity)
+            messages.success(
+                request,
+                f'Updated size {size.upper()} {product.name} quantity to '
+                f'{quantity}'
+            )
+            if quantity > LARGE_QUANTITY:
+                messages.warning(
+                    request,
+                    f'High quantity for size {size.upper()} '
+                    f'{product.name}.'
+                    )
+    else:
+        storage.set(item_id, None, quantity)
+        messages.success(
+            request,
+            f'Updated {product.name} quantity to {quantity}'
+            )
+        if quantity > LARGE_QUANTITY:
+            messages.warning(request, f'High quantity for {product.name}.')
+    return True
+
+
+def remove_item(request, storage, product, size=None):
+    """
+    Remove a product from the bag, or just one of its sizes
+    """
+    item_id = str(product.pk)
+    bag = storage.bag
+
+    if not valid_size(request, product, size):
+        return False
+
+    if size:
+        if isinstance(bag.get(item_id), dict):
+            # Capture the quantity removed
+            removed_qty = bag[item_id]['items_by_size'].get(size)
+            storage.remove(item_id, size)
+            if removed_qty is not None:
+                messages.info(
+                    request,
+                    f'Removed {removed_qty} of size {size.upper()} '
+                    f'{product.name} from your bag.'
+                )
+
+            # If no other sizes remain, remove the product completely
+            if item_id not in bag:
+                messages.info(
+                    request,
+                    f'All sizes of {product.name} removed from your bag.'
+                )
+    else:
+        # Product without sizes
+        removed_qty = bag.get(item_id)
+        storage.remove(item_id)
+        if removed_qty is not None:
+            messages.info(
+                request,
+                f'Removed {removed_qty} of {product.name} from your bag.'
+            )
+    return True
+
+
+BATCH_ACTIONS = {
+    'set': set_item,
+    'add': add_item,
+    'remove': remove_item,
+}
+
+
+def save_bag(request):
+    """
+    Write the changes made to the request's bag
+    """
+    get_bag_storage(request).save()
+
+
+def clean_operations(operations):
+    """
+    Check a batch of operations against the bag rules, fetching every
+    product they name in one query. Each operation is a dict with an
+    item_id, an optional size, a quantity and an action of 'set' (the
+    default), 'add' or 'remove'. Returns the valid operations as (action,
+    product, size, quantity) tuples, and an error naming each invalid
+    one by its position. A batch that is not a list, or is too long, is
+    refused as a whole.
+    """
+    if not isinstance(operations, list) or not operations:
+        return [], ['Expected a list of bag operations.']
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return [], [
+            f'A bag update can change at most {MAX_BATCH_OPERATIONS} lines.'
+        ]
+
+    errors = []
+
+    def refuse(number, problem):
+        errors.append((number, f'Operation {number} {problem}'))
+
+    parsed = []
+    for number, operation in enumerate(operations, start=1):
+        if not isinstance(operation, dict):
+            refuse(number, 'is not an object.')
+            continue
+        action = operation.get('action', 'set')
+        if action not in BATCH_ACTIONS:
+            refuse(number, 'has an unknown action.')
+            continue
+        item_id = parse_quantity(operation.get('item_id'), default=None)
+        if item_id is None:
+            refuse(number, 'has no valid item_id.')
+            continue
+        size = operation.get('size') or None
+        if size is not None and size not in SIZES:
+            refuse(number, 'has an invalid size.')
+            continue
+        quantity = None
+        if action != 'remove':
+            quantity = parse_quantity(operation.get('quantity'), default=None)
+            if quantity is None:
+                refuse(number, 'has no valid quantity.')
+                continue
+        parsed.append((number, action, item_id, size, quantity))
+
+    products = Product.objects.only('id', 'name', 'has_sizes').in_bulk(
+        [item_id for number, action, item_id, size, quantity in parsed]
+    )
+    cleaned = []
+    for number, action, item_id, size, quantity in parsed:
+        product = products.get(item_id)
+        if product is None:
+            refuse(number, 'names an unknown product.')
+        elif quantity is not None and not (
+            MIN_QUANTITY <= quantity <= MAX_QUANTITY
+        ):
+            refuse(
+                number,
+                f'has an invalid quantity for {product.name}. Must be '
+                f'between {MIN_QUANTITY} and {MAX_QUANTITY}.',
+            )
+        else:
+            cleaned.append((action, product, size, quantity))
+    return cleaned, [message for number, message in sorted(errors)]
+
+
+def apply_operations(request, storage, operations):
+    """
+    Apply operations from clean_operations to the bag in order
+    """
+    for action, product, size, quantity in operations:
+        if action == 'remove':
+            remove_item(request, storage, product, size)
+        else:
+            BATCH_ACTIONS[action](request, storage, product, quantity, size)
+
+
+def _line(summary, product, size):
+    """
+    Describe the bag line for a product and size
+    """
+    item_id = str(product.pk)
+    size = size if product.has_sizes and size else None
+    line = next(
+        (
+            item for item in summary['bag_items']
+            if item['item_id'] == item_id and item.get('size') == size
+        ),
+        None,
+    )
+    return {
+        'item_id': item_id,
+        'size': size,
+        'quantity': line['quantity'] if line else 0,
+        'subtotal': f"{line['subtotal'] if line else 0:.2f}",
+        'removed': line is None,
+    }
+
+
+def _totals(summary):
+    return {
+        'product_count': summary['product_count'],
+        'total': f"{summary['total']:.2f}",
+        'delivery': f"{summary['delivery']:.2f}",
+        'grand_total': f"{summary['grand_total']:.2f}",
+        'free_delivery_delta': f"{summary['free_delivery_delta']:.2f}",
+    }
+
+
+def _messages(request):
+    # Reading the messages here stops them showing on the next page
+    return [
+        {'level': message.level_tag, 'message': message.message}
+        for message in get_messages(request)
+    ]
+
+
+def bag_delta(request, product, size=None):
+    """
+    Describe the bag line for a product and size after a change, with
+    the new totals and the messages queued for the shopper
+    """
+    summary = get_bag_summary(request)
+    return {
+        'line': _line(summary, product, size),
+        'totals': _totals(summary),
+        'messages': _messages(request),
+    }
+
+
+def batch_delta(request, operations):
+    """
+    Describe every line a batch of operations touched, with the new
+    totals and the messages queued for the shopper
+    """
+    summary = get_bag_summary(request)
+    lines = {}
+    for action, product, size, quantity in operations:
+        line = _line(summary, product, size)
+        lines[line['item_id'], line['size']] = line
+    return {
+        'lines': list(lines.values()),
+        'totals': _totals(summary),
+        'messages': _messages(request),
+    }
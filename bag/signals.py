@@ -0,0 +1,50 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.dispatch import receiver
+from .models import Cart, CartLine
+from .operations import MAX_QUANTITY
+from .storage import CART_TOKEN_SESSION_KEY
+
+
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    """
+    Move the lines of the cart built before signing in into the user's
+    cart, adding quantities where both have the same product and size
+    """
+    token = request.session.pop(CART_TOKEN_SESSION_KEY, None)
+    if not token:
+        return
+    with transaction.atomic():
+        anonymous = Cart.objects.filter(token=token, user=None).first()
+        if anonymous is None:
+            return
+        lines = list(anonymous.lines.all())
+        if lines:
+            cart, created = Cart.objects.get_or_create(user=user)
+            existing = {
+                (product_id, size): quantity
+                for product_id, size, quantity in cart.lines.filter(
+                    product_id__in=[line.product_id for line in lines]
+                ).values_list('product_id', 'size', 'quantity')
+            }
+            CartLine.objects.bulk_create(
+                [
+                    CartLine(
+                        cart=cart,
+                        product_id=line.product_id,
+                        size=line.size,
+                        quantity=min(
+                            line.quantity + existing.get(
+                                (line.product_id, line.size), 0
+                            ),
+                            MAX_QUANTITY,
+                        ),
+                    )
+                    for line in lines
+                ],
+                update_conflicts=True,
+                unique_fields=['cart', 'product', 'size'],
+                update_fields=['quantity'],
+            )
+        anonymous.delete()
@@ -0,0 +1,313 @@
+"""
+Where a shopper's bag is kept.
+
+Every storage hands out the bag in the same nested dict form the
+session has always held: a quantity keyed on product id for products
+without sizes, or {'items_by_size': {size: quantity}} for products with
+them. Changes go through add, set and remove, which update that dict at
+once and remember what changed, so save() only has to write the changes.
+
+BAG_STORAGE picks the storage:
+
+    'session'   the whole bag is written back to the session (default)
+    'database'  Cart and CartLine rows, one row written per change
+    'cookie'    a signed cookie (see bag.encoding), so bag pages need no
+                session at all; bags too big for the cookie go in the
+                session. Needs bag.middleware.BagCookieMiddleware.
+"""
+import copy
+import secrets
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .encoding import BagDecodeError, BagEncodeError, decode_bag, encode_bag
+from .models import Cart, CartLine
+
+BAG_STORAGE = getattr(settings, 'BAG_STORAGE', 'session')
+CART_TOKEN_SESSION_KEY = 'cart_token'
+BAG_COOKIE_NAME = getattr(settings, 'BAG_COOKIE_NAME', 'bag')
+# Browsers keep at least 4096 bytes per cookie, name and attributes
+# included, so leave room for those
+BAG_COOKIE_MAX_BYTES = getattr(settings, 'BAG_COOKIE_MAX_BYTES', 3072)
+BAG_COOKIE_AGE = getattr(settings, 'BAG_COOKIE_AGE', 60 * 60 * 24 * 30)
+
+
+class BagStorage:
+    """
+    The bag for one request, loaded when first used
+    """
+    def __init__(self, request):
+        self.request = request
+        self._bag = None
+        self.changes = []
+
+    @property
+    def bag(self):
+        if self._bag is None:
+            self._bag = self.load()
+        return self._bag
+
+    def load(self):
+        raise NotImplementedError
+
+    def write(self, changes):
+        """
+        Store the changes made since the bag was loaded or last saved
+        """
+        raise NotImplementedError
+
+    def add(self, item_id, size, quantity):
+        """
+        Add to the quantity of a product, in a size if given
+        """
+        entry = self.bag.get(item_id)
+        if size:
+            if not isinstance(entry, dict):
+                self._replace(item_id)
+                entry = self.bag[item_id] = {'items_by_size': {}}
+            entry['items_by_size'][size] = (
+                entry['items_by_size'].get(size, 0) + quantity
+            )
+            self.changes.append(('add', item_id, size, quantity))
+        elif isinstance(entry, int):
+            self.bag[item_id] = entry + quantity
+            self.changes.append(('add', item_id, '', quantity))
+        else:
+            self.set(item_id, None, quantity)
+
+    def set(self, item_id, size, quantity):
+        """
+        Set the quantity of a product, in a size if given
+        """
+        entry = self.bag.get(item_id)
+        if size:
+            if not isinstance(entry, dict):
+                self._replace(item_id)
+                entry = self.bag[item_id] = {'items_by_size': {}}
+            entry['items_by_size'][size] = quantity
+        else:
+            if isinstance(entry, dict):
+                self._replace(item_id)
+            self.bag[item_id] = quantity
+        self.changes.append(('set', item_id, size or '', quantity))
+
+    def remove(self, item_id, size=None):
+        """
+        Remove a product, or just one of its sizes. The product goes
+        once its last size does.
+        """
+        entry = self.bag.get(item_id)
+        if size and isinstance(entry, dict):
+            entry['items_by_size'].pop(size, None)
+            self.changes.append(('remove', item_id, size))
+            if not entry['items_by_size']:
+                self.bag.pop(item_id, None)
+        else:
+            self.bag.pop(item_id, None)
+            self.changes.append(('remove', item_id, None))
+
+    def _replace(self, item_id):
+        # A product is kept either with sizes or without, never both
+        if item_id in self.bag:
+            self.bag.pop(item_id)
+            self.changes.append(('remove', item_id, None))
+
+    def save(self):
+        if self.changes:
+            self.write(self.changes)
+            self.changes = []
+        # Any summary worked out earlier in the request is now stale
+        self.request._bag_summary = None
+
+    def clear(self):
+        """
+        Empty the bag, as after a successful checkout
+        """
+        for item_id in list(self.bag):
+            self.remove(item_id)
+        self.save()
+
+
+class SessionBagStorage(BagStorage):
+    """
+    The bag as a dict in the session, written back whole on every change
+    """
+    def load(self):
+        # A copy, so changes are only seen once they are saved
+        return copy.deepcopy(self.request.session.get('bag', {}))
+
+    def write(self, changes):
+        if self.bag:
+            self.request.session['bag'] = copy.deepcopy(self.bag)
+        else:
+            self.request.session.pop('bag', None)
+
+
+class DatabaseBagStorage(BagStorage):
+    """
+    The bag as CartLine rows, one row per product and size. Signed in
+    users have one cart across all their devices.
+    """
+    def _cart_lookup(self, prefix=''):
+        user = self.request.user
+        if user.is_authenticated:
+            return {f'{prefix}user': user}
+        token = self.request.session.get(CART_TOKEN_SESSION_KEY)
+        if token:
+            return {f'{prefix}token': token}
+        return None
+
+    def load(self):
+        lookup = self._cart_lookup('cart__')
+        if lookup is None:
+            return {}
+        bag = {}
+        lines = CartLine.objects.filter(**lookup).order_by('id')
+        for product_id, size, quantity in lines.values_list(
+            'product_id', 'size', 'quantity'
+        ):
+            item_id = str(product_id)
+            entry = bag.get(item_id)
+            if size:
+                if not isinstance(entry, dict):
+                    # Sized lines win over an unsized one left by a merge
+                    entry = bag[item_id] = {'items_by_size': {}}
+                entry['items_by_size'][size] = quantity
+            elif entry is None:
+                bag[item_id] = quantity
+        return bag
+
+    def get_cart(self):
+        """
+        Return the cart for this visitor, creating it if needed
+        """
+        lookup = self._cart_lookup()
+        if lookup is None:
+            lookup = {'token': secrets.token_hex(16)}
+            self.request.session[CART_TOKEN_SESSION_KEY] = lookup['token']
+        cart, created = Cart.objects.get_or_create(**lookup)
+        return cart
+
+    def write(self, changes):
+        with transaction.atomic():
+            cart = self.get_cart()
+            for change in changes:
+                action, item_id, size = change[:3]
+                if action == 'add':
+                    add_line(cart, item_id, size, change[3])
+                elif action == 'set':
+                    set_line(cart, item_id, size, change[3])
+                else:
+                    lines = cart.lines.filter(product_id=item_id)
+                    if size is not None:
+                        lines = lines.filter(size=size)
+                    lines.delete()
+
+
+def add_line(cart, product_id, size, quantity):
+    """
+    Add to a line's quantity in the database, creating it if needed
+    """
+    lines = CartLine.objects.filter(cart=cart, product_id=product_id, size=size)
+    if lines.update(quantity=F('quantity') + quantity):
+        return
+    try:
+        with transaction.atomic():
+            CartLine.objects.create(
+                cart=cart, product_id=product_id, size=size, quantity=quantity
+            )
+    except IntegrityError:
+        # Another request created the line first
+        lines.update(quantity=F('quantity') + quantity)
+
+
+def set_line(cart, product_id, size, quantity):
+    """
+    Set a line's quantity with a single upsert
+    """
+    CartLine.objects.bulk_create(
+        [CartLine(
+            cart=cart, product_id=product_id, size=size, quantity=quantity
+        )],
+        update_conflicts=True,
+        unique_fields=['cart', 'product', 'size'],
+        update_fields=['quantity'],
+    )
+
+
+class CookieBagStorage(BagStorage):
+    """
+    The bag in a signed cookie, falling back to the session when it is
+    too big for one. The cookie is set on the response by
+    BagCookieMiddleware.
+    """
+    def __init__(self, request):
+        super().__init__(request)
+        self.in_session = False
+        self.cookie = None
+
+    def load(self):
+        value = self.request.COOKIES.get(BAG_COOKIE_NAME)
+        if not value:
+            return {}
+        try:
+            bag, self.in_session = decode_bag(value)
+        except BagDecodeError:
+            return {}
+        if self.in_session:
+            return copy.deepcopy(self.request.session.get('bag', {}))
+        return bag
+
+    def write(self, changes):
+        was_in_session = self.in_session
+        if not self.bag:
+            self.cookie = ''
+            self.in_session = False
+        else:
+            try:
+                self.cookie = encode_bag(self.bag)
+            except BagEncodeError:
+                # Keep a bag the cookie cannot hold in the session
+                self.in_session = True
+            else:
+                self.in_session = len(self.cookie) > BAG_COOKIE_MAX_BYTES
+        if self.in_session:
+            self.request.session['bag'] = copy.deepcopy(self.bag)
+            self.cookie = encode_bag(self.bag, in_session=True)
+        elif was_in_session:
+            self.request.session.pop('bag', None)
+
+    def set_cookie(self, response):
+        """
+        Set or delete the bag cookie if the bag was saved
+        """
+        if self.cookie is None:
+            return
+        if self.cookie:
+            response.set_cookie(
+                BAG_COOKIE_NAME,
+                self.cookie,
+                max_age=BAG_COOKIE_AGE,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+        else:
+            response.delete_cookie(BAG_COOKIE_NAME, samesite='Lax')
+
+
+STORAGES = {
+    'session': SessionBagStorage,
+    'database': DatabaseBagStorage,
+    'cookie': CookieBagStorage,
+}
+
+
+def get_bag_storage(request):
+    """
+    Return the bag storage for a request, the same one each time
+    """
+    storage = getattr(request, '_bag_storage', None)
+    if storage is None:
+        storage = request._bag_storage = STORAGES[BAG_STORAGE](request)
+    return storage
@@ -1,3 +1,435 @@
-from django.test import TestCase
+import base64
+import json
+import re
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth import login
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from boutique_ado.query_budget import LOCAL_CACHES
+from products.models import Product
+from products.sample_data import seed_catalogue
+from .models import Cart, CartLine
+from .operations import MAX_BATCH_OPERATIONS
+from .storage import BAG_COOKIE_NAME, CART_TOKEN_SESSION_KEY
+from .encoding import (
+    BAG_FORMAT_VERSION, MAX_LINES, BagDecodeError, BagEncodeError, _signer,
+    decode_bag, encode_bag,
+)
 
-# Create your tests here.
+
+def _signed(data):
+    return _signer().sign(base64.urlsafe_b64encode(data).rstrip(b'=').decode())
+
+
+class BagEncodingTests(TestCase):
+    """
+    Bags survive the trip through the cookie format, and anything else
+    is refused
+    """
+    def test_round_trip(self):
+        bags = [
+            {},
+            {'1': 3},
+            {'7': 1, '300': 2, '70000': 99},
+            {'2': {'items_by_size': {'xs': 1, 'm': 2, 'xl': 3}}, '5': 4},
+            {'9': {'items_by_size': {'w32l34': 2, 's': 1}}},
+        ]
+        for bag in bags:
+            with self.subTest(bag=bag):
+                self.assertEqual(decode_bag(encode_bag(bag)), (bag, False))
+
+    def test_overlong_sizes_are_refused(self):
+        with self.assertRaises(BagEncodeError):
+            encode_bag({'1': {'items_by_size': {'x' * 256: 1}}})
+
+    def test_bag_in_session(self):
+        self.assertEqual(
+            decode_bag(encode_bag({'1': 3}, in_session=True)), ({}, True)
+        )
+
+    def test_signed_with_the_current_key(self):
+        with override_settings(SECRET_KEY='old key'):
+            value = encode_bag({'1': 3})
+        with override_settings(SECRET_KEY='new key'):
+            with self.assertRaises(BagDecodeError):
+                decode_bag(value)
+        with override_settings(
+            SECRET_KEY='new key', SECRET_KEY_FALLBACKS=['old key']
+        ):
+            self.assertEqual(decode_bag(value), ({'1': 3}, False))
+
+    def test_invalid_values_are_refused(self):
+        version = BAG_FORMAT_VERSION << 1
+        values = [
+            '',
+            'not signed',
+            encode_bag({'1': 3})[:-1],
+            _signed(b''),
+            _signed(bytes([(BAG_FORMAT_VERSION + 1) << 1])),
+            # truncated number, unknown size code, empty line
+            _signed(bytes([version, 0x81])),
+            _signed(bytes([version, 1, 9, 1])),
+            _signed(bytes([version, 1, 0, 0])),
+            # the same product twice
+            _signed(bytes([version, 1, 0, 1, 0, 0, 1])),
+            _signed(bytes([version, 1, 1, 1, 0, 1, 1])),
+            _signed(bytes([version]) + bytes([1, 0, 1]) * (MAX_LINES + 1)),
+        ]
+        for value in values:
+            with self.subTest(value=value):
+                with self.assertRaises(BagDecodeError):
+                    decode_bag(value)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class BagQueryBudgetTests(TestCase):
+    """
+    The bag page runs the same queries however many lines the bag has:
+    the session, then one query for every product in it
+    """
+    def test_bag_queries(self):
+        for size in (10, 100, 1000):
+            seed_catalogue(size)
+            session = self.client.session
+            session['bag'] = {
+                str(pk): 1 for pk in range(1, min(size, 20) + 1)
+            }
+            session.save()
+            with self.subTest(size=size):
+                with self.assertNumQueries(2):
+                    response = self.client.get(reverse('bag:view_bag'))
+                self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class BagDeltaTests(TestCase):
+    """
+    Bag changes asked for as JSON answer with the changed line, the new
+    totals and the queued messages instead of a redirect
+    """
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalogue(2)
+        Product.objects.filter(pk=1).update(price='20.00', has_sizes=False)
+        Product.objects.filter(pk=2).update(price='7.50', has_sizes=True)
+
+    def _post(self, name, item_id, data, json_response=True):
+        headers = {'HTTP_ACCEPT': 'application/json'} if json_response else {}
+        return self.client.post(
+            reverse(name, args=[item_id]), data, **headers
+        )
+
+    def test_add_adjust_and_remove(self):
+        response = self._post('bag:add_to_bag', 1, {'quantity': 2})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(set(data), {'line', 'totals', 'messages'})
+        self.assertEqual(data['line'], {
+            'item_id': '1', 'size': None, 'quantity': 2, 'subtotal': '40.00',
+            'removed': False,
+        })
+        self.assertEqual(data['totals']['product_count'], 2)
+        self.assertEqual(data['totals']['total'], '40.00')
+        self.assertEqual(
+            [message['level'] for message in data['messages']],
+            ['success', 'info'],
+        )
+
+        response = self._post(
+            'bag:add_to_bag', 2, {'quantity': 1, 'product_size': 'm'}
+        )
+        data = response.json()
+        self.assertEqual(data['line']['size'], 'm')
+        self.assertEqual(data['line']['subtotal'], '7.50')
+        self.assertEqual(data['totals']['total'], '47.50')
+
+        data = self._post(
+            'bag:adjust_bag', 2, {'quantity': 3, 'product_size': 'm'}
+        ).json()
+        self.assertEqual(data['line']['quantity'], 3)
+        self.assertEqual(data['totals']['product_count'], 5)
+        self.assertEqual(data['totals']['total'], '62.50')
+
+        data = self._post('bag:remove_from_bag', 1, {}).json()
+        self.assertEqual(data['line']['quantity'], 0)
+        self.assertTrue(data['line']['removed'])
+        self.assertEqual(data['totals']['total'], '22.50')
+
+        # The messages were sent with the JSON, so the next page has none
+        response = self.client.get(reverse('bag:view_bag'))
+        self.assertEqual(list(response.context['messages']), [])
+
+    def test_refused_changes(self):
+        response = self._post('bag:add_to_bag', 1, {'quantity': 100})
+        self.assertEqual(response.status_code, 400)
+        data = response.json()
+        self.assertTrue(data['line']['removed'])
+        self.assertEqual(data['messages'][0]['level'], 'error')
+
+        response = self._post('bag:remove_from_bag', 2, {'size': 'xxl'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_pages_still_redirect(self):
+        response = self._post(
+            'bag:add_to_bag', 1, {'quantity': 1, 'redirect_url': '/bag/'},
+            json_response=False,
+        )
+        self.assertRedirects(response, '/bag/', fetch_redirect_response=False)
+        response = self._post(
+            'bag:adjust_bag', 1, {'quantity': 2}, json_response=False
+        )
+        self.assertRedirects(
+            response, reverse('bag:view_bag'), fetch_redirect_response=False
+        )
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class BagBatchUpdateTests(TestCase):
+    """
+    A batch applies its valid operations in one write and names each
+    invalid one
+    """
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalogue(3)
+        Product.objects.filter(pk=3).update(has_sizes=True)
+
+    def _update(self, operations):
+        return self.client.post(
+            reverse('bag:update_bag'), json.dumps(operations),
+            content_type='application/json',
+        )
+
+    def _bag(self):
+        return self.client.session.get('bag', {})
+
+    def test_valid_operations_apply_and_errors_come_back(self):
+        self._update([{'item_id': 1, 'quantity': 2}])
+        response = self._update([
+            {'item_id': 1, 'quantity': 3, 'action': 'add'},
+            {'item_id': 2, 'quantity': 0},
+            {'item_id': 3, 'size': 'm', 'quantity': 4, 'action': 'add'},
+            {'item_id': 999, 'quantity': 1},
+            {'item_id': 2, 'quantity': 1, 'action': 'swap'},
+            {'quantity': 1},
+            {'item_id': 2, 'quantity': 'lots'},
+            'not an object',
+        ])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(
+            [
+                int(re.match(r'Operation (\d+) ', error).group(1))
+                for error in data['errors']
+            ],
+            [2, 4, 5, 6, 7, 8],
+        )
+        self.assertEqual(
+            [
+                (line['item_id'], line['size'], line['quantity'])
+                for line in data['lines']
+            ],
+            [('1', None, 5), ('3', 'm', 4)],
+        )
+        self.assertEqual(data['totals']['product_count'], 9)
+        self.assertEqual(
+            self._bag(), {'1': 5, '3': {'items_by_size': {'m': 4}}}
+        )
+
+    def test_removing_lines(self):
+        self._update([
+            {'item_id': 1, 'quantity': 2},
+            {'item_id': 2, 'quantity': 1},
+        ])
+        response = self._update([
+            {'item_id': 1, 'action': 'remove'},
+            {'item_id': 2, 'quantity': 100},
+        ])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data['errors']), 1)
+        self.assertTrue(data['lines'][0]['removed'])
+        self.assertEqual(self._bag(), {'2': 1})
+
+    def test_batches_with_nothing_valid_are_refused(self):
+        self._update([{'item_id': 1, 'quantity': 2}])
+        too_many = [{'item_id': 2, 'quantity': 1}] * (
+            MAX_BATCH_OPERATIONS + 1
+        )
+        for operations in (
+            [], {'item_id': 2}, [{'item_id': 2, 'quantity': 0}], too_many,
+        ):
+            with self.subTest(operations=operations):
+                response = self._update(operations)
+                self.assertEqual(response.status_code, 400)
+                self.assertTrue(response.json()['errors'])
+                self.assertEqual(self._bag(), {'1': 2})
+
+        response = self.client.post(
+            reverse('bag:update_bag'), 'not json',
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class BagSizeTests(TestCase):
+    """
+    Only the sizes products come in reach the bag, whatever the storage
+    """
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalogue(2)
+
+    def _bag(self):
+        response = self.client.get(reverse('bag:view_bag'))
+        return response.context['bag_items']()
+
+    def test_unknown_sizes_are_refused(self):
+        for storage in ('session', 'database', 'cookie'):
+            with self.subTest(storage=storage), mock.patch(
+                'bag.storage.BAG_STORAGE', storage
+            ):
+                self.client.logout()
+                for size in ('x' * 300, 'XXL'):
+                    response = self.client.post(
+                        reverse('bag:add_to_bag', args=[1]),
+                        {'quantity': 1, 'product_size': size},
+                    )
+                    self.assertEqual(response.status_code, 302)
+                    response = self.client.post(
+                        reverse('bag:add_to_bag', args=[1]),
+                        {'quantity': 1, 'product_size': size},
+                        HTTP_ACCEPT='application/json',
+                    )
+                    self.assertEqual(response.status_code, 400)
+                self.assertEqual(self._bag(), [])
+
+                response = self.client.post(
+                    reverse('bag:add_to_bag', args=[1]),
+                    {'quantity': 1, 'product_size': 'm'},
+                )
+                self.assertEqual(response.status_code, 302)
+                self.assertEqual(len(self._bag()), 1)
+        self.assertFalse(
+            CartLine.objects.exclude(size__in=['', 'm']).exists()
+        )
+
+    def test_batch_update_refuses_unknown_sizes(self):
+        response = self.client.post(
+            reverse('bag:update_bag'),
+            json.dumps([
+                {'item_id': 1, 'size': 'm', 'quantity': 1},
+                {'item_id': 2, 'size': 'x' * 300, 'quantity': 1},
+                {'item_id': 2, 'size': ['m'], 'quantity': 1},
+            ]),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['errors']), 2)
+        self.assertEqual(len(self._bag()), 1)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class CartMergeTests(TestCase):
+    """
+    Signing in moves the cart built anonymously into the user's cart
+    """
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalogue(3)
+        Product.objects.filter(pk=2).update(has_sizes=True)
+        cls.user = User.objects.create_user('shopper', password='x')
+
+    def setUp(self):
+        patcher = mock.patch('bag.storage.BAG_STORAGE', 'database')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _add(self, item_id, quantity, size=None):
+        data = {'quantity': quantity}
+        if size:
+            data['product_size'] = size
+        self.client.post(reverse('bag:add_to_bag', args=[item_id]), data)
+
+    def _sign_in(self):
+        """
+        Sign in on the test client's session, as the login view does
+        """
+        request = RequestFactory().get('/')
+        request.session = SessionStore(self.client.session.session_key)
+        login(
+            request, self.user,
+            backend='django.contrib.auth.backends.ModelBackend',
+        )
+        request.session.save()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = (
+            request.session.session_key
+        )
+
+    def _lines(self, cart):
+        return set(cart.lines.values_list('product_id', 'size', 'quantity'))
+
+    def test_anonymous_lines_merge_into_the_users_cart(self):
+        cart = Cart.objects.create(user=self.user)
+        CartLine.objects.create(cart=cart, product_id=1, size='', quantity=3)
+        CartLine.objects.create(cart=cart, product_id=2, size='s', quantity=1)
+        CartLine.objects.create(cart=cart, product_id=3, size='', quantity=98)
+
+        self._add(1, 2)
+        self._add(2, 1, 'm')
+        self._add(3, 5)
+        anonymous = Cart.objects.get(user=None)
+        self.assertEqual(
+            self.client.session[CART_TOKEN_SESSION_KEY], anonymous.token
+        )
+
+        self._sign_in()
+        self.assertFalse(Cart.objects.filter(pk=anonymous.pk).exists())
+        self.assertEqual(self._lines(cart), {
+            (1, '', 5), (2, 's', 1), (2, 'm', 1), (3, '', 99),
+        })
+        self.assertNotIn(CART_TOKEN_SESSION_KEY, self.client.session)
+
+        # The bag now shows the user's cart
+        response = self.client.get(reverse('bag:view_bag'))
+        self.assertEqual(response.context['product_count'](), 106)
+
+    def test_first_cart_is_created_on_sign_in(self):
+        self._add(1, 2)
+        self._sign_in()
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual(self._lines(cart), {(1, '', 2)})
+        self.assertEqual(Cart.objects.count(), 1)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class CookieBagStorageTests(TestCase):
+    """
+    A bag the cookie cannot hold is kept in the session instead
+    """
+    def test_bag_the_cookie_cannot_encode(self):
+        seed_catalogue(1)
+        Product.objects.update(has_sizes=True)
+        session = self.client.session
+        session['bag'] = {'1': {'items_by_size': {'x' * 300: 1}}}
+        session.save()
+        with mock.patch('bag.storage.BAG_STORAGE', 'cookie'):
+            self.client.cookies[BAG_COOKIE_NAME] = encode_bag(
+                {}, in_session=True
+            )
+            response = self.client.post(
+                reverse('bag:add_to_bag', args=[1]),
+                {'quantity': 1, 'product_size': 'm'},
+            )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            decode_bag(response.cookies[BAG_COOKIE_NAME].value), ({}, True)
+        )
+        self.assertEqual(
+            self.client.session['bag']['1']['items_by_size'],
+            {'x' * 300: 1, 'm': 1},
+        )
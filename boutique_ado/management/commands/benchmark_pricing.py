@@ -0,0 +1,91 @@
+import random
+import time
+from decimal import Decimal
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from boutique_ado.pricing import price_lines, to_pence
+
+
+def decimal_totals(prices, quantities):
+    """
+    Price a bag the way the bag context processor used to, with a
+    Decimal per line and a float delivery percentage
+    """
+    total = 0
+    for price, quantity in zip(prices, quantities):
+        subtotal = quantity * price
+        total += subtotal
+    if total < settings.FREE_DELIVERY_THRESHOLD:
+        delivery = total * Decimal(settings.STANDARD_DELIVERY_PERCENTAGE / 100)
+    else:
+        delivery = 0
+    return total, delivery + total
+
+
+class Command(BaseCommand):
+    help = (
+        "Time pricing generated bags with the integer pricing engine "
+        "against the old Decimal loop, and check they agree."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lines', type=int, default=1000,
+            help='Lines per bag (default 1000)',
+        )
+        parser.add_argument(
+            '--iterations', type=int, default=200,
+            help='Times to price each bag (default 200)',
+        )
+
+    def _time(self, price, iterations):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            result = price()
+        return (time.perf_counter() - start) / iterations * 1e6, result
+
+    def handle(self, *args, **options):
+        lines = max(options['lines'], 1)
+        iterations = max(options['iterations'], 1)
+        rng = random.Random(0)
+        prices = [
+            Decimal(rng.randint(99, 25000)).scaleb(-2) for _ in range(lines)
+        ]
+        quantities = [rng.randint(1, 99) for _ in range(lines)]
+
+        decimal_us, (total, grand_total) = self._time(
+            lambda: decimal_totals(prices, quantities), iterations
+        )
+        # As in the bag, each product's price is converted to pence once
+        pence = [to_pence(price) for price in prices]
+        integer_us, (line_totals, totals) = self._time(
+            lambda: price_lines(pence, quantities), iterations
+        )
+
+        if to_pence(total) != totals.total:
+            self.stderr.write(
+                f'Totals disagree: {total} and {totals.total} pence'
+            )
+        self.stdout.write(
+            f'{lines} lines: Decimal loop {decimal_us:.1f} us, '
+            f'integer pence {integer_us:.1f} us '
+            f'({decimal_us / integer_us:.1f}x faster)'
+        )
+
+        # Small bags, where delivery is charged and has to be rounded
+        small = [
+            ([Decimal(rng.randint(99, 1500)).scaleb(-2)], [rng.randint(1, 3)])
+            for _ in range(1000)
+        ]
+        differ = 0
+        for prices, quantities in small:
+            total, grand_total = decimal_totals(prices, quantities)
+            lines, totals = price_lines(
+                [to_pence(price) for price in prices], quantities
+            )
+            if to_pence(grand_total) != totals.grand_total:
+                differ += 1
+        self.stdout.write(
+            f'Grand totals differing by a penny of rounding in {differ} '
+            'of 1000 small bags with delivery charged'
+        )
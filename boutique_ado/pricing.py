@@ -0,0 +1,91 @@
+"""
+Prices and totals for bags and orders, worked out in whole pence.
+
+Product prices are converted to pence once, and everything after that
+is integer arithmetic, so the bag, the Stripe amount and the order all
+agree to the penny. Delivery is STANDARD_DELIVERY_PERCENTAGE of the
+total, rounded half up to the nearest penny, and is free from
+FREE_DELIVERY_THRESHOLD upwards.
+
+A bag is priced in one pass over parallel arrays of unit prices and
+quantities, with the multiplying and summing done by builtins rather
+than a Python loop with a Decimal per line.
+"""
+from collections import namedtuple
+from decimal import ROUND_HALF_UP, Decimal
+from fractions import Fraction
+from operator import mul
+from django.conf import settings
+
+PENNY = Decimal('0.01')
+
+Totals = namedtuple(
+    'Totals', 'total delivery grand_total free_delivery_delta'
+)
+
+
+def to_pence(amount):
+    """
+    Convert an amount in pounds to whole pence, rounding half up
+    """
+    if isinstance(amount, float):
+        amount = str(amount)
+    return int(
+        (Decimal(amount) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP)
+    )
+
+
+def to_pounds(pence):
+    """
+    Convert whole pence to a two decimal place amount in pounds
+    """
+    return Decimal(pence).scaleb(-2).quantize(PENNY)
+
+
+def _delivery_rate():
+    # A Fraction keeps rates like 12.5 exact
+    return Fraction(str(settings.STANDARD_DELIVERY_PERCENTAGE)) / 100
+
+
+def delivery_pence(total):
+    """
+    Return the delivery charge in pence for a total in pence
+    """
+    if total >= to_pence(settings.FREE_DELIVERY_THRESHOLD):
+        return 0
+    rate = _delivery_rate()
+    numerator = total * rate.numerator
+    # Round half up: floor(numerator / denominator + 1/2)
+    return (2 * numerator + rate.denominator) // (2 * rate.denominator)
+
+
+def totals(total):
+    """
+    Return the totals for a goods total in pence
+    """
+    delivery = delivery_pence(total)
+    return Totals(
+        total=total,
+        delivery=delivery,
+        grand_total=total + delivery,
+        free_delivery_delta=max(
+            to_pence(settings.FREE_DELIVERY_THRESHOLD) - total, 0
+        ),
+    )
+
+
+def line_totals(unit_prices, quantities):
+    """
+    Return the total of each line, in pence, for parallel sequences of
+    unit prices in pence and quantities
+    """
+    return list(map(mul, unit_prices, quantities))
+
+
+def price_lines(unit_prices, quantities):
+    """
+    Return the line totals and the Totals for a bag or order given as
+    parallel sequences of unit prices in pence and quantities
+    """
+    lines = line_totals(unit_prices, quantities)
+    return lines, totals(sum(lines))
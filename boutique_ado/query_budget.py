@@ -0,0 +1,15 @@
+"""
+Settings for the query budget tests.
+
+The tests pin the number of queries each view runs with
+assertNumQueries, at several catalogue sizes, so an N+1 regression
+fails the build instead of slowing the shop down.
+"""
+
+# Budgets count a view's own queries, so measure them with the cache in
+# memory rather than in the database
+LOCAL_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
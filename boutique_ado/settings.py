@@ -55,7 +55,7 @@ INSTALLED_APPS = [
     'widget_tweaks',
     'boutique_ado',
     'home',
-    'products',
+    'products.apps.ProductsConfig',
     'bag',
     'checkout.apps.CheckoutConfig',
     'profiles',
@@ -70,6 +70,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
+    'bag.middleware.BagCookieMiddleware',
 ]
 
 ROOT_URLCONF = 'boutique_ado.urls'
@@ -159,6 +160,57 @@ else:
     }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# The catalogue and price versions that invalidate cached listings,
+# facets, ETags and bag totals live in this cache, so it must be shared
+# by every web worker and by management commands such as
+# import_products. Redis is used when REDIS_URL is set, and the database
+# otherwise (run createcachetable first). A per-process cache such as
+# LocMemCache would let workers serve stale listings and prices, and
+# the products.E001 check refuses it.
+
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'boutique_ado_cache',
+        }
+    }
+
+
+# Identifies the deployed code, so catalogue pages rendered by an older
+# release are not revalidated after a deploy. Heroku sets
+# HEROKU_RELEASE_VERSION when dyno metadata is enabled. Without either,
+# each process's start time is used instead, which is never stale but
+# gives each worker its own ETags.
+RELEASE_VERSION = (
+    os.getenv('RELEASE_VERSION') or os.getenv('HEROKU_RELEASE_VERSION', '')
+)
+
+# 'snapshot' answers catalogue listings from an in-memory copy per worker
+CATALOGUE_ENGINE = os.getenv('CATALOGUE_ENGINE', 'orm')
+
+# Where shopping bags are kept: 'session', 'database' to keep them in
+# Cart rows that follow a signed in user between devices, or 'cookie' to
+# keep them in a signed cookie so bag pages need no session
+BAG_STORAGE = os.getenv('BAG_STORAGE', 'session')
+
+# Show the results for a corrected search when a search finds nothing,
+# rather than only suggesting the correction
+SPELLING_AUTOCORRECT = (
+    os.getenv('SPELLING_AUTOCORRECT', 'False').lower() == 'true'
+)
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -264,6 +316,9 @@ STRIPE_CURRENCY = 'gbp'
 STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY', '')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', '')
 STRIPE_WH_SECRET = os.getenv('STRIPE_WH_SECRET', '')
+# 'stub' answers Stripe calls from checkout.stripe_stub, without a
+# network or keys
+STRIPE_CLIENT = os.getenv('STRIPE_CLIENT', 'stripe')
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
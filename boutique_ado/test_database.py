@@ -0,0 +1,21 @@
+from contextlib import contextmanager
+from django.db import connection
+from django.test.utils import (
+    setup_test_environment, teardown_test_environment
+)
+
+
+@contextmanager
+def throwaway_test_database():
+    """
+    Run the wrapped block against a freshly migrated test database,
+    the same way the test runner does, and destroy it afterwards
+    """
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
@@ -1,9 +1,7 @@
 from django.contrib import admin, messages
-import stripe
-from django.conf import settings
-from .models import Order, OrderLineItem, OrderChangeRequest
-
-stripe.api_key = settings.STRIPE_SECRET_KEY
+from .exports import order_export
+from .models import Order, OrderLineItem, OrderChangeRequest, WebhookEvent
+from .stripe_client import get_stripe_gateway
 
 
 # -------------------- OrderLineItem Inline -------------------- #
@@ -20,7 +18,7 @@ def make_accepted(modeladmin, request, queryset):
     for order in queryset:
         if order.status != 'accepted':
             try:
-                stripe.PaymentIntent.capture(order.stripe_pid)
+                get_stripe_gateway().capture_payment_intent(order.stripe_pid)
                 order.status = 'accepted'
                 order.save()
                 modeladmin.message_user(
@@ -43,7 +41,7 @@ def make_declined(modeladmin, request, queryset):
     for order in queryset:
         if order.status != 'declined':
             try:
-                stripe.PaymentIntent.cancel(order.stripe_pid)
+                get_stripe_gateway().cancel_payment_intent(order.stripe_pid)
                 order.status = 'declined'
                 order.save()
                 modeladmin.message_user(
@@ -104,7 +102,12 @@ class OrderAdmin(admin.ModelAdmin):
     list_filter = ('status', 'date')
     search_fields = ('order_number', 'full_name', 'email')
     ordering = ('-date',)
-    actions = [make_accepted, make_declined]
+    actions = [
+        make_accepted,
+        make_declined,
+        order_export.action('csv'),
+        order_export.action('ndjson'),
+    ]
 
 
 # -------------------- OrderChangeRequest Admin -------------------- #
@@ -114,3 +117,18 @@ class OrderChangeRequestAdmin(admin.ModelAdmin):
     list_filter = ('status', 'created_at')
     search_fields = ('order__order_number', 'user__username')
     actions = [make_accepted, make_declined]
+
+
+# -------------------- WebhookEvent Admin -------------------- #
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = (
+        'event_id', 'type', 'status', 'attempts', 'received_at',
+        'handling_ms',
+    )
+    list_filter = ('status', 'type')
+    search_fields = ('event_id',)
+    readonly_fields = (
+        'event_id', 'type', 'payload', 'attempts', 'received_at',
+        'processed_at', 'handling_ms', 'last_error',
+    )
@@ -0,0 +1,59 @@
+from django.db.models import Prefetch
+from boutique_ado.exports import Export
+from .models import OrderLineItem
+
+ORDER_FIELDS = (
+    'order_number', 'date', 'status', 'full_name', 'email', 'phone_number',
+    'country', 'postcode', 'town_or_city', 'street_address1',
+    'street_address2', 'county', 'delivery_cost', 'order_total',
+    'grand_total', 'stripe_pid',
+)
+LINE_ITEM_FIELDS = (
+    'sku', 'product', 'product_size', 'quantity', 'lineitem_total',
+)
+
+
+class OrderExport(Export):
+    """
+    Exports each order with its line items: nested in NDJSON, and as one
+    CSV row per line item with the order's columns repeated
+    """
+    name = 'orders'
+    header = ORDER_FIELDS + LINE_ITEM_FIELDS
+
+    def records(self, queryset, chunk_size):
+        # With a chunk size, iterator() prefetches line items one chunk
+        # of orders at a time
+        lineitems = OrderLineItem.objects.select_related('product').only(
+            'order_id', 'product_size', 'quantity', 'lineitem_total',
+            'product__sku', 'product__name',
+        ).order_by('pk')
+        orders = queryset.order_by('pk').prefetch_related(
+            Prefetch('lineitems', queryset=lineitems)
+        )
+        for order in orders.iterator(chunk_size=chunk_size):
+            record = {field: getattr(order, field) for field in ORDER_FIELDS}
+            record['country'] = order.country.code
+            record['lineitems'] = [
+                {
+                    'sku': item.product.sku,
+                    'product': item.product.name,
+                    'product_size': item.product_size,
+                    'quantity': item.quantity,
+                    'lineitem_total': item.lineitem_total,
+                }
+                for item in order.lineitems.all()
+            ]
+            yield record
+
+    def rows(self, record):
+        order = [record[field] for field in ORDER_FIELDS]
+        if not record['lineitems']:
+            return [order + [''] * len(LINE_ITEM_FIELDS)]
+        return [
+            order + [item[field] for field in LINE_ITEM_FIELDS]
+            for item in record['lineitems']
+        ]
+
+
+order_export = OrderExport()
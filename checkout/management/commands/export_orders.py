@@ -0,0 +1,21 @@
+from boutique_ado.exports import ExportCommand
+from checkout.exports import order_export
+from checkout.models import Order
+
+
+class Command(ExportCommand):
+    help = "Stream orders and their line items to CSV or NDJSON."
+    export = order_export
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--status', choices=[key for key, label in Order.STATUS_CHOICES],
+            help='Only export orders with this status',
+        )
+
+    def get_queryset(self, options):
+        orders = Order.objects.all()
+        if options['status']:
+            orders = orders.filter(status=options['status'])
+        return orders
@@ -0,0 +1,80 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from checkout.stripe_client import get_stripe_gateway
+from checkout.webhook_queue import claim_events, process_event_in_thread
+
+
+class Command(BaseCommand):
+    help = (
+        "Handle the Stripe webhook events queued by the webhook view, "
+        "retrying failures with backoff."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=4,
+            help='Events handled at once (default 4)',
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help='Seconds to wait when no event is due (default 1)',
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Stop once no event is due instead of waiting for more',
+        )
+
+    def _report(self, outcomes, timings):
+        if not timings:
+            return
+        timings = sorted(timings)
+        count = len(timings)
+        summary = ', '.join(
+            f'{outcome} {number}' for outcome, number in sorted(
+                outcomes.items()
+            )
+        )
+        self.stdout.write(
+            f'{count} events: {summary}; handling p50 '
+            f'{timings[count // 2]:.1f} ms, p95 '
+            f'{timings[min(count * 95 // 100, count - 1)]:.1f} ms, '
+            f'max {timings[-1]:.1f} ms'
+        )
+        for name, metrics in sorted(get_stripe_gateway().metrics.items()):
+            self.stdout.write(f'Stripe {name}: {metrics}')
+
+    def handle(self, *args, **options):
+        concurrency = max(options['concurrency'], 1)
+        outcomes = {}
+        timings = []
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            try:
+                while True:
+                    events = claim_events(concurrency)
+                    if not events:
+                        if options['once']:
+                            break
+                        time.sleep(options['poll_interval'])
+                        continue
+
+                    results = pool.map(process_event_in_thread, events)
+                    for event, outcome in zip(events, results):
+                        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                        # event was updated in the worker thread
+                        queued_ms = (
+                            timezone.now() - event.received_at
+                        ).total_seconds() * 1000
+                        timings.append(event.handling_ms)
+                        self.stdout.write(
+                            f'{event.event_id} {event.type}: {outcome} '
+                            f'(attempt {event.attempts}, handled in '
+                            f'{event.handling_ms:.1f} ms, '
+                            f'{queued_ms:.0f} ms after it arrived)'
+                        )
+                        if event.last_error and outcome != 'done':
+                            self.stdout.write(f'  {event.last_error}')
+            except KeyboardInterrupt:
+                pass
+        self._report(outcomes, timings)
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:51
+
+import hashlib
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def hash_original_bags(apps, schema_editor):
+    Order = apps.get_model('checkout', 'Order')
+    batch = []
+    orders = Order.objects.only('id', 'original_bag').order_by('id')
+    for order in orders.iterator(chunk_size=2000):
+        order.original_bag_hash = hashlib.sha256(
+            order.original_bag.encode()
+        ).hexdigest()
+        batch.append(order)
+        if len(batch) == 2000:
+            Order.objects.bulk_update(batch, ['original_bag_hash'])
+            batch = []
+    Order.objects.bulk_update(batch, ['original_bag_hash'])
+
+
+def check_unique_stripe_pids(apps, schema_editor):
+    Order = apps.get_model('checkout', 'Order')
+    duplicates = list(
+        Order.objects.exclude(stripe_pid='')
+        .values('stripe_pid')
+        .annotate(orders=Count('id'))
+        .filter(orders__gt=1)
+        .values_list('stripe_pid', flat=True)[:10]
+    )
+    if duplicates:
+        raise RuntimeError(
+            'Several orders share these payment intents, so stripe_pid '
+            'cannot be made unique until they are resolved: '
+            + ', '.join(duplicates)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0007_order_status'),
+        ('profiles', '0005_useraddress_full_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='original_bag_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(hash_original_bags, migrations.RunPython.noop),
+        migrations.RunPython(
+            check_unique_stripe_pids, migrations.RunPython.noop
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('stripe_pid', ''), _negated=True), fields=('stripe_pid',), name='unique_order_stripe_pid'),
+        ),
+    ]
@@ -1,14 +1,23 @@
+import hashlib
 import uuid
 from django.db import models
 from django.db.models import Sum
-from django.conf import settings
 from django.contrib.auth.models import User
 from django_countries.fields import CountryField
 from django.utils import timezone
+from boutique_ado.pricing import to_pence, to_pounds, totals
 from products.models import Product
 from profiles.models import UserProfile
 
 
+def hash_bag(original_bag):
+    """
+    Return the hash an order's bag is matched on, rather than comparing
+    the whole bag
+    """
+    return hashlib.sha256(original_bag.encode()).hexdigest()
+
+
 # Create your models here.
 class Order(models.Model):
     STATUS_CHOICES = [
@@ -44,6 +53,9 @@ class Order(models.Model):
         max_digits=10, decimal_places=2, null=False, default=0
         )
     original_bag = models.TextField(null=False, blank=False, default='')
+    original_bag_hash = models.CharField(
+        max_length=64, null=False, blank=True, default='', editable=False
+        )
     stripe_pid = models.CharField(
         max_length=254, null=False, blank=False, default=''
         )
@@ -51,6 +63,16 @@ class Order(models.Model):
         max_length=10, choices=STATUS_CHOICES, default='pending'
         )
 
+    class Meta:
+        constraints = [
+            # One order per payment; orders without one are left alone
+            models.UniqueConstraint(
+                fields=['stripe_pid'],
+                condition=~models.Q(stripe_pid=''),
+                name='unique_order_stripe_pid',
+            ),
+        ]
+
     def _generate_order_number(self):
         """
         Generate a random, unique order number using uuid
@@ -62,18 +84,20 @@ class Order(models.Model):
         Update grand total each time a line item is added,
         accounting for delivery costs
         """
-        self.order_total = self.lineitems.aggregate(
+        order_total = self.lineitems.aggregate(
             total=Sum('lineitem_total')
         )['total'] or 0
-        if self.order_total < settings.FREE_DELIVERY_THRESHOLD:
-            self.delivery_cost = (
-                self.order_total * settings.STANDARD_DELIVERY_PERCENTAGE / 100
-                )
-        else:
-            self.delivery_cost = 0
-        self.grand_total = self.order_total + self.delivery_cost
+        self.set_totals(totals(to_pence(order_total)))
         self.save()
 
+    def set_totals(self, order_totals):
+        """
+        Set the order, delivery and grand totals from pricing Totals
+        """
+        self.order_total = to_pounds(order_totals.total)
+        self.delivery_cost = to_pounds(order_totals.delivery)
+        self.grand_total = to_pounds(order_totals.grand_total)
+
     def save(self, *args, **kwargs):
         """
         Override the original save method to set the order number
@@ -81,6 +105,7 @@ class Order(models.Model):
         """
         if not self.order_number:
             self.order_number = self._generate_order_number()
+        self.original_bag_hash = hash_bag(self.original_bag)
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -113,7 +138,9 @@ class OrderLineItem(models.Model):
         Override the original save method to set the order number
         if it hasn't been set already
         """
-        self.lineitem_total = self.product.price * self.quantity
+        self.lineitem_total = to_pounds(
+            to_pence(self.product.price) * self.quantity
+        )
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -156,3 +183,48 @@ class OrderChangeRequest(models.Model):
             f"Change Request for Order {self.order.order_number} by "
             f"{self.user.username}"
             )
+
+
+class WebhookEvent(models.Model):
+    """
+    A Stripe webhook event waiting to be, or already, handled by the
+    process_webhooks worker. Stripe's event id makes redelivered events
+    land on the same row.
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=PENDING
+        )
+    attempts = models.PositiveIntegerField(default=0)
+    # When the event may next be picked up. While an event is being
+    # handled this is the end of the worker's lease on it.
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    handling_ms = models.FloatField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        ordering = ['-received_at']
+        indexes = [
+            models.Index(
+                fields=['status', 'next_attempt_at'],
+                name='webhook_event_queue_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.type} {self.event_id} ({self.status})'
@@ -0,0 +1,63 @@
+"""
+One Stripe PaymentIntent per bag.
+
+The intent made for a checkout is remembered in the session with the
+amount it was made for. Showing the checkout page again reuses it with
+no call to Stripe, changes its amount when the bag total has changed,
+and only makes a new one when there is none, when an order has already
+been made for it, or when Stripe will no longer change the old one, as
+once it has succeeded or been cancelled.
+"""
+import stripe
+from django.conf import settings
+from .models import Order
+from .stripe_client import get_stripe_gateway
+
+PAYMENT_INTENT_SESSION_KEY = 'payment_intent'
+
+
+def get_payment_intent(request, amount):
+    """
+    Return the id and client secret of the session's payment intent,
+    making sure it is for the given amount in pence
+    """
+    stored = request.session.get(PAYMENT_INTENT_SESSION_KEY)
+    if stored and Order.objects.filter(stripe_pid=stored['id']).exists():
+        # Paid for, though the shopper never reached the success page
+        stored = None
+    currency = settings.STRIPE_CURRENCY
+    if stored and stored['currency'] == currency:
+        if stored['amount'] == amount:
+            return stored
+        try:
+            get_stripe_gateway().modify_payment_intent(
+                stored['id'], amount=amount
+            )
+        except stripe.InvalidRequestError:
+            # Finished with, or no longer known to Stripe
+            pass
+        else:
+            stored = dict(stored, amount=amount)
+            request.session[PAYMENT_INTENT_SESSION_KEY] = stored
+            return stored
+
+    intent = get_stripe_gateway().create_payment_intent(
+        amount=amount,
+        currency=currency,
+        capture_method='automatic',
+    )
+    stored = {
+        'id': intent.id,
+        'client_secret': intent.client_secret,
+        'amount': amount,
+        'currency': currency,
+    }
+    request.session[PAYMENT_INTENT_SESSION_KEY] = stored
+    return stored
+
+
+def forget_payment_intent(request):
+    """
+    Stop reusing the session's payment intent, once it has been paid
+    """
+    request.session.pop(PAYMENT_INTENT_SESSION_KEY, None)
@@ -0,0 +1,67 @@
+"""
+Building orders from bags, shared by the checkout view and the Stripe
+webhook.
+
+Every product in the bag is fetched in one query, the line totals and
+order totals are worked out once in pence, and the order and all its
+line items are written in one transaction. The line items are inserted
+together, so the per-line signal that recalculates the order total does
+not run.
+"""
+from django.db import transaction
+from boutique_ado.pricing import price_lines, to_pence, to_pounds
+from products.models import Product
+from .models import OrderLineItem
+
+
+def bag_lines(bag):
+    """
+    Return (product id, size, quantity) for each line of a bag
+    """
+    for item_id, item_data in bag.items():
+        if isinstance(item_data, int):
+            yield int(item_id), None, item_data
+        else:
+            for size, quantity in item_data['items_by_size'].items():
+                yield int(item_id), size, quantity
+
+
+def build_order(order, bag):
+    """
+    Save an unsaved order with a line item for each line of the bag.
+    Raises Product.DoesNotExist, saving nothing, if a product in the bag
+    no longer exists.
+    """
+    lines = list(bag_lines(bag))
+    products = Product.objects.only('id', 'sku', 'price').in_bulk(
+        {product_id for product_id, size, quantity in lines}
+    )
+    missing = {
+        product_id for product_id, size, quantity in lines
+        if product_id not in products
+    }
+    if missing:
+        raise Product.DoesNotExist(
+            f'Products {", ".join(map(str, sorted(missing)))} not found'
+        )
+
+    line_totals, totals = price_lines(
+        [to_pence(products[product_id].price) for product_id, _, _ in lines],
+        [quantity for _, _, quantity in lines],
+    )
+    order.set_totals(totals)
+
+    with transaction.atomic():
+        order.save()
+        OrderLineItem.objects.bulk_create([
+            OrderLineItem(
+                order=order,
+                product=products[product_id],
+                product_size=size,
+                quantity=quantity,
+                lineitem_total=to_pounds(line_total),
+            )
+            for (product_id, size, quantity), line_total
+            in zip(lines, line_totals)
+        ])
+    return order
@@ -70,6 +70,7 @@ document.addEventListener('DOMContentLoaded', () => {
             'csrfmiddlewaretoken': csrfToken,
             'client_secret': clientSecret,
             'save_info': saveInfo,
+            'email': form.email.value.trim(),
         };
 
         // URL for the request
@@ -0,0 +1,155 @@
+"""
+The Stripe calls the shop makes, behind one gateway.
+
+STRIPE_CLIENT picks the gateway: 'stripe' calls the Stripe API, and
+'stub' answers from checkout.stripe_stub without leaving the process,
+for local development and for counting the calls a checkout makes.
+
+The Stripe gateway keeps one StripeClient, whose HTTP client keeps a
+connection pool per thread, so calls after the first reuse a connection
+rather than opening a new one. STRIPE_TIMEOUT bounds how long a call
+can wait to connect and to read. Each gateway times every call it makes
+and keeps the count, errors and latency per kind of call in metrics.
+"""
+import logging
+import threading
+import time
+import stripe
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+GATEWAYS = {
+    'stripe': 'checkout.stripe_client.StripeGateway',
+    'stub': 'checkout.stripe_stub.StubGateway',
+}
+# Seconds to connect and seconds to read
+STRIPE_TIMEOUT = getattr(settings, 'STRIPE_TIMEOUT', (3.05, 10))
+STRIPE_MAX_NETWORK_RETRIES = getattr(
+    settings, 'STRIPE_MAX_NETWORK_RETRIES', 2
+)
+
+logger = logging.getLogger(__name__)
+
+
+class CallMetrics:
+    """
+    The count, errors and latency of one kind of call
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms, failed):
+        self.count += 1
+        self.errors += failed
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    @property
+    def mean_ms(self):
+        return self.total_ms / self.count if self.count else 0.0
+
+    def __str__(self):
+        return (
+            f'{self.count} calls, {self.errors} errors, mean '
+            f'{self.mean_ms:.1f} ms, max {self.max_ms:.1f} ms'
+        )
+
+
+class StripeGateway:
+    """
+    Calls to the Stripe API with the shop's secret key
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = stripe.StripeClient(
+                settings.STRIPE_SECRET_KEY,
+                http_client=stripe.RequestsClient(timeout=STRIPE_TIMEOUT),
+                max_network_retries=STRIPE_MAX_NETWORK_RETRIES,
+            )
+        return self._client
+
+    def _call(self, name, function, *args, **kwargs):
+        """
+        Make a call, recording how long it took under name
+        """
+        started = time.perf_counter()
+        failed = False
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.metrics.setdefault(name, CallMetrics()).record(
+                    elapsed_ms, failed
+                )
+            logger.info(
+                'Stripe %s %s in %.1f ms', name,
+                'failed' if failed else 'succeeded', elapsed_ms,
+            )
+
+    def reset_metrics(self):
+        with self.lock:
+            self.metrics = {}
+
+    def create_payment_intent(self, **params):
+        return self._call(
+            'create_payment_intent',
+            self.client.v1.payment_intents.create, params,
+        )
+
+    def modify_payment_intent(self, pid, **params):
+        return self._call(
+            'modify_payment_intent',
+            self.client.v1.payment_intents.update, pid, params,
+        )
+
+    def capture_payment_intent(self, pid):
+        return self._call(
+            'capture_payment_intent',
+            self.client.v1.payment_intents.capture, pid,
+        )
+
+    def cancel_payment_intent(self, pid):
+        return self._call(
+            'cancel_payment_intent',
+            self.client.v1.payment_intents.cancel, pid,
+        )
+
+    def retrieve_charge(self, charge_id):
+        return self._call(
+            'retrieve_charge', self.client.v1.charges.retrieve, charge_id,
+        )
+
+    def construct_event(self, payload, sig_header, secret):
+        """
+        Verify a webhook's signature and return its event. This needs no
+        call to Stripe.
+        """
+        return stripe.Webhook.construct_event(
+            payload=payload, sig_header=sig_header, secret=secret
+        )
+
+
+_gateways = {}
+
+
+def get_stripe_gateway():
+    """
+    Return the gateway chosen by STRIPE_CLIENT, the same one each time
+    """
+    name = getattr(settings, 'STRIPE_CLIENT', 'stripe')
+    if name not in _gateways:
+        _gateways[name] = import_string(GATEWAYS[name])()
+    return _gateways[name]
@@ -0,0 +1,171 @@
+"""
+A local stand-in for the Stripe API.
+
+StubGateway keeps payment intents and charges in memory and answers
+with the same Stripe objects the API would, so checkout works without
+network access or keys. It counts every call by name, so a flow can be
+checked for the calls it makes, and times them like the real gateway.
+succeed_payment_intent() plays the part of a shopper completing a
+payment, and payment_intent_event() gives the webhook event for it.
+"""
+import secrets
+from collections import Counter
+import stripe
+from .stripe_client import StripeGateway
+
+# Intents in these states can no longer be changed
+TERMINAL_STATUSES = ('succeeded', 'canceled')
+
+
+def _object(cls, values):
+    return cls.construct_from(values, 'sk_stub')
+
+
+class StubGateway(StripeGateway):
+    """
+    An in-memory Stripe that records the calls made to it
+    """
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def reset(self):
+        self.reset_metrics()
+        self.calls = Counter()
+        self.payment_intents = {}
+        self.charges = {}
+
+    def _call(self, name, function, *args, **kwargs):
+        with self.lock:
+            self.calls[name] += 1
+        return super()._call(name, function, *args, **kwargs)
+
+    def _intent(self, pid):
+        try:
+            return self.payment_intents[pid]
+        except KeyError:
+            raise stripe.InvalidRequestError(
+                f'No such payment_intent: {pid}', 'intent'
+            )
+
+    def create_payment_intent(self, **params):
+        return self._call(
+            'create_payment_intent', self._create_payment_intent, **params
+        )
+
+    def _create_payment_intent(self, amount, currency, **params):
+        with self.lock:
+            pid = f'pi_stub_{secrets.token_hex(12)}'
+            intent = self.payment_intents[pid] = {
+                'id': pid,
+                'object': 'payment_intent',
+                'amount': amount,
+                'amount_received': 0,
+                'currency': currency,
+                'capture_method': params.get('capture_method', 'automatic'),
+                'client_secret': f'{pid}_secret_{secrets.token_hex(8)}',
+                'latest_charge': None,
+                'metadata': dict(params.get('metadata') or {}),
+                'receipt_email': None,
+                'shipping': None,
+                'status': 'requires_payment_method',
+            }
+            return _object(stripe.PaymentIntent, intent)
+
+    def modify_payment_intent(self, pid, **params):
+        return self._call(
+            'modify_payment_intent', self._modify_payment_intent, pid,
+            **params
+        )
+
+    def _modify_payment_intent(self, pid, **params):
+        with self.lock:
+            intent = self._intent(pid)
+            if intent['status'] in TERMINAL_STATUSES:
+                raise stripe.InvalidRequestError(
+                    'This PaymentIntent can no longer be modified because '
+                    f"it has a status of {intent['status']}.", 'intent'
+                )
+            intent['metadata'].update(params.pop('metadata', None) or {})
+            intent.update(params)
+            return _object(stripe.PaymentIntent, intent)
+
+    def capture_payment_intent(self, pid):
+        return self._call(
+            'capture_payment_intent', self._capture_payment_intent, pid
+        )
+
+    def _capture_payment_intent(self, pid):
+        with self.lock:
+            intent = self._intent(pid)
+            intent['status'] = 'succeeded'
+            return _object(stripe.PaymentIntent, intent)
+
+    def cancel_payment_intent(self, pid):
+        return self._call(
+            'cancel_payment_intent', self._cancel_payment_intent, pid
+        )
+
+    def _cancel_payment_intent(self, pid):
+        with self.lock:
+            intent = self._intent(pid)
+            if intent['status'] == 'succeeded':
+                raise stripe.InvalidRequestError(
+                    'This PaymentIntent could not be canceled because it has '
+                    'a status of succeeded.', 'intent'
+                )
+            intent['status'] = 'canceled'
+            return _object(stripe.PaymentIntent, intent)
+
+    def retrieve_charge(self, charge_id):
+        return self._call(
+            'retrieve_charge', self._retrieve_charge, charge_id
+        )
+
+    def _retrieve_charge(self, charge_id):
+        with self.lock:
+            try:
+                return _object(stripe.Charge, self.charges[charge_id])
+            except KeyError:
+                raise stripe.InvalidRequestError(
+                    f'No such charge: {charge_id}', 'id'
+                )
+
+    def succeed_payment_intent(self, pid, billing_details=None, shipping=None):
+        """
+        Complete a payment as the shopper's browser would, returning the
+        intent. Not counted as a call, since the shop never makes it.
+        """
+        with self.lock:
+            intent = self._intent(pid)
+            charge_id = f'ch_stub_{secrets.token_hex(12)}'
+            self.charges[charge_id] = {
+                'id': charge_id,
+                'object': 'charge',
+                'amount': intent['amount'],
+                'billing_details': billing_details or {},
+                'payment_intent': pid,
+            }
+            intent.update(
+                status='succeeded',
+                amount_received=intent['amount'],
+                latest_charge=charge_id,
+                shipping=shipping,
+            )
+            return _object(stripe.PaymentIntent, intent)
+
+    def payment_intent_event(self, pid, expand_charge=False):
+        """
+        Return the payment_intent.succeeded event Stripe would send for
+        an intent, with its latest charge expanded if asked
+        """
+        with self.lock:
+            intent = dict(self._intent(pid))
+            if expand_charge and intent['latest_charge']:
+                intent['latest_charge'] = self.charges[intent['latest_charge']]
+            return _object(stripe.Event, {
+                'id': f'evt_stub_{secrets.token_hex(12)}',
+                'object': 'event',
+                'type': 'payment_intent.succeeded',
+                'data': {'object': intent},
+            })
@@ -1,3 +1,519 @@
-from django.test import TestCase
+import csv
+import hashlib
+import hmac
+import io
+import json
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.http import StreamingHttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from boutique_ado.pricing import delivery_pence, price_lines, to_pence
+from products.sample_data import seed_catalogue
+from products.models import Product
+from .models import Order, OrderLineItem, WebhookEvent, hash_bag
+from .payments import PAYMENT_INTENT_SESSION_KEY
+from .stripe_client import get_stripe_gateway
+from .webhook_handler import RetryLater, StripeWH_Handler
+from .webhook_queue import (
+    WEBHOOK_RETRY_MAX, claim_events, process_event, retry_delay,
+)
 
-# Create your tests here.
+ORDER_DETAILS = {
+    'full_name': 'Stripe Stub',
+    'email': 'stub@example.com',
+    'phone_number': '01234 567890',
+    'country': 'GB',
+    'postcode': 'AB1 2CD',
+    'town_or_city': 'Town',
+    'street_address1': '1 Street',
+    'street_address2': '',
+    'county': '',
+    'address_id': '',
+}
+BILLING_DETAILS = {
+    'email': ORDER_DETAILS['email'],
+    'name': ORDER_DETAILS['full_name'],
+    'phone': ORDER_DETAILS['phone_number'],
+}
+SHIPPING = {
+    'name': ORDER_DETAILS['full_name'],
+    'phone': ORDER_DETAILS['phone_number'],
+    'address': {
+        'city': 'Town',
+        'country': 'GB',
+        'line1': '1 Street',
+        'line2': '',
+        'postal_code': 'AB1 2CD',
+        'state': '',
+    },
+}
+
+
+@override_settings(FREE_DELIVERY_THRESHOLD=50, STANDARD_DELIVERY_PERCENTAGE=10)
+class PricingTests(SimpleTestCase):
+    """
+    Totals are worked out in pence and rounded half up
+    """
+    def test_to_pence(self):
+        cases = [
+            (Decimal('53.99'), 5399),
+            (Decimal('0.005'), 1),
+            (Decimal('0.004'), 0),
+            (1.005, 101),
+            ('19.995', 2000),
+            (7, 700),
+        ]
+        for amount, pence in cases:
+            with self.subTest(amount=amount):
+                self.assertEqual(to_pence(amount), pence)
+
+    def test_delivery_rounds_half_up(self):
+        cases = [(1004, 100), (1005, 101), (4999, 500), (5000, 0), (0, 0)]
+        for total, delivery in cases:
+            with self.subTest(total=total):
+                self.assertEqual(delivery_pence(total), delivery)
+
+    @override_settings(STANDARD_DELIVERY_PERCENTAGE=12.5)
+    def test_fractional_delivery_rate(self):
+        self.assertEqual(delivery_pence(1004), 126)
+        self.assertEqual(delivery_pence(1003), 125)
+
+    def test_price_lines(self):
+        lines, totals = price_lines([1999, 550], [2, 3])
+        self.assertEqual(lines, [3998, 1650])
+        self.assertEqual(totals.total, 5648)
+        self.assertEqual(totals.delivery, 0)
+        self.assertEqual(totals.grand_total, 5648)
+        self.assertEqual(totals.free_delivery_delta, 0)
+
+        lines, totals = price_lines([1999], [1])
+        self.assertEqual(totals.delivery, 200)
+        self.assertEqual(totals.grand_total, 2199)
+        self.assertEqual(totals.free_delivery_delta, 3001)
+
+
+@override_settings(STRIPE_CLIENT='stub')
+class StripeCallTests(TestCase):
+    """
+    Each checkout step makes only the Stripe calls it needs, checked
+    against the local stub
+    """
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalogue(10)
+
+    def setUp(self):
+        self.stub = get_stripe_gateway()
+        self.stub.reset()
+        self.checkout_url = reverse('checkout:checkout')
+        self._add_to_bag()
+
+    def _add_to_bag(self):
+        self.client.post(reverse('bag:add_to_bag', args=[1]), {'quantity': 1})
+
+    def assertStripeCalls(self, expected, request):
+        """
+        Make a request and check the Stripe calls it made
+        """
+        before = self.stub.calls.copy()
+        response = request()
+        self.assertLess(response.status_code, 400)
+        self.assertEqual(dict(self.stub.calls - before), expected)
+        return response
+
+    def _pay(self):
+        """
+        Show the checkout, pay for the bag and return the intent
+        """
+        self.client.get(self.checkout_url)
+        intent = self.client.session[PAYMENT_INTENT_SESSION_KEY]
+        self.assertStripeCalls(
+            {'modify_payment_intent': 1},
+            lambda: self.client.post(
+                reverse('checkout:cache_checkout_data'),
+                {
+                    'client_secret': intent['client_secret'],
+                    'email': ORDER_DETAILS['email'],
+                },
+            ),
+        )
+        self.stub.succeed_payment_intent(
+            intent['id'], billing_details=BILLING_DETAILS, shipping=SHIPPING,
+        )
+        return intent
+
+    def test_checkout_page_reuses_the_intent(self):
+        self.assertStripeCalls(
+            {'create_payment_intent': 1},
+            lambda: self.client.get(self.checkout_url),
+        )
+        self.assertStripeCalls({}, lambda: self.client.get(self.checkout_url))
+
+        self.client.post(
+            reverse('bag:adjust_bag', args=[1]), {'quantity': 2}
+        )
+        self.assertStripeCalls(
+            {'modify_payment_intent': 1},
+            lambda: self.client.get(self.checkout_url),
+        )
+        self.assertStripeCalls(
+            {},
+            lambda: self.client.post(
+                self.checkout_url, dict(ORDER_DETAILS, email='x')
+            ),
+        )
+
+    def test_placing_an_order_makes_no_calls(self):
+        intent = self._pay()
+        response = self.assertStripeCalls(
+            {},
+            lambda: self.client.post(
+                self.checkout_url,
+                dict(ORDER_DETAILS, client_secret=intent['client_secret']),
+            ),
+        )
+        self.assertStripeCalls({}, lambda: self.client.get(response.url))
+        self.assertTrue(Order.objects.filter(stripe_pid=intent['id']).exists())
+
+        self._add_to_bag()
+        self.assertStripeCalls(
+            {'create_payment_intent': 1},
+            lambda: self.client.get(self.checkout_url),
+        )
+
+    def test_paid_intent_is_not_reused(self):
+        # The webhook makes the order, but the shopper closes the tab
+        # before the checkout view or the success page runs
+        pid = self._pay()['id']
+        StripeWH_Handler().handle(self.stub.payment_intent_event(pid))
+        self.assertStripeCalls(
+            {'create_payment_intent': 1},
+            lambda: self.client.get(self.checkout_url),
+        )
+        self.assertNotEqual(
+            self.client.session[PAYMENT_INTENT_SESSION_KEY]['id'], pid
+        )
+
+    def test_webhook_reads_the_event_payload(self):
+        pid = self._pay()['id']
+        handler = StripeWH_Handler()
+        self.assertStripeCalls(
+            {}, lambda: handler.handle(self.stub.payment_intent_event(pid))
+        )
+        self.assertTrue(Order.objects.filter(stripe_pid=pid).exists())
+
+        # As for a payment whose checkout data never reached the shop
+        del self.stub.payment_intents[pid]['metadata']['email']
+        self.assertStripeCalls(
+            {},
+            lambda: handler.handle(
+                self.stub.payment_intent_event(pid, expand_charge=True)
+            ),
+        )
+        self.assertStripeCalls(
+            {'retrieve_charge': 1},
+            lambda: handler.handle(self.stub.payment_intent_event(pid)),
+        )
+        self.assertEqual(self.stub.metrics['retrieve_charge'].count, 1)
+
+
+@override_settings(STRIPE_CLIENT='stub')
+class WebhookOrderMatchingTests(TestCase):
+    """
+    The webhook finds the order for a payment by its payment intent id
+    and bag hash, and never makes a second order for one payment
+    """
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalogue(10)
+
+    def setUp(self):
+        self.stub = get_stripe_gateway()
+        self.stub.reset()
+        self.client.post(reverse('bag:add_to_bag', args=[1]), {'quantity': 1})
+        self.client.get(reverse('checkout:checkout'))
+        self.intent = self.client.session[PAYMENT_INTENT_SESSION_KEY]
+        self.client.post(
+            reverse('checkout:cache_checkout_data'),
+            {
+                'client_secret': self.intent['client_secret'],
+                'email': ORDER_DETAILS['email'],
+            },
+        )
+        self.stub.succeed_payment_intent(
+            self.intent['id'],
+            billing_details=BILLING_DETAILS,
+            shipping=SHIPPING,
+        )
+
+    def _place_order(self):
+        self.client.post(
+            reverse('checkout:checkout'),
+            dict(ORDER_DETAILS, client_secret=self.intent['client_secret']),
+        )
+        return Order.objects.get(stripe_pid=self.intent['id'])
+
+    def _handle(self, handler=None):
+        handler = handler or StripeWH_Handler()
+        return handler.handle(
+            self.stub.payment_intent_event(self.intent['id'])
+        )
+
+    def test_order_is_matched_on_pid_and_bag_hash(self):
+        order = self._place_order()
+        self.assertEqual(
+            order.original_bag_hash, hash_bag(order.original_bag)
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = self._handle()
+        self.assertContains(response, 'Verified order already in database')
+        lookup = next(
+            query['sql'] for query in queries.captured_queries
+            if 'FROM "checkout_order"' in query['sql']
+        )
+        self.assertIn('"stripe_pid"', lookup)
+        self.assertIn('"original_bag_hash"', lookup)
+        self.assertNotIn('"original_bag" ', lookup)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_webhook_makes_the_missing_order_once(self):
+        self.assertContains(self._handle(), 'Created order in webhook')
+        self.assertContains(
+            self._handle(), 'Verified order already in database'
+        )
+        order = Order.objects.get()
+        self.assertEqual(order.stripe_pid, self.intent['id'])
+        self.assertEqual(order.lineitems.count(), 1)
+
+    def test_checkout_uses_the_order_the_webhook_made(self):
+        self._handle()
+        response = self.client.post(
+            reverse('checkout:checkout'),
+            dict(ORDER_DETAILS, client_secret=self.intent['client_secret']),
+        )
+        order = Order.objects.get()
+        self.assertRedirects(
+            response,
+            reverse('checkout:checkout_success', args=[order.order_number]),
+            fetch_redirect_response=False,
+        )
+
+    def test_webhook_waits_for_the_checkout(self):
+        with self.assertRaises(RetryLater):
+            self._handle(StripeWH_Handler(wait_for_checkout=True))
+        self.assertFalse(Order.objects.exists())
+        self._place_order()
+        self.assertContains(
+            self._handle(StripeWH_Handler(wait_for_checkout=True)),
+            'Verified order already in database',
+        )
+
+    def test_payment_has_one_order(self):
+        order = self._place_order()
+        details = dict(ORDER_DETAILS)
+        del details['address_id']
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Order.objects.create(**details, stripe_pid=order.stripe_pid)
+        # Orders without a payment intent are not constrained
+        Order.objects.create(**details)
+        Order.objects.create(**details)
+
+
+class OrderExportTests(TestCase):
+    """
+    Orders stream out with their line items, nested in NDJSON and one
+    row per line item in CSV
+    """
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_superuser('export', 'export@example.com', 'x')
+        shirt = Product.objects.create(
+            sku='s1', name='Shirt', description='', price='12.50'
+        )
+        mug = Product.objects.create(
+            sku='m1', name='Mug', description='', price=3
+        )
+        details = dict(ORDER_DETAILS)
+        del details['address_id']
+        cls.order = Order.objects.create(**details, stripe_pid='pi_1')
+        OrderLineItem.objects.create(
+            order=cls.order, product=shirt, product_size='m', quantity=2
+        )
+        OrderLineItem.objects.create(order=cls.order, product=mug, quantity=1)
+        cls.empty = Order.objects.create(
+            **details, stripe_pid='pi_2', status='declined'
+        )
+
+    def test_admin_csv_export(self):
+        self.client.login(username='export', password='x')
+        response = self.client.post(
+            reverse('admin:checkout_order_changelist'),
+            {'action': 'export_csv', '_selected_action': [self.order.pk]},
+        )
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(
+            b''.join(response.streaming_content).decode()
+        )))
+        self.assertEqual(
+            [(row['order_number'], row['sku'], row['quantity']) for row in rows],
+            [
+                (self.order.order_number, 's1', '2'),
+                (self.order.order_number, 'm1', '1'),
+            ],
+        )
+        self.assertEqual(rows[0]['lineitem_total'], '25.00')
+        self.assertEqual(rows[0]['product_size'], 'm')
+        self.assertEqual(rows[0]['country'], 'GB')
+
+    def test_export_command(self):
+        stdout = io.StringIO()
+        call_command(
+            'export_orders', format='ndjson', chunk_size=1, stdout=stdout
+        )
+        records = [
+            json.loads(line) for line in stdout.getvalue().splitlines()
+        ]
+        self.assertEqual(
+            [record['stripe_pid'] for record in records], ['pi_1', 'pi_2']
+        )
+        self.assertEqual(
+            [item['sku'] for item in records[0]['lineitems']], ['s1', 'm1']
+        )
+        self.assertEqual(records[1]['lineitems'], [])
+
+        stdout = io.StringIO()
+        call_command('export_orders', status='declined', stdout=stdout)
+        rows = list(csv.DictReader(io.StringIO(stdout.getvalue())))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['stripe_pid'], 'pi_2')
+        self.assertEqual(rows[0]['sku'], '')
+
+
+def _signature(body, secret):
+    timestamp = int(time.time())
+    digest = hmac.new(
+        secret.encode(), f'{timestamp}.{body}'.encode(), hashlib.sha256
+    ).hexdigest()
+    return f't={timestamp},v1={digest}'
+
+
+@override_settings(STRIPE_CLIENT='stub', STRIPE_WH_SECRET='whsec_test')
+class WebhookQueueTests(TestCase):
+    """
+    Verified events are stored as Stripe sent them, once each, and the
+    worker handles them from there
+    """
+    def _post(self, body):
+        return self.client.post(
+            reverse('checkout:webhook'),
+            body,
+            content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=_signature(body, 'whsec_test'),
+        )
+
+    def test_events_are_queued_as_sent(self):
+        payload = {
+            'id': 'evt_test',
+            'object': 'event',
+            'type': 'payment_intent.payment_failed',
+            'data': {'object': {'id': 'pi_test', 'metadata': {}}},
+        }
+        body = json.dumps(payload)
+        self.assertContains(self._post(body), 'Queued')
+        self.assertContains(self._post(body), 'Already queued')
+
+        response = self.client.post(
+            reverse('checkout:webhook'),
+            body,
+            content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=_signature(body, 'whsec_other'),
+        )
+        self.assertEqual(response.status_code, 400)
+
+        webhook_event = WebhookEvent.objects.get()
+        self.assertEqual(webhook_event.payload, payload)
+
+        webhook_event, = claim_events(10)
+        self.assertEqual(process_event(webhook_event), 'done')
+        webhook_event.refresh_from_db()
+        self.assertEqual(webhook_event.status, WebhookEvent.DONE)
+
+    def _queue(self):
+        self._post(json.dumps({
+            'id': 'evt_retry',
+            'object': 'event',
+            'type': 'payment_intent.payment_failed',
+            'data': {'object': {'id': 'pi_retry', 'metadata': {}}},
+        }))
+
+    def _make_due(self):
+        WebhookEvent.objects.update(next_attempt_at=timezone.now())
+
+    @mock.patch('checkout.webhook_queue.WEBHOOK_MAX_ATTEMPTS', 3)
+    @mock.patch.object(
+        StripeWH_Handler, 'handle', side_effect=RuntimeError('Stripe down')
+    )
+    def test_failed_events_back_off_until_they_fail(self, handle):
+        self._queue()
+        for attempts in (1, 2):
+            webhook_event, = claim_events(10)
+            started = timezone.now()
+            self.assertEqual(process_event(webhook_event), 'retry')
+            webhook_event.refresh_from_db()
+            self.assertEqual(webhook_event.status, WebhookEvent.PENDING)
+            self.assertEqual(webhook_event.attempts, attempts)
+            self.assertEqual(
+                webhook_event.last_error, 'RuntimeError: Stripe down'
+            )
+            # Twice as long after each failure, less up to half for jitter
+            delay = 2 * 2 ** (attempts - 1)
+            wait = webhook_event.next_attempt_at - started
+            self.assertGreaterEqual(wait, timedelta(seconds=delay / 2 - 1))
+            self.assertLessEqual(wait, timedelta(seconds=delay))
+            self.assertEqual(claim_events(10), [])
+            self._make_due()
+
+        webhook_event, = claim_events(10)
+        self.assertEqual(process_event(webhook_event), 'failed')
+        webhook_event.refresh_from_db()
+        self.assertEqual(webhook_event.status, WebhookEvent.FAILED)
+        self.assertEqual(webhook_event.attempts, 3)
+        self._make_due()
+        self.assertEqual(claim_events(10), [])
+        self.assertEqual(handle.call_count, 3)
+
+    def test_retry_delay_is_capped(self):
+        self.assertLessEqual(
+            retry_delay(40), timedelta(seconds=WEBHOOK_RETRY_MAX)
+        )
+
+    @mock.patch.object(
+        StripeWH_Handler, 'handle', side_effect=RetryLater('No order yet')
+    )
+    def test_waiting_for_the_checkout_is_not_a_failure(self, handle):
+        self._queue()
+        webhook_event, = claim_events(10)
+        self.assertEqual(process_event(webhook_event), 'deferred')
+        webhook_event.refresh_from_db()
+        self.assertEqual(webhook_event.status, WebhookEvent.PENDING)
+        self.assertEqual(webhook_event.attempts, 0)
+        self.assertEqual(webhook_event.last_error, 'No order yet')
+
+    def test_lease_runs_out_for_a_dead_worker(self):
+        self._queue()
+        webhook_event, = claim_events(10)
+        # Another worker cannot take the event while the lease lasts
+        self.assertEqual(claim_events(10), [])
+        self._make_due()
+        webhook_event, = claim_events(10)
+        self.assertEqual(webhook_event.status, WebhookEvent.PROCESSING)
+        self.assertEqual(webhook_event.attempts, 2)
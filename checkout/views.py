@@ -4,13 +4,17 @@ from django.urls import reverse
 from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.db import IntegrityError
 from django.conf import settings
-import stripe
 import json
 from .forms import OrderForm, OrderChangeRequestForm
-from .models import Order, OrderLineItem
+from .models import Order
+from .payments import forget_payment_intent, get_payment_intent
+from .services import build_order
+from .stripe_client import get_stripe_gateway
 from products.models import Product
-from bag.contexts import bag_contents
+from bag.contexts import get_bag_summary
+from bag.storage import get_bag_storage
 from profiles.models import UserAddress, UserProfile
 
 
@@ -18,10 +22,11 @@ from profiles.models import UserAddress, UserProfile
 def cache_checkout_data(request):
     try:
         pid = request.POST.get('client_secret').split('_secret')[0]
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-        stripe.PaymentIntent.modify(pid, metadata={
-            'bag': json.dumps(request.session.get('bag', {})),
+        get_stripe_gateway().modify_payment_intent(pid, metadata={
+            'bag': json.dumps(get_bag_storage(request).bag),
             'save_info': request.POST.get('save_info'),
+            # Lets the webhook find the email without fetching the charge
+            'email': request.POST.get('email', ''),
             'username': (
                 request.user.id
                 if request.user.is_authenticated
@@ -38,27 +43,16 @@ def cache_checkout_data(request):
 
 def checkout(request):
     stripe_public_key = settings.STRIPE_PUBLIC_KEY
-    stripe_secret_key = settings.STRIPE_SECRET_KEY
 
-    bag = request.session.get('bag', {})
+    bag = get_bag_storage(request).bag
 
     # Redirect if bag is empty
     if not bag:
         messages.error(request, "There's nothing in your bag at the moment")
         return redirect(reverse('products'))
 
-    # Use bag_contents to calculate totals
-    current_bag = bag_contents(request)
-    total = current_bag['grand_total']
-    stripe_total = round(total * 100)
-    stripe.api_key = stripe_secret_key
-
-    # Create Stripe PaymentIntent (always create before rendering template)
-    intent = stripe.PaymentIntent.create(
-        amount=stripe_total,
-        currency=settings.STRIPE_CURRENCY,
-        capture_method='automatic',
-    )
+    # Use the bag summary to calculate totals
+    current_bag = get_bag_summary(request)
 
     if request.method == 'POST':
         form_data = {
@@ -113,34 +107,21 @@ def checkout(request):
                 order.street_address2 = addr.street_address2
                 order.county = addr.county
 
-            order.save()
-            # Create OrderLineItems from bag
-            for item_id, item_data in bag.items():
-                try:
-                    product = Product.objects.get(id=item_id)
-                    if isinstance(item_data, int):
-                        OrderLineItem.objects.create(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                    else:
-                        for size, quantity in (
-                            item_data['items_by_size'].items()
-                        ):
-                            OrderLineItem.objects.create(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                except Product.DoesNotExist:
-                    messages.error(request, (
-                        "One of the products in your bag wasn't found in our "
-                        "database. Please call us for assistance!"
-                    ))
-                    order.delete()
-                    return redirect(reverse('view_bag'))
+            # Save the order with a line item for each line of the bag
+            try:
+                build_order(order, bag)
+            except Product.DoesNotExist:
+                messages.error(request, (
+                    "One of the products in your bag wasn't found in our "
+                    "database. Please call us for assistance!"
+                ))
+                return redirect(reverse('bag:view_bag'))
+            except IntegrityError:
+                # The webhook made the order for this payment first. Any
+                # other integrity error is not ours to handle
+                order = Order.objects.filter(stripe_pid=pid).first()
+                if order is None:
+                    raise
 
             # Save info for future reference if checkbox checked
             request.session['save_info'] = 'save-info' in request.POST
@@ -245,11 +226,15 @@ def checkout(request):
             'environment?'
         )
 
+    # Reuse the bag's PaymentIntent, changing its amount if the bag has
+    # changed since it was made
+    intent = get_payment_intent(request, current_bag['grand_total_pence'])
+
     template = 'checkout/checkout.html'
     context = {
         'order_form': order_form,
         'stripe_public_key': stripe_public_key,
-        'client_secret': intent.client_secret,
+        'client_secret': intent['client_secret'],
         'bag_items': current_bag['bag_items'],
         'total': current_bag['total'],
         'grand_total': current_bag['grand_total'],
@@ -300,8 +285,8 @@ def checkout_success(request, order_number):
                      f'A confirmation email will be sent to {order.email}.'
                      )
 
-    if 'bag' in request.session:
-        del request.session['bag']
+    get_bag_storage(request).clear()
+    forget_payment_intent(request)
 
     template = 'checkout/checkout_success.html'
     context = {
@@ -1,37 +1,73 @@
 from django.http import HttpResponse
+from django.contrib.sites.models import Site
 from django.core.mail import send_mail
+from django.db import IntegrityError
 from django.template.loader import render_to_string
 from django.conf import settings
 from django.urls import reverse
-import time
-import stripe
 import json
-from .models import Order, OrderLineItem
-from products.models import Product
+import logging
+from boutique_ado.pricing import to_pence
+from .models import Order, hash_bag
+from .services import build_order
+from .stripe_client import get_stripe_gateway
 from profiles.models import UserProfile, UserAddress
 
+logger = logging.getLogger(__name__)
+
+
+class RetryLater(Exception):
+    """
+    Raised by a handler that should be run again later, not failed
+    """
+
 
 class StripeWH_Handler:
     """
     Handle Stripe Webhooks
     """
-    def __init__(self, request):
-        self.request = request
+    # The events handled other than by handle_event
+    EVENT_METHODS = {
+        'payment_intent.succeeded': 'handle_payment_intent_succeeded',
+        'payment_intent.payment_failed': 'handle_payment_intent_failed',
+    }
+
+    def __init__(self, wait_for_checkout=False):
+        # While the checkout view may still be making the order for a
+        # payment, defer to it rather than making the order here
+        self.wait_for_checkout = wait_for_checkout
+
+    def handle(self, event):
+        """
+        Pass an event to the method for its type
+        """
+        method = self.EVENT_METHODS.get(event['type'], 'handle_event')
+        return getattr(self, method)(event)
 
     def _send_confirmation_email(self, order):
         """
-        Send the user a confirmstion email
+        Send the user a confirmation email
         """
         cust_email = order.email
-        order_detail_url = self.request.build_absolute_uri(
-            reverse('checkout:order_detail', args=[order.order_number])
+        scheme = 'http' if settings.DEBUG else 'https'
+        order_detail_url = (
+            f'{scheme}://{Site.objects.get_current().domain}'
+            f'{reverse("checkout:order_detail", args=[order.order_number])}'
         )
+        context = {
+            'order': order,
+            'order_detail_url': order_detail_url,
+            'user': order.user_profile.user if order.user_profile else None,
+        }
 
         # Send confirmation email
-        subject = f"Order Confirmation - {order.order_number}"
+        subject = render_to_string(
+            'checkout/confirmation_emails/confirmation_email_subject.txt',
+            context,
+        ).strip()
         message = render_to_string(
-            'checkout/emails/order_confirmation_email.html',
-            {'order': order, 'order_detail_url': order_detail_url}
+            'checkout/confirmation_emails/confirmation_email_body.txt',
+            context,
         )
 
         send_mail(
@@ -41,6 +77,27 @@ class StripeWH_Handler:
             [cust_email],
         )
 
+    def _latest_charge(self, intent):
+        """
+        Return the intent's latest charge, from the event when it was
+        expanded there and from Stripe otherwise
+        """
+        charge = intent.latest_charge
+        if isinstance(charge, str):
+            charge = get_stripe_gateway().retrieve_charge(charge)
+        return charge
+
+    def _check_amount(self, intent, order):
+        """
+        Log a payment whose amount differs from its order's total
+        """
+        if intent.amount_received != to_pence(order.grand_total):
+            logger.warning(
+                'Payment %s received %s pence for order %s, which totals '
+                '%s pence', intent.id, intent.amount_received,
+                order.order_number, to_pence(order.grand_total),
+            )
+
     def handle_event(self, event):
         """
         Handle a generic/unknown/unexpected webhook event
@@ -59,22 +116,25 @@ class StripeWH_Handler:
         bag = intent.metadata.bag
         save_info = intent.metadata.save_info
 
-        # Get the Charge object
-        stripe_charge = stripe.Charge.retrieve(
-            intent.latest_charge
-        )
+        # The unique index on stripe_pid makes this a single indexed
+        # lookup, with the bag compared by its stored hash
+        order = Order.objects.filter(
+            stripe_pid=pid, original_bag_hash=hash_bag(bag)
+        ).first()
+        if order is None and self.wait_for_checkout:
+            raise RetryLater('Waiting for the checkout to make the order')
 
-        billing_details = stripe_charge.billing_details  # updated
         shipping_details = intent.shipping
-        grand_total = round(stripe_charge.amount / 100, 2)  # updated
-
         email = (getattr(shipping_details, 'email', None) or
                  intent.receipt_email or
-                 billing_details.email
-                 )
-        phone = (getattr(shipping_details, 'phone', None) or
-                 billing_details.phone
+                 intent.metadata.get('email')
                  )
+        phone = getattr(shipping_details, 'phone', None)
+        if not (email and phone):
+            # Only the charge has the billing details
+            billing_details = self._latest_charge(intent).billing_details
+            email = email or billing_details.email
+            phone = phone or billing_details.phone
 
         # Clean data in the shipping details
         for field, value in shipping_details.address.items():
@@ -115,30 +175,8 @@ class StripeWH_Handler:
                 county=shipping_details.address.state,
             )
 
-        order_exists = False
-        attempt = 1
-        while attempt <= 5:
-            try:
-                order = Order.objects.get(
-                    full_name__iexact=shipping_details.name,
-                    email__iexact=email,
-                    phone_number__iexact=phone,
-                    country__iexact=shipping_details.address.country,
-                    postcode__iexact=shipping_details.address.postal_code,
-                    town_or_city__iexact=shipping_details.address.city,
-                    street_address1__iexact=shipping_details.address.line1,
-                    street_address2__iexact=shipping_details.address.line2,
-                    county__iexact=shipping_details.address.state,
-                    grand_total=grand_total,
-                    original_bag=bag,
-                    stripe_pid=pid,
-                )
-                order_exists = True
-                break
-            except Order.DoesNotExist:
-                attempt += 1
-                time.sleep(1)
-        if order_exists:
+        if order is not None:
+            self._check_amount(intent, order)
             self._send_confirmation_email(order)
             return HttpResponse(
                 content=f'Webhook received: {event['type']} | '
@@ -146,54 +184,46 @@ class StripeWH_Handler:
                 status=200,
             )
         else:
-            order = None
             try:
-                order = Order.objects.create(
-                            user_profile=user_profile,
-                            full_name=shipping_details.name,
-                            email=email,
-                            phone_number=phone,
-                            country=shipping_details.address.country,
-                            postcode=(
-                                shipping_details.address.postal_code
-                                ),
-                            town_or_city=shipping_details.address.city,
-                            street_address1=(
-                                shipping_details.address.line1
-                                ),
-                            street_address2=(
-                                shipping_details.address.line2
-                                ),
-                            county=shipping_details.address.state,
-                            grand_total=grand_total,
-                            original_bag=bag,
-                            stripe_pid=pid,
-                        )
-                for item_id, item_data in json.loads(bag).items():
-                    product = Product.objects.get(id=item_id)
-                    if isinstance(item_data, int):
-                        OrderLineItem.objects.create(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                    else:
-                        for size, quantity in (
-                            item_data['items_by_size'].items()
-                        ):
-                            OrderLineItem.objects.create(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
+                order = build_order(
+                    Order(
+                        user_profile=user_profile,
+                        full_name=shipping_details.name,
+                        email=email,
+                        phone_number=phone,
+                        country=shipping_details.address.country,
+                        postcode=shipping_details.address.postal_code,
+                        town_or_city=shipping_details.address.city,
+                        street_address1=shipping_details.address.line1,
+                        street_address2=shipping_details.address.line2,
+                        county=shipping_details.address.state,
+                        original_bag=bag,
+                        stripe_pid=pid,
+                    ),
+                    json.loads(bag),
+                )
+            except IntegrityError as e:
+                # The checkout view made the order for this payment while
+                # we were making ours
+                order = Order.objects.filter(stripe_pid=pid).first()
+                if order is None:
+                    return HttpResponse(content='Webhook received:  '
+                                        f'{event["type"]} | ERROR: {e}',
+                                        status=500,
+                                        )
+                self._check_amount(intent, order)
+                self._send_confirmation_email(order)
+                return HttpResponse(
+                    content=f'Webhook received: {event["type"]} | '
+                    'SUCCESS: Verified order already in database',
+                    status=200,
+                )
             except Exception as e:
-                if order:
-                    order.delete()
                 return HttpResponse(content='Webhook received:  '
                                     f'{event["type"]} | ERROR: {e}',
                                     status=500,
                                     )
+        self._check_amount(intent, order)
         self._send_confirmation_email(order)
         return HttpResponse(
             content=f'Webhook received: {event["type"]} | '
@@ -0,0 +1,133 @@
+"""
+The queue of Stripe webhook events between the webhook view and the
+process_webhooks worker.
+
+The view only verifies an event and stores it, so Stripe gets its
+answer straight away. Workers claim due events with a conditional
+update, which also gives them a lease: an event whose worker died is
+picked up again once the lease runs out. A failed event is retried with
+exponential backoff until it has used up its attempts. An event that is
+waiting for the checkout view to make its order is retried shortly,
+without counting as a failure.
+"""
+import random
+import time
+from datetime import timedelta
+import stripe
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+from .models import WebhookEvent
+from .webhook_handler import RetryLater, StripeWH_Handler
+
+WEBHOOK_MAX_ATTEMPTS = getattr(settings, 'WEBHOOK_MAX_ATTEMPTS', 8)
+WEBHOOK_RETRY_BASE = getattr(settings, 'WEBHOOK_RETRY_BASE', 2)
+WEBHOOK_RETRY_MAX = getattr(settings, 'WEBHOOK_RETRY_MAX', 60 * 60)
+# How long to give the checkout view to make an order itself
+CHECKOUT_GRACE = timedelta(seconds=10)
+CHECKOUT_RETRY = timedelta(seconds=2)
+LEASE = timedelta(minutes=5)
+
+
+def enqueue_event(payload):
+    """
+    Store the decoded body of a verified event for the worker, once
+    however often Stripe delivers it. Returns whether it was new.
+    """
+    webhook_event, created = WebhookEvent.objects.get_or_create(
+        event_id=payload['id'],
+        defaults={'type': payload['type'], 'payload': payload},
+    )
+    return created
+
+
+def retry_delay(attempts):
+    """
+    Return how long to wait before trying a failed event again
+    """
+    delay = min(WEBHOOK_RETRY_BASE * 2 ** (attempts - 1), WEBHOOK_RETRY_MAX)
+    # Jitter spreads out retries of events that failed together
+    return timedelta(seconds=delay * random.uniform(0.5, 1))
+
+
+def claim_events(limit):
+    """
+    Claim up to limit due events for this worker and return them
+    """
+    now = timezone.now()
+    due = WebhookEvent.objects.filter(
+        status__in=[WebhookEvent.PENDING, WebhookEvent.PROCESSING],
+        next_attempt_at__lte=now,
+    )
+    claimed = []
+    for pk in due.order_by('next_attempt_at').values_list('pk', flat=True)[
+        :limit
+    ]:
+        # Only one worker's update can match while the event is due
+        if due.filter(pk=pk).update(
+            status=WebhookEvent.PROCESSING,
+            next_attempt_at=now + LEASE,
+            attempts=F('attempts') + 1,
+        ):
+            claimed.append(pk)
+    return list(WebhookEvent.objects.filter(pk__in=claimed))
+
+
+def process_event(webhook_event):
+    """
+    Handle a claimed event and record the outcome, which is returned as
+    'done', 'deferred', 'retry' or 'failed'
+    """
+    received_at = webhook_event.received_at
+    handler = StripeWH_Handler(
+        wait_for_checkout=timezone.now() - received_at < CHECKOUT_GRACE
+    )
+    event = stripe.Event.construct_from(
+        webhook_event.payload, settings.STRIPE_SECRET_KEY
+    )
+    started = time.perf_counter()
+    try:
+        response = handler.handle(event)
+        if response.status_code >= 500:
+            raise RuntimeError(response.content.decode())
+    except RetryLater as e:
+        outcome = 'deferred'
+        # Waiting for the checkout is not a failure
+        webhook_event.attempts -= 1
+        webhook_event.status = WebhookEvent.PENDING
+        webhook_event.next_attempt_at = timezone.now() + CHECKOUT_RETRY
+        webhook_event.last_error = str(e)
+    except Exception as e:
+        if webhook_event.attempts >= WEBHOOK_MAX_ATTEMPTS:
+            outcome = 'failed'
+            webhook_event.status = WebhookEvent.FAILED
+        else:
+            outcome = 'retry'
+            webhook_event.status = WebhookEvent.PENDING
+            webhook_event.next_attempt_at = (
+                timezone.now() + retry_delay(webhook_event.attempts)
+            )
+        webhook_event.last_error = f'{type(e).__name__}: {e}'
+    else:
+        outcome = 'done'
+        webhook_event.status = WebhookEvent.DONE
+        webhook_event.processed_at = timezone.now()
+        webhook_event.last_error = ''
+    webhook_event.handling_ms = (time.perf_counter() - started) * 1000
+    webhook_event.save(update_fields=[
+        'status', 'attempts', 'next_attempt_at', 'processed_at',
+        'handling_ms', 'last_error',
+    ])
+    return outcome
+
+
+def process_event_in_thread(webhook_event):
+    """
+    Process an event from a worker thread, closing the thread's
+    database connection afterwards
+    """
+    try:
+        return process_event(webhook_event)
+    finally:
+        connection.close()
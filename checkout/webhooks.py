@@ -4,7 +4,9 @@ from django.conf import settings
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
+from .stripe_client import get_stripe_gateway
 from .webhook_handler import StripeWH_Handler
+from .webhook_queue import enqueue_event
 
 
 @require_POST
@@ -12,11 +14,10 @@ from .webhook_handler import StripeWH_Handler
 def stripe_webhook(request):
     """
     Stripe webhook endpoint.
-    Verifies signature, parses the event, and dispatches to a handler class.
+    Verifies signature, then queues the event for the process_webhooks
+    worker and answers at once, so a burst of events never ties up the
+    site's workers.
     """
-    # Set Stripe secret key (used if you make API calls in handlers)
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-
     # Get raw body and signature header
     payload = request.body
     sig_header = request.META.get("HTTP_STRIPE_SIGNATURE", "")
@@ -24,7 +25,7 @@ def stripe_webhook(request):
 
     try:
         # Verify event signature & construct event
-        event = stripe.Webhook.construct_event(
+        event = get_stripe_gateway().construct_event(
             payload=payload,
             sig_header=sig_header,
             secret=webhook_secret,
@@ -32,26 +33,26 @@ def stripe_webhook(request):
     except ValueError:
         # Invalid payload (not valid JSON)
         return HttpResponseBadRequest("Invalid payload")
-    except stripe.error.SignatureVerificationError:
+    except stripe.SignatureVerificationError:
         # Invalid signature
         return HttpResponseBadRequest("Invalid signature")
     except Exception as e:
         return HttpResponse(status=400, content=str(e))
 
-    # Create webhook handler instance
-    handler = StripeWH_Handler(request)
-
-    # Map event types to handler methods
-    event_map = {
-        "payment_intent.succeeded": handler.handle_payment_intent_succeeded,
-        "payment_intent.payment_failed": handler.handle_payment_intent_failed,
-    }
-
-    # Get handler from map or use default
-    event_type = event["type"]
-    event_handler = event_map.get(event_type, handler.handle_event)
-
-    # Call the handler
-    response = event_handler(event)
+    # Events nothing handles are acknowledged without being stored
+    if event['type'] not in StripeWH_Handler.EVENT_METHODS:
+        return HttpResponse(
+            content=f'Unhandled webhook received: {event["type"]}',
+            status=200,
+        )
 
-    return response or HttpResponse(status=200)
+    # The verified body is stored as Stripe sent it
+    if enqueue_event(json.loads(payload)):
+        return HttpResponse(
+            content=f'Webhook received: {event["type"]} | Queued',
+            status=200,
+        )
+    return HttpResponse(
+        content=f'Webhook received: {event["type"]} | Already queued',
+        status=200,
+    )
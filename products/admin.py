@@ -1,4 +1,5 @@
 from django.contrib import admin
+from .exports import product_export
 from .models import Product, Category
 
 
@@ -13,7 +14,12 @@ class ProductAdmin(admin.ModelAdmin):
         'image',
     )
 
+    list_select_related = ('category',)
     ordering = ('sku',)
+    actions = [
+        product_export.action('csv'),
+        product_export.action('ndjson'),
+    ]
 
 
 class CategoryAdmin(admin.ModelAdmin):
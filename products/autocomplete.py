@@ -0,0 +1,211 @@
+"""
+Search box suggestions from an in-process prefix index.
+
+Every word suffix of every product name and category name ("bootcut
+jeans", "jeans") is kept in one sorted array, so the names matching a
+typed prefix sit in a contiguous run found by bisection. Names are
+numbered by popularity, units sold for products and for the products in
+a category, so the best matches are the lowest numbers in that run.
+Answers for prefixes with long runs are worked out when the index is
+built, so no lookup reads more than a few hundred keys.
+
+Each worker keeps one index and rebuilds it when the catalogue version
+changes, or when it is old enough for sales to have moved the ranking.
+"""
+import heapq
+import re
+import threading
+import time
+from bisect import bisect_left
+from django.conf import settings
+from django.db.models import Sum
+from django.urls import reverse
+from urllib.parse import urlencode
+from .catalogue import get_catalogue_version
+from .models import Category, Product
+
+AUTOCOMPLETE_LIMIT = 8
+AUTOCOMPLETE_MAX_LIMIT = 20
+AUTOCOMPLETE_TTL = getattr(settings, 'AUTOCOMPLETE_TTL', 15 * 60)
+# Prefixes matching more keys than this have their results precomputed
+PRECOMPUTED_RUN = 256
+
+_WORDS = re.compile(r'\w+')
+
+
+def normalise(text):
+    """
+    Lower case the text and reduce it to words separated by single spaces
+    """
+    return ' '.join(_WORDS.findall(text.casefold()))
+
+
+class PrefixIndex:
+    """
+    Matches prefixes against the start of any word of a set of
+    (label, value) entries. Entries must be given most popular first.
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        suffixes = []
+        for rank, (label, value) in enumerate(entries):
+            words = normalise(label).split(' ')
+            for start in range(len(words)):
+                suffix = ' '.join(words[start:])
+                if suffix:
+                    suffixes.append((suffix, rank))
+        suffixes.sort()
+        self.keys = [key for key, rank in suffixes]
+        self.ranks = [rank for key, rank in suffixes]
+
+        self.precomputed = {}
+        self._precompute(0, len(self.keys), 1)
+
+    def _precompute(self, start, end, length):
+        """
+        Store the answers for prefixes of the given length with long
+        runs between start and end, then look for longer ones within them
+        """
+        position = start
+        while position < end:
+            prefix = self.keys[position][:length]
+            if len(prefix) < length:
+                # A key shorter than the prefix sorts before the longer
+                # keys sharing its start
+                position += 1
+                continue
+            run_end = self._end(prefix, position)
+            if run_end - position > PRECOMPUTED_RUN:
+                self.precomputed[prefix] = self._best(
+                    position, run_end, AUTOCOMPLETE_MAX_LIMIT
+                )
+                self._precompute(position, run_end, length + 1)
+            position = run_end
+
+    def _end(self, prefix, start):
+        """
+        Return the index just past the run of keys starting with prefix
+        """
+        # Every key with the prefix sorts before the prefix followed by
+        # the highest code point
+        return bisect_left(self.keys, prefix + '\U0010ffff', start)
+
+    def _best(self, start, end, limit):
+        return heapq.nsmallest(limit, set(self.ranks[start:end]))
+
+    def search(self, query, limit=AUTOCOMPLETE_LIMIT):
+        """
+        Return up to limit entries matching the query
+        """
+        prefix = normalise(query)
+        if not prefix:
+            return []
+        if prefix in self.precomputed:
+            ranks = self.precomputed[prefix][:limit]
+        else:
+            start = bisect_left(self.keys, prefix)
+            ranks = self._best(start, self._end(prefix, start), limit)
+        return [self.entries[rank] for rank in ranks]
+
+
+class Autocomplete:
+    """
+    The product and category indexes for one catalogue version
+    """
+    def __init__(self, version, products, categories):
+        self.version = version
+        self.built_at = time.monotonic()
+        self.products = PrefixIndex(products)
+        self.categories = PrefixIndex(categories)
+
+    def suggest(self, query, limit=AUTOCOMPLETE_LIMIT):
+        """
+        Return the best product and category matches with their links
+        """
+        listing_url = reverse('products:products')
+        return {
+            'products': [
+                {
+                    'label': label,
+                    'url': reverse('products:product_detail', args=[pk]),
+                }
+                for label, pk in self.products.search(query, limit)
+            ],
+            'categories': [
+                {
+                    'label': label,
+                    'url': f'{listing_url}?{urlencode({"category": name})}',
+                }
+                for label, name in self.categories.search(query, limit)
+            ],
+        }
+
+
+def build_autocomplete(version=None):
+    """
+    Load product and category names ranked by units sold
+    """
+    if version is None:
+        version = get_catalogue_version()
+    sales = dict(
+        Product.objects.filter(orderlineitem__isnull=False)
+        .values('pk')
+        .annotate(sold=Sum('orderlineitem__quantity'))
+        .values_list('pk', 'sold')
+    )
+
+    products = []
+    category_sales = {}
+    rows = Product.objects.values_list('pk', 'name', 'category_id')
+    for pk, name, category_id in rows.iterator(chunk_size=2000):
+        sold = sales.get(pk, 0)
+        products.append((-sold, name.casefold(), pk, name))
+        if category_id:
+            category_sales[category_id] = (
+                category_sales.get(category_id, 0) + sold
+            )
+    products.sort()
+
+    categories = sorted(
+        (
+            -category_sales.get(category.pk, 0),
+            (category.friendly_name or category.name).casefold(),
+            category.friendly_name or category.name,
+            category.name,
+        )
+        for category in Category.objects.all()
+    )
+    return Autocomplete(
+        version,
+        [(name, pk) for sold, key, pk, name in products],
+        [(label, name) for sold, key, label, name in categories],
+    )
+
+
+_autocomplete = None
+_autocomplete_lock = threading.Lock()
+
+
+def get_autocomplete():
+    """
+    Return this worker's index, rebuilding it if the catalogue changed
+    or it has expired. While one thread rebuilds, the others keep using
+    the old index.
+    """
+    global _autocomplete
+    version = get_catalogue_version()
+    index = _autocomplete
+    if (
+        index is not None and index.version == version
+        and time.monotonic() - index.built_at < AUTOCOMPLETE_TTL
+    ):
+        return index
+
+    if _autocomplete_lock.acquire(blocking=index is None):
+        try:
+            if _autocomplete is index:
+                _autocomplete = build_autocomplete(version)
+            index = _autocomplete
+        finally:
+            _autocomplete_lock.release()
+    return index
@@ -0,0 +1,142 @@
+"""
+Catalogue versioning and the listing cache.
+
+Every Product or Category change bumps the catalogue version, and every
+cached listing is keyed on it, so stale entries are never read again and
+simply expire.
+
+The price version works the same way for cached bag summaries, but only
+moves when a product's price or another detail shown in the bag changes,
+or a product is deleted, so ordinary catalogue edits leave bags cached.
+"""
+import hashlib
+import json
+import time
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils import timezone
+from .models import Category, Product
+
+CATALOGUE_VERSION_KEY = 'catalogue:version'
+CATALOGUE_MODIFIED_KEY = 'catalogue:modified'
+PRICE_VERSION_KEY = 'catalogue:price_version'
+# The product fields a bag summary shows
+PRICE_VERSION_FIELDS = ('name', 'sku', 'price', 'has_sizes', 'image')
+LISTING_CACHE_TIMEOUT = 60 * 60
+LOCK_TIMEOUT = 10
+LOCK_POLL_INTERVAL = 0.05
+
+
+# The last version of each key this process saw
+_seen_versions = {}
+
+
+def _seen(key, version):
+    _seen_versions[key] = max(version, _seen_versions.get(key, 0))
+    return version
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Seed a lost key from the clock in microseconds, and above any
+        # version this process has seen, so it moves forward unless
+        # another process saw versions further ahead than the clock
+        seed = max(time.time_ns() // 1000, _seen_versions.get(key, 0) + 1)
+        cache.add(key, seed, None)
+        version = cache.get(key)
+    return _seen(key, version)
+
+
+def _bump_version(key):
+    try:
+        return _seen(key, cache.incr(key))
+    except ValueError:
+        _get_version(key)
+        return _seen(key, cache.incr(key))
+
+
+def get_catalogue_version():
+    """
+    Return the current catalogue version, starting one if none is cached
+    """
+    return _get_version(CATALOGUE_VERSION_KEY)
+
+
+def bump_catalogue_version():
+    """
+    Invalidate everything cached against the current catalogue
+    """
+    cache.set(CATALOGUE_MODIFIED_KEY, timezone.now(), None)
+    return _bump_version(CATALOGUE_VERSION_KEY)
+
+
+def get_price_version():
+    """
+    Return the current price version, starting one if none is cached
+    """
+    return _get_version(PRICE_VERSION_KEY)
+
+
+def bump_price_version():
+    """
+    Invalidate every cached bag summary
+    """
+    return _bump_version(PRICE_VERSION_KEY)
+
+
+def get_catalogue_modified():
+    """
+    Return when the catalogue last changed, reading it from the
+    products and categories if the cached timestamp has been lost
+    """
+    modified = cache.get(CATALOGUE_MODIFIED_KEY)
+    if modified is None:
+        timestamps = [
+            model.objects.aggregate(latest=Max('updated_at'))['latest']
+            for model in (Product, Category)
+        ]
+        modified = max(
+            (timestamp for timestamp in timestamps if timestamp),
+            default=timezone.now(),
+        )
+        cache.add(CATALOGUE_MODIFIED_KEY, modified, None)
+    return modified
+
+
+def catalogue_cache_key(prefix, params):
+    """
+    Build a cache key for the given parameters under the current version
+    """
+    digest = hashlib.md5(
+        json.dumps(params, sort_keys=True).encode()
+    ).hexdigest()
+    return f'{prefix}:{get_catalogue_version()}:{digest}'
+
+
+def get_or_compute(key, compute, timeout=LISTING_CACHE_TIMEOUT):
+    """
+    Return the cached value for key, computing it if it is missing.
+    Only the caller holding the lock computes a cold key; everyone else
+    waits for its result rather than repeating the same queries.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            value = compute()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        value = cache.get(key)
+        if value is not None:
+            return value
+    return compute()
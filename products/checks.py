@@ -0,0 +1,30 @@
+"""
+System checks for the settings the catalogue cache relies on.
+"""
+from django.conf import settings
+from django.core.checks import Error, register
+
+# Caches that keep their entries inside one process
+PER_PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Refuse a default cache that other processes cannot see, since the
+    catalogue and price versions kept in it would then differ between
+    workers
+    """
+    backend = settings.CACHES['default']['BACKEND']
+    if backend in PER_PROCESS_CACHES:
+        return [Error(
+            f'The default cache ({backend}) is not shared between '
+            'processes, so catalogue and price changes would not reach '
+            'every worker.',
+            hint='Set REDIS_URL or use the DatabaseCache.',
+            id='products.E001',
+        )]
+    return []
@@ -0,0 +1,86 @@
+"""
+Conditional GET support for the catalogue pages.
+
+Catalogue pages are identified by the release, the catalogue version
+and the request URL, plus everything about the visitor that the page
+renders: the bag badge and the signed in user. A matching If-None-Match or
+If-Modified-Since header is then answered with a 304 before the page is
+rendered. A cached page's CSRF token stays valid, because it was issued
+with the cookie the browser still holds. Pages with queued messages are always
+rendered in full, since the messages are shown only once.
+"""
+import hashlib
+import json
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.utils import timezone
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from bag.storage import get_bag_storage
+from .catalogue import get_catalogue_modified, get_catalogue_version
+
+# Pages from before this process started may come from other code
+STARTED_AT = timezone.now()
+RELEASE = (
+    getattr(settings, 'RELEASE_VERSION', '') or STARTED_AT.isoformat()
+)
+
+
+def _has_messages(request):
+    # len() looks at the queued messages without marking them as seen
+    return bool(len(get_messages(request)))
+
+
+def _visitor_state(request):
+    """
+    The parts of the page that depend on who is asking
+    """
+    if not hasattr(request, '_catalogue_visitor_state'):
+        user = request.user
+        request._catalogue_visitor_state = {
+            'bag': get_bag_storage(request).bag,
+            'user': user.pk if user.is_authenticated else None,
+            'superuser': user.is_superuser,
+        }
+    return request._catalogue_visitor_state
+
+
+def catalogue_etag(request, *args, **kwargs):
+    """
+    Build a strong ETag for a catalogue page
+    """
+    if _has_messages(request):
+        return None
+    state = {
+        'release': RELEASE,
+        'catalogue': get_catalogue_version(),
+        'url': request.get_full_path(),
+        'visitor': _visitor_state(request),
+    }
+    return hashlib.sha256(
+        json.dumps(state, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def catalogue_last_modified(request, *args, **kwargs):
+    """
+    Return when the catalogue or the code last changed, but only for
+    anonymous visitors with an empty bag, as otherwise the page depends
+    on more than the catalogue
+    """
+    state = _visitor_state(request)
+    if _has_messages(request) or state['user'] or state['bag']:
+        return None
+    return max(get_catalogue_modified(), STARTED_AT)
+
+
+def catalogue_conditional(view):
+    """
+    Decorate a catalogue view with ETag and Last-Modified handling.
+    Browsers must revalidate every time, which is cheap when nothing
+    has changed.
+    """
+    return cache_control(private=True, no_cache=True)(condition(
+        etag_func=catalogue_etag,
+        last_modified_func=catalogue_last_modified,
+    )(view))
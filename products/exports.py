@@ -0,0 +1,23 @@
+from boutique_ado.exports import Export
+
+# Matches the flat records import_products reads, so exports round trip
+PRODUCT_FIELDS = (
+    'sku', 'name', 'description', 'category', 'price', 'rating',
+    'has_sizes', 'image_url', 'image',
+)
+
+
+class ProductExport(Export):
+    name = 'products'
+    header = PRODUCT_FIELDS
+
+    def records(self, queryset, chunk_size):
+        rows = queryset.order_by('pk').values_list(
+            'sku', 'name', 'description', 'category__name', 'price',
+            'rating', 'has_sizes', 'image_url', 'image',
+        )
+        for row in rows.iterator(chunk_size=chunk_size):
+            yield dict(zip(PRODUCT_FIELDS, row))
+
+
+product_export = ProductExport()
@@ -0,0 +1,163 @@
+"""
+Faceted navigation for the product listing.
+
+One GROUP BY query counts the products in every combination of
+category, price bucket and rating bucket for the current search. Each
+facet's counts are then summed from that result in Python, applying
+every active filter except the facet's own, so shoppers can see what
+switching to another category or bucket would give them. The grouped
+counts are cached under the catalogue version like the listings.
+"""
+from collections import Counter
+from django.db.models import Case, CharField, Count, Q, Value, When
+from .catalogue import catalogue_cache_key, get_or_compute
+from .models import Product
+from .search import filter_search
+
+# key, label, lower bound (inclusive), upper bound (exclusive)
+PRICE_BUCKETS = (
+    ('under-25', 'Under £25', None, 25),
+    ('25-50', '£25 to £50', 25, 50),
+    ('50-100', '£50 to £100', 50, 100),
+    ('100-plus', '£100 and over', 100, None),
+)
+RATING_BUCKETS = (
+    ('4-plus', '4 stars and up', 4, None),
+    ('3-4', '3 to 4 stars', 3, 4),
+    ('under-3', 'Under 3 stars', None, 3),
+)
+UNRATED = ('unrated', 'No rating')
+
+PRICE_BUCKET_MAP = {bucket[0]: bucket for bucket in PRICE_BUCKETS}
+RATING_BUCKET_MAP = {bucket[0]: bucket for bucket in RATING_BUCKETS}
+RATING_KEYS = set(RATING_BUCKET_MAP) | {UNRATED[0]}
+
+
+def _range_filter(field, low, high):
+    condition = Q()
+    if low is not None:
+        condition &= Q(**{f'{field}__gte': low})
+    if high is not None:
+        condition &= Q(**{f'{field}__lt': high})
+    return condition
+
+
+def price_filter(key):
+    """
+    Return the filter for a price bucket key
+    """
+    key, label, low, high = PRICE_BUCKET_MAP[key]
+    return _range_filter('price', low, high)
+
+
+def rating_filter(key):
+    """
+    Return the filter for a rating bucket key
+    """
+    if key == UNRATED[0]:
+        return Q(rating__isnull=True)
+    key, label, low, high = RATING_BUCKET_MAP[key]
+    return _range_filter('rating', low, high)
+
+
+def _bucket_case(buckets, field, null_bucket=None):
+    whens = [
+        When(_range_filter(field, low, high), then=Value(key))
+        for key, label, low, high in buckets
+    ]
+    if null_bucket:
+        whens.insert(0, When(
+            **{f'{field}__isnull': True}, then=Value(null_bucket)
+        ))
+    return Case(*whens, output_field=CharField())
+
+
+def build_facet_counts(query=None):
+    """
+    Count products per (category, price bucket, rating bucket)
+    in a single grouped query
+    """
+    products = Product.objects.all()
+    if query:
+        products = filter_search(products, query)
+    rows = (
+        products.order_by()
+        .annotate(
+            price_bucket=_bucket_case(PRICE_BUCKETS, 'price'),
+            rating_bucket=_bucket_case(RATING_BUCKETS, 'rating', UNRATED[0]),
+        )
+        .values(
+            'category__name', 'category__friendly_name',
+            'price_bucket', 'rating_bucket',
+        )
+        .annotate(count=Count('pk'))
+    )
+    return [
+        (
+            row['category__name'], row['category__friendly_name'],
+            row['price_bucket'], row['rating_bucket'], row['count'],
+        )
+        for row in rows
+    ]
+
+
+def get_facets(params):
+    """
+    Return the category, price and rating facets for normalised
+    listing parameters
+    """
+    counts = get_or_compute(
+        catalogue_cache_key('products:facets', {'q': params['q']}),
+        lambda: build_facet_counts(params['q']),
+    )
+    categories = params['categories']
+    price = params['price']
+    rating = params['rating']
+
+    category_counts = Counter()
+    friendly_names = {}
+    price_counts = Counter()
+    rating_counts = Counter()
+    for category, friendly_name, price_bucket, rating_bucket, count in counts:
+        in_category = not categories or category in categories
+        in_price = not price or price_bucket == price
+        in_rating = not rating or rating_bucket == rating
+        if category and in_price and in_rating:
+            category_counts[category] += count
+            friendly_names[category] = friendly_name or category
+        if in_category and in_rating:
+            price_counts[price_bucket] += count
+        if in_category and in_price:
+            rating_counts[rating_bucket] += count
+
+    return {
+        'category': [
+            {
+                'key': name,
+                'label': friendly_names[name],
+                'count': category_counts[name],
+                'active': bool(categories) and name in categories,
+            }
+            for name in sorted(category_counts, key=friendly_names.get)
+        ],
+        'price': [
+            {
+                'key': key,
+                'label': label,
+                'count': price_counts[key],
+                'active': key == price,
+            }
+            for key, label, low, high in PRICE_BUCKETS
+        ],
+        'rating': [
+            {
+                'key': key,
+                'label': label,
+                'count': rating_counts[key],
+                'active': key == rating,
+            }
+            for key, label in [
+                bucket[:2] for bucket in RATING_BUCKETS
+            ] + [UNRATED]
+        ],
+    }
@@ -1,5 +1,6 @@
 # products/forms.py
 from django import forms
+from .images import update_derivatives
 from .widgets import CustomClearableFileInput
 from .models import Product, Category
 
@@ -22,3 +23,10 @@ class ProductForm(forms.ModelForm):
         self.fields['category'].choices = friendly_names
         for field_name, field in self.fields.items():
             field.widget.attrs['class'] = 'border-black rounded-0'
+
+    def save(self, commit=True):
+        product = super().save(commit)
+        # Derivatives need the saved image, so are only made on commit
+        if commit and 'image' in self.changed_data:
+            update_derivatives(product)
+        return product
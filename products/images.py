@@ -0,0 +1,161 @@
+"""
+Resized derivatives of product images.
+
+Each product image is rendered at a fixed set of widths in WebP and JPEG.
+The files are named after a hash of their content and saved through the
+default storage, so they can be cached forever, and their names are
+recorded on the product for the templates to build a srcset from.
+
+Rendering only needs the source bytes, so it can run in worker processes
+for bulk backfills, while storage writes stay in the calling process.
+"""
+import hashlib
+import io
+from pathlib import PurePosixPath
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+from .catalogue import bump_catalogue_version
+
+DERIVATIVES_PATH = 'derivatives'
+
+# name, width in pixels
+DERIVATIVE_SIZES = (
+    ('thumb', 150),
+    ('card', 400),
+    ('detail', 800),
+    ('detail_2x', 1600),
+)
+
+# extension, Pillow format, save options
+DERIVATIVE_FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpeg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+
+def _flatten(image):
+    """
+    Return the image in RGB, laying any transparency over white
+    """
+    if image.mode == 'RGB':
+        return image
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def render_derivatives(data):
+    """
+    Render every derivative of an image from its bytes.
+    Images are never enlarged, so sizes wider than the source share
+    one rendering at the source width.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        image = _flatten(ImageOps.exif_transpose(source))
+    source_width, source_height = image.size
+
+    sizes = {}
+    files = {}
+    for size, width in DERIVATIVE_SIZES:
+        width = min(width, source_width)
+        height = max(round(source_height * width / source_width), 1)
+        sizes[size] = (width, height)
+        if any(key[0] == width for key in files):
+            continue
+        resized = image
+        if width != source_width:
+            resized = image.resize((width, height), Image.LANCZOS)
+        for extension, image_format, options in DERIVATIVE_FORMATS:
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format, **options)
+            files[(width, extension)] = buffer.getvalue()
+
+    return {
+        'width': source_width,
+        'height': source_height,
+        'sizes': sizes,
+        'files': files,
+    }
+
+
+def store_derivatives(source_name, rendered, storage=None):
+    """
+    Save rendered derivatives under content hashed names and return the
+    description of them to keep on the product
+    """
+    storage = storage or default_storage
+    stem = PurePosixPath(source_name).stem
+    names = {}
+    for (width, extension), data in rendered['files'].items():
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        name = f'{DERIVATIVES_PATH}/{stem}-{width}w-{digest}.{extension}'
+        # The same name always holds the same bytes
+        if not storage.exists(name):
+            name = storage.save(name, ContentFile(data))
+        names[(width, extension)] = name
+
+    return {
+        'source': source_name,
+        'width': rendered['width'],
+        'height': rendered['height'],
+        'variants': {
+            size: {
+                'width': width,
+                'height': height,
+                **{
+                    extension: names[(width, extension)]
+                    for extension, image_format, options in DERIVATIVE_FORMATS
+                },
+            }
+            for size, (width, height) in rendered['sizes'].items()
+        },
+    }
+
+
+def read_source(product, storage=None):
+    """
+    Return the bytes of a product's image
+    """
+    storage = storage or default_storage
+    with storage.open(product.image.name, 'rb') as image_file:
+        return image_file.read()
+
+
+def update_derivatives(product):
+    """
+    Regenerate the derivatives of one product's current image,
+    clearing them if it no longer has one
+    """
+    derivatives = {}
+    if product.image:
+        derivatives = store_derivatives(
+            product.image.name, render_derivatives(read_source(product))
+        )
+    product.image_derivatives = derivatives
+    product._meta.model.objects.filter(pk=product.pk).update(
+        image_derivatives=derivatives, updated_at=timezone.now()
+    )
+    # The update skips the signals, and pages cached since the product
+    # was saved still show its old derivatives
+    transaction.on_commit(bump_catalogue_version)
+    return derivatives
+
+
+def current_derivatives(product):
+    """
+    Return the product's derivatives if they were made from its
+    current image
+    """
+    derivatives = product.image_derivatives
+    if (
+        product.image and derivatives
+        and derivatives.get('source') == product.image.name
+    ):
+        return derivatives
+    return None
@@ -0,0 +1,288 @@
+"""
+Streaming catalogue imports.
+
+Supplier feeds arrive as a JSON array (including Django fixtures),
+newline delimited JSON or CSV. Each is read a record at a time so memory
+use does not grow with the size of the feed, and products are upserted
+by SKU a batch at a time, each batch in its own transaction.
+"""
+import csv
+import json
+import re
+from decimal import Decimal, InvalidOperation
+from django.db import transaction
+from .models import Category, Product
+from .search import index_products
+
+FORMATS = ('json', 'ndjson', 'csv')
+EXTENSIONS = {
+    '.json': 'json',
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+    '.csv': 'csv',
+}
+READ_SIZE = 64 * 1024
+
+# Everything but the SKU is overwritten when a product already exists
+UPDATE_FIELDS = [
+    'category', 'name', 'description', 'has_sizes', 'price', 'rating',
+    'image_url', 'image', 'updated_at',
+]
+
+_WHITESPACE = re.compile(r'\s*')
+_TRUE = {'1', 'true', 'yes', 'y', 't'}
+
+
+class ImportFormatError(ValueError):
+    """
+    Raised when a feed cannot be parsed at all
+    """
+
+
+def format_for(path):
+    """
+    Guess a feed's format from its file extension
+    """
+    for extension, feed_format in EXTENSIONS.items():
+        if path.lower().endswith(extension):
+            return feed_format
+    return None
+
+
+def read_json_array(stream):
+    """
+    Yield each item of a top level JSON array, reading the stream in
+    chunks and decoding one item at a time
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    # What may come next: '[' to open the array, an item or ']' straight
+    # after it, an item after a comma, ',' or ']' after an item, and
+    # nothing but whitespace after the array
+    expecting = 'open'
+    while True:
+        chunk = stream.read(READ_SIZE)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            character = buffer[position]
+            if expecting == 'open':
+                if character != '[':
+                    raise ImportFormatError('Expected a JSON array.')
+                expecting = 'first'
+                position += 1
+                continue
+            if expecting == 'end':
+                raise ImportFormatError('Unexpected data after the array.')
+            if character == ']' and expecting in ('first', 'separator'):
+                expecting = 'end'
+                position += 1
+                continue
+            if expecting == 'separator':
+                if character != ',':
+                    raise ImportFormatError(
+                        f"Expected ',' or ']' but found {character!r}."
+                    )
+                expecting = 'item'
+                position += 1
+                continue
+            if character in ',]':
+                raise ImportFormatError(
+                    f'Expected an item but found {character!r}.'
+                )
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as error:
+                # The item may run on into the next chunk
+                if not chunk:
+                    raise ImportFormatError(f'Invalid JSON: {error}')
+                break
+            if end == len(buffer) and chunk:
+                # A number could continue in the next chunk
+                break
+            position = end
+            expecting = 'separator'
+            yield item
+        if not chunk:
+            if expecting == 'end':
+                return
+            raise ImportFormatError('The JSON array is not closed.')
+
+
+def read_ndjson(stream):
+    """
+    Yield one item per non blank line
+    """
+    for number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as error:
+                raise ImportFormatError(f'Line {number}: {error}')
+
+
+def read_csv(stream):
+    """
+    Yield one item per row, keyed on the header row
+    """
+    yield from csv.DictReader(stream)
+
+
+READERS = {
+    'json': read_json_array,
+    'ndjson': read_ndjson,
+    'csv': read_csv,
+}
+
+
+def _blank(value):
+    return value is None or value == ''
+
+
+def _decimal(value, field):
+    # Prices and ratings are stored with 6 digits, 2 after the point
+    try:
+        number = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f'has a {field} of {value!r}, which is not a number')
+    # Round first, as a value just under the limit can round up to it
+    if number.is_finite():
+        number = number.quantize(Decimal('0.01'))
+    if not number.is_finite() or abs(number) >= 10 ** 4:
+        raise ValueError(f'has a {field} of {value!r}, which is out of range')
+    return number
+
+
+def _boolean(value):
+    if isinstance(value, str):
+        return value.strip().lower() in _TRUE
+    return bool(value)
+
+
+class CatalogueImporter:
+    """
+    Upserts products from feed items in batches, creating or updating
+    any categories the feed contains along the way
+    """
+    def __init__(self, batch_size=1000, max_errors=20):
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.batch = {}
+        self.rows = 0
+        self.imported = 0
+        self.categories = 0
+        self.skipped = 0
+        self.errors = []
+        # Fixtures refer to categories by their primary key in the
+        # fixture, which need not match the one in this database
+        self.category_ids = {
+            name: pk for pk, name in Category.objects.values_list('pk', 'name')
+        }
+        self.category_pks = {pk: pk for pk in self.category_ids.values()}
+
+    def add(self, item):
+        """
+        Queue one feed item, writing the batch once it is full
+        """
+        self.rows += 1
+        if not isinstance(item, dict):
+            return self._skip('is not an object')
+        model = item.get('model')
+        fields = item.get('fields', item) if model else item
+        try:
+            if model == 'products.category':
+                self._save_category(item.get('pk'), fields)
+                return
+            if model not in (None, 'products.product'):
+                return self._skip(f'has unsupported model {model!r}')
+            product = self._product(fields, fixture=model is not None)
+        except (ValueError, TypeError) as error:
+            return self._skip(str(error))
+
+        # A later row for the same SKU replaces an earlier one
+        self.batch[product.sku] = product
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def _skip(self, reason):
+        self.skipped += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append(f'Row {self.rows} {reason}')
+
+    def _save_category(self, fixture_pk, fields):
+        name = fields.get('name')
+        if _blank(name):
+            raise ValueError('has a category without a name')
+        category, created = Category.objects.update_or_create(
+            name=name,
+            defaults={'friendly_name': fields.get('friendly_name') or None},
+        )
+        self.category_ids[name] = category.pk
+        if fixture_pk is not None:
+            self.category_pks[int(fixture_pk)] = category.pk
+        self.categories += 1
+
+    def _category_id(self, value, fixture):
+        if _blank(value):
+            return None
+        if fixture:
+            # Fixtures name categories by primary key, other feeds by name
+            try:
+                return self.category_pks[int(value)]
+            except (KeyError, ValueError):
+                raise ValueError(f'has unknown category {value!r}')
+        value = str(value)
+        if value not in self.category_ids:
+            self.category_ids[value] = Category.objects.create(
+                name=value
+            ).pk
+            self.categories += 1
+        return self.category_ids[value]
+
+    def _product(self, fields, fixture=False):
+        sku = fields.get('sku')
+        if _blank(sku):
+            raise ValueError('has no SKU')
+        if _blank(fields.get('name')):
+            raise ValueError('has no name')
+        if _blank(fields.get('price')):
+            raise ValueError('has no price')
+        rating = fields.get('rating')
+        return Product(
+            sku=str(sku),
+            name=fields['name'],
+            description=fields.get('description') or '',
+            has_sizes=_boolean(fields.get('has_sizes')),
+            price=_decimal(fields['price'], 'price'),
+            rating=None if _blank(rating) else _decimal(rating, 'rating'),
+            category_id=self._category_id(fields.get('category'), fixture),
+            image_url=fields.get('image_url') or None,
+            image=fields.get('image') or None,
+        )
+
+    def flush(self):
+        """
+        Upsert the queued products and refresh their search index entries
+        """
+        if not self.batch:
+            return
+        products = list(self.batch.values())
+        self.batch = {}
+        with transaction.atomic():
+            Product.objects.bulk_create(
+                products,
+                update_conflicts=True,
+                unique_fields=['sku'],
+                update_fields=UPDATE_FIELDS,
+            )
+            ids = [product.pk for product in products if product.pk]
+            if len(ids) < len(products):
+                ids = Product.objects.filter(
+                    sku__in=[product.sku for product in products]
+                ).values_list('pk', flat=True)
+            index_products(ids)
+        self.imported += len(products)
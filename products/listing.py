@@ -0,0 +1,99 @@
+"""
+Listing queries for the product catalogue page.
+
+A listing is described by normalised parameters and answered with the
+ids of one page of products, so the result is cheap to cache and can
+come from either the database or the in-memory catalogue snapshot.
+"""
+from .catalogue import catalogue_cache_key, get_or_compute
+from .facets import (
+    PRICE_BUCKET_MAP, RATING_KEYS, price_filter, rating_filter
+)
+from .models import Product, Category
+from .pagination import (
+    SORT_EXPRESSIONS, cached_count, paginate_keyset, paginate_ranked
+)
+from .search import filter_search, search_products
+from .snapshot import CATALOGUE_ENGINE, get_snapshot
+
+
+def listing_params(sort, direction, categories, query, cursor,
+                   price=None, rating=None):
+    """
+    Normalise the listing parameters so equivalent requests share a cache key
+    """
+    if sort not in SORT_EXPRESSIONS:
+        sort = direction = None
+    elif direction != 'desc':
+        direction = 'asc'
+    return {
+        'sort': sort,
+        'direction': direction,
+        'categories': sorted(set(categories)) if categories else None,
+        'q': query,
+        'price': price if price in PRICE_BUCKET_MAP else None,
+        'rating': rating if rating in RATING_KEYS else None,
+        'cursor': cursor,
+    }
+
+
+def build_listing(params):
+    """
+    Run the listing queries for one page, returning only product ids
+    so that the result is cheap to cache
+    """
+    products = Product.objects.all()
+    categories = None
+
+    if params['categories']:
+        products = products.filter(category__name__in=params['categories'])
+        categories = list(
+            Category.objects.filter(name__in=params['categories'])
+        )
+
+    if params['price']:
+        products = products.filter(price_filter(params['price']))
+
+    if params['rating']:
+        products = products.filter(rating_filter(params['rating']))
+
+    if params['q']:
+        # Every match is counted and can be sorted, but only the best
+        # SEARCH_RESULTS_LIMIT are ranked
+        products = filter_search(products, params['q'])
+
+    ranked_count = None
+    if params['q'] and not params['sort']:
+        # Keep the search ranking unless another sort was chosen
+        ranked_ids = search_products(params['q'])
+        matching = set(
+            products.filter(pk__in=ranked_ids).values_list('pk', flat=True)
+        )
+        ranked_ids = [pk for pk in ranked_ids if pk in matching]
+        page = paginate_ranked(products, ranked_ids, params['cursor'])
+        ranked_count = len(ranked_ids)
+    else:
+        page = paginate_keyset(
+            products, params['sort'], params['direction'], params['cursor']
+        )
+
+    return {
+        'ids': [product.pk for product in page],
+        'count': cached_count(products, params),
+        'ranked_count': ranked_count,
+        'next_cursor': page.next_cursor,
+        'previous_cursor': page.previous_cursor,
+        'categories': categories,
+    }
+
+
+def get_listing(params):
+    """
+    Return the listing for the given parameters from the configured engine
+    """
+    if CATALOGUE_ENGINE == 'snapshot' and not params['q']:
+        return get_snapshot().listing(params)
+    return get_or_compute(
+        catalogue_cache_key('products:listing', params),
+        lambda: build_listing(params),
+    )
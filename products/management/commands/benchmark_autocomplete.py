@@ -0,0 +1,83 @@
+import random
+import time
+from contextlib import nullcontext
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from boutique_ado.test_database import throwaway_test_database
+from products.autocomplete import build_autocomplete, normalise
+from products.models import Product
+from products.sample_data import seed_catalogue
+from products.views import autocomplete
+
+
+class Command(BaseCommand):
+    help = (
+        "Time building the autocomplete index and answering prefixes of "
+        "product names, directly and through the view."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations', type=int, default=2000,
+            help='Prefixes to time (default 2000)',
+        )
+        parser.add_argument(
+            '--size', type=int,
+            help=(
+                'Time against this many generated products in a throwaway '
+                'database instead of the current catalogue'
+            ),
+        )
+
+    def _report(self, label, timings):
+        timings = sorted(timings)
+        count = len(timings)
+        self.stdout.write(
+            f'{label:<10}'
+            f'p50 {timings[count // 2] * 1e6:>8.1f} us  '
+            f'p99 {timings[min(count * 99 // 100, count - 1)] * 1e6:>8.1f} us  '
+            f'max {timings[-1] * 1e6:>8.1f} us'
+        )
+
+    def handle(self, *args, **options):
+        size = options['size']
+        database = throwaway_test_database() if size else nullcontext()
+        with database:
+            if size:
+                seed_catalogue(size)
+
+            start = time.perf_counter()
+            index = build_autocomplete()
+            self.stdout.write(
+                f'Index of {len(index.products.keys)} name suffixes built '
+                f'in {(time.perf_counter() - start) * 1000:.0f} ms'
+            )
+
+            names = list(Product.objects.values_list('name', flat=True))
+            if not names:
+                self.stdout.write('There are no products to search for.')
+                return
+            rng = random.Random(0)
+            prefixes = []
+            for _ in range(max(options['iterations'], 1)):
+                words = normalise(rng.choice(names)).split(' ')
+                word = rng.choice(words)
+                prefixes.append(word[:rng.randint(1, len(word))])
+
+            timings = []
+            for prefix in prefixes:
+                start = time.perf_counter()
+                index.suggest(prefix)
+                timings.append(time.perf_counter() - start)
+            self._report('index', timings)
+
+            factory = RequestFactory()
+            # The first request builds the view's own copy of the index
+            autocomplete(factory.get('/products/autocomplete/', {'q': 'a'}))
+            timings = []
+            for prefix in prefixes:
+                request = factory.get('/products/autocomplete/', {'q': prefix})
+                start = time.perf_counter()
+                autocomplete(request)
+                timings.append(time.perf_counter() - start)
+            self._report('view', timings)
@@ -0,0 +1,72 @@
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand
+from products.listing import build_listing, listing_params
+from products.models import Category
+from products.snapshot import build_snapshot
+
+SORTS = (
+    (None, None),
+    ('name', 'asc'),
+    ('price', 'asc'),
+    ('price', 'desc'),
+    ('rating', 'desc'),
+    ('category', 'asc'),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare listing latency of the database path with the in-memory "
+        "catalogue snapshot, and report the snapshot's memory use."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations', type=int, default=50,
+            help='Timed runs per listing (default 50)',
+        )
+
+    def _time(self, func, iterations):
+        func()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        return (time.perf_counter() - start) / iterations * 1000
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        snapshot = build_snapshot()
+        build_ms = (time.perf_counter() - start) * 1000
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.stdout.write(
+            f"Snapshot of {len(snapshot.ids)} products built in "
+            f"{build_ms:.1f} ms, using {current / 1024:.0f} KiB "
+            f"(peak {peak / 1024:.0f} KiB)"
+        )
+
+        category = Category.objects.values_list('name', flat=True).first()
+        self.stdout.write(
+            f"{'listing':<32}{'orm ms':>10}{'snapshot ms':>14}{'speedup':>10}"
+        )
+        for sort, direction in SORTS:
+            for categories in (None, [category] if category else None):
+                params = listing_params(
+                    sort, direction, categories, None, None
+                )
+                orm_ms = self._time(lambda: build_listing(params), iterations)
+                snapshot_ms = self._time(
+                    lambda: snapshot.listing(params), iterations
+                )
+                label = f"{sort or 'id'} {direction or 'asc'}"
+                if categories:
+                    label += f" [{categories[0]}]"
+                self.stdout.write(
+                    f"{label:<32}{orm_ms:>10.3f}{snapshot_ms:>14.3f}"
+                    f"{orm_ms / snapshot_ms:>9.1f}x"
+                )
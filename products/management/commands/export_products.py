@@ -0,0 +1,14 @@
+from boutique_ado.exports import ExportCommand
+from products.exports import product_export
+from products.models import Product
+
+
+class Command(ExportCommand):
+    help = (
+        "Stream every product to CSV or NDJSON in the flat format "
+        "import_products reads."
+    )
+    export = product_export
+
+    def get_queryset(self, options):
+        return Product.objects.all()
@@ -0,0 +1,84 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from django.core.management.base import BaseCommand
+from products.catalogue import bump_catalogue_version
+from products.images import (
+    current_derivatives, read_source, render_derivatives, store_derivatives
+)
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate the resized WebP and JPEG derivatives of every product "
+        "image, rendering them in a pool of worker processes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Worker processes to render with (default one per CPU)',
+        )
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Regenerate derivatives that are already up to date',
+        )
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['force']:
+            products = [
+                product for product in products.order_by('pk')
+                if current_derivatives(product) is None
+            ]
+        else:
+            products = list(products.order_by('pk'))
+
+        workers = max(options['workers'], 1)
+        generated = failed = 0
+        # Sources are read and derivatives stored here, so workers only
+        # render; a few jobs per worker are queued to bound memory use
+        pending = {}
+        queue = iter(products)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                while len(pending) < workers * 2:
+                    product = next(queue, None)
+                    if product is None:
+                        break
+                    try:
+                        data = read_source(product)
+                    except OSError as error:
+                        failed += 1
+                        self.stderr.write(f'{product.image.name}: {error}')
+                        continue
+                    future = executor.submit(render_derivatives, data)
+                    pending[future] = product
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    product = pending.pop(future)
+                    try:
+                        derivatives = store_derivatives(
+                            product.image.name, future.result()
+                        )
+                    except (OSError, ValueError) as error:
+                        failed += 1
+                        self.stderr.write(f'{product.image.name}: {error}')
+                        continue
+                    Product.objects.filter(pk=product.pk).update(
+                        image_derivatives=derivatives
+                    )
+                    generated += 1
+                    self.stdout.write(f'Generated {product.image.name}')
+
+        if generated:
+            bump_catalogue_version()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Generated derivatives for {generated} products '
+                f'({failed} failed).'
+            )
+        )
@@ -0,0 +1,112 @@
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from products.catalogue import bump_catalogue_version, bump_price_version
+from products.importer import (
+    FORMATS, READERS, CatalogueImporter, ImportFormatError, format_for
+)
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_memory_mib():
+    """
+    Return the peak resident memory of this process, where it is known
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    if sys.platform == 'darwin':
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream products and categories from JSON, NDJSON or CSV files "
+        "and upsert them by SKU in batches. Django fixtures and flat "
+        "records are both accepted; categories may be given by name or "
+        "by their primary key."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help="Files to import in order, or '-' for standard input",
+        )
+        parser.add_argument(
+            '--format', choices=FORMATS,
+            help='Feed format (default: guessed from each file extension)',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Products written per transaction (default 1000)',
+        )
+        parser.add_argument(
+            '--progress', type=int, default=50000,
+            help='Report progress every this many rows (default 50000)',
+        )
+
+    def _stream(self, path):
+        if path == '-':
+            return sys.stdin
+        # utf-8-sig drops the byte order mark spreadsheet exports add
+        try:
+            return open(path, encoding='utf-8-sig', newline='')
+        except OSError as error:
+            raise CommandError(f'{path}: {error}')
+
+    def handle(self, *args, **options):
+        importer = CatalogueImporter(batch_size=max(options['batch_size'], 1))
+        progress = options['progress']
+        start = time.perf_counter()
+
+        for path in options['paths']:
+            feed_format = options['format'] or format_for(path)
+            if feed_format is None:
+                raise CommandError(
+                    f'Cannot tell the format of {path}; use --format.'
+                )
+            stream = self._stream(path)
+            try:
+                for item in READERS[feed_format](stream):
+                    importer.add(item)
+                    if progress and importer.rows % progress == 0:
+                        elapsed = time.perf_counter() - start
+                        self.stdout.write(
+                            f'{importer.rows} rows, '
+                            f'{importer.rows / elapsed:.0f} rows/s'
+                        )
+                importer.flush()
+            except (ImportFormatError, OSError) as error:
+                raise CommandError(f'{path}: {error}')
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+
+        elapsed = time.perf_counter() - start
+        if importer.imported or importer.categories:
+            bump_catalogue_version()
+        if importer.imported:
+            # Upserts skip the signals that watch for price changes
+            bump_price_version()
+
+        for error in importer.errors:
+            self.stderr.write(error)
+        peak = peak_memory_mib()
+        self.stdout.write(
+            f'{importer.rows} rows in {elapsed:.1f} s '
+            f'({importer.rows / elapsed if elapsed else 0:.0f} rows/s)'
+            + (f', peak memory {peak:.0f} MiB' if peak else '')
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Imported {importer.imported} products and '
+                f'{importer.categories} categories; '
+                f'skipped {importer.skipped} rows.'
+            )
+        )
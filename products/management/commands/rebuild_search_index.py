@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from products.models import Product
+from products.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product full-text search index from scratch."
+
+    def handle(self, *args, **kwargs):
+        with transaction.atomic():
+            rebuild_index()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Indexed {Product.objects.count()} products for search."
+                )
+            )
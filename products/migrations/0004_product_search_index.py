@@ -0,0 +1,63 @@
+from django.db import migrations
+
+SQLITE_CREATE = (
+    'CREATE VIRTUAL TABLE IF NOT EXISTS products_search USING fts5('
+    "name, description, sku, category, tokenize = 'porter unicode61')"
+)
+POSTGRES_CREATE = (
+    'CREATE TABLE IF NOT EXISTS products_search ('
+    'product_id bigint PRIMARY KEY '
+    'REFERENCES products_product (id) ON DELETE CASCADE, '
+    'document tsvector NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS products_search_document_idx '
+    'ON products_search USING GIN (document)',
+)
+# The index as products.search built it when this migration was written,
+# frozen here so later changes to that module cannot change the migration
+SQLITE_BACKFILL = (
+    'INSERT INTO products_search (rowid, name, description, sku, category) '
+    "SELECT p.id, p.name, p.description, COALESCE(p.sku, ''), "
+    "COALESCE(c.friendly_name, '') "
+    'FROM products_product p '
+    'LEFT JOIN products_category c ON c.id = p.category_id'
+)
+POSTGRES_BACKFILL = (
+    'INSERT INTO products_search (product_id, document) '
+    'SELECT p.id, '
+    "setweight(to_tsvector('english', p.name), 'A') || "
+    "setweight(to_tsvector('simple', COALESCE(p.sku, '')), 'A') || "
+    "setweight(to_tsvector('english', "
+    "COALESCE(c.friendly_name, '')), 'B') || "
+    "setweight(to_tsvector('english', p.description), 'C') "
+    'FROM products_product p '
+    'LEFT JOIN products_category c ON c.id = p.category_id'
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(SQLITE_CREATE)
+        schema_editor.execute('DELETE FROM products_search')
+        schema_editor.execute(SQLITE_BACKFILL)
+    elif vendor == 'postgresql':
+        for statement in POSTGRES_CREATE:
+            schema_editor.execute(statement)
+        schema_editor.execute('TRUNCATE products_search')
+        schema_editor.execute(POSTGRES_BACKFILL)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP TABLE IF EXISTS products_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_product_has_sizes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -1,14 +1,35 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Lower
+from django.utils import timezone
 
 
 # Create your models here.
-class Category(models.Model):
+class CatalogueModel(models.Model):
+    """
+    Keeps updated_at current on every save. It has a default rather than
+    auto_now because fixtures are loaded raw, which skips auto_now and
+    would leave the column empty.
+    """
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        self.updated_at = timezone.now()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'updated_at'}
+        super().save(*args, **kwargs)
+
+
+class Category(CatalogueModel):
 
     class Meta:
         verbose_name_plural = 'Categories'
 
-    name = models.CharField(max_length=254)
+    name = models.CharField(max_length=254, unique=True)
     friendly_name = models.CharField(max_length=254, null=True, blank=True)
+    updated_at = models.DateTimeField(default=timezone.now, editable=False)
 
     def __str__(self):
         return self.name
@@ -17,11 +38,32 @@ class Category(models.Model):
         return self.friendly_name
 
 
-class Product(models.Model):
+class Product(CatalogueModel):
+
+    class Meta:
+        # One index per listing sort, ending in id for the tie-break
+        indexes = [
+            models.Index(
+                Lower('name'), F('id'), name='products_lower_name_idx'
+                ),
+            models.Index(fields=['price', 'id'], name='products_price_idx'),
+            models.Index(fields=['rating', 'id'], name='products_rating_idx'),
+            models.Index(
+                fields=['category', 'price', 'id'],
+                name='products_category_price_idx'
+                ),
+            models.Index(
+                fields=['category', 'rating', 'id'],
+                name='products_category_rating_idx'
+                ),
+        ]
+
     category = models.ForeignKey(
         'Category', null=True, blank=True, on_delete=models.SET_NULL
         )
-    sku = models.CharField(max_length=254, null=True, blank=True)
+    sku = models.CharField(
+        max_length=254, null=True, blank=True, unique=True
+        )
     name = models.CharField(max_length=254)
     description = models.TextField()
     has_sizes = models.BooleanField(default=False, null=True, blank=True)
@@ -31,6 +73,8 @@ class Product(models.Model):
         )
     image_url = models.URLField(max_length=1024, null=True, blank=True)
     image = models.ImageField(null=True, blank=True)
+    image_derivatives = models.JSONField(default=dict, editable=False)
+    updated_at = models.DateTimeField(default=timezone.now, editable=False)
 
     def __str__(self):
         return self.name
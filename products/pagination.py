@@ -0,0 +1,247 @@
+"""
+Keyset (cursor) pagination for the product listing.
+
+Each page is fetched with a WHERE clause that starts after the last row
+of the previous page, so page N costs the same as page 1. Rows are
+always ordered by the sort value and then by id in the same direction,
+which keeps the order stable when several products share a price,
+rating or name, and lets one (value, id) index serve both directions.
+"""
+import base64
+import binascii
+import json
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from django.db.models.functions import Lower
+from .catalogue import catalogue_cache_key
+from .models import Category, Product
+
+PRODUCTS_PER_PAGE = getattr(settings, 'PRODUCTS_PER_PAGE', 24)
+COUNT_CACHE_TIMEOUT = 60 * 60
+
+# sort key -> (expression, nullable)
+SORT_EXPRESSIONS = {
+    'name': (Lower('name'), False),
+    'price': (F('price'), False),
+    'rating': (F('rating'), True),
+    'category': (F('category__name'), True),
+}
+# sort key -> the field whose type cursor values must have
+SORT_FIELDS = {
+    'name': Product._meta.get_field('name'),
+    'price': Product._meta.get_field('price'),
+    'rating': Product._meta.get_field('rating'),
+    'category': Category._meta.get_field('name'),
+}
+
+
+class Page:
+    """
+    A single page of results and the cursors either side of it
+    """
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(payload):
+    data = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor from the query string, returning None if it is invalid
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, binascii.Error):
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def _valid_cursor_value(sort, value):
+    """
+    Check a cursor's sort value is one the sort could have produced
+    """
+    if sort is None:
+        return True
+    if value is None:
+        return SORT_EXPRESSIONS[sort][1]
+    if not isinstance(value, str):
+        return False
+    try:
+        SORT_FIELDS[sort].to_python(value)
+    except ValidationError:
+        return False
+    return True
+
+
+def decode_sort_cursor(cursor, sort):
+    """
+    Decode a keyset cursor for the given sort key, returning None unless
+    it was made for that sort and holds a value and id of the right types
+    """
+    payload = decode_cursor(cursor)
+    if (
+        payload is None or payload.get('s') != sort
+        or not isinstance(payload.get('id'), int)
+        or isinstance(payload['id'], bool)
+        or not _valid_cursor_value(sort, payload.get('v'))
+    ):
+        return None
+    return payload
+
+
+def _after(value, pk, descending, nullable, nulls_last):
+    """
+    Build a filter for the rows that follow (value, pk) in the ordering.
+    The leading range condition lets the database seek straight to the
+    cursor through the sort index.
+    """
+    pk_filter = Q(pk__lt=pk) if descending else Q(pk__gt=pk)
+    if value is None:
+        if nulls_last:
+            return Q(sort_value__isnull=True) & pk_filter
+        return Q(sort_value__isnull=False) | (
+            Q(sort_value__isnull=True) & pk_filter
+        )
+
+    if descending:
+        condition = Q(sort_value__lte=value) & (
+            Q(sort_value__lt=value) | pk_filter
+        )
+    else:
+        condition = Q(sort_value__gte=value) & (
+            Q(sort_value__gt=value) | pk_filter
+        )
+    if nullable and nulls_last:
+        condition |= Q(sort_value__isnull=True)
+    return condition
+
+
+def _ordering(sort, descending, nullable, nulls_last):
+    if sort is None:
+        # Ordering by the alias would hide the primary key from the planner
+        return ['-pk' if descending else 'pk']
+    nulls = {}
+    if nullable:
+        nulls = {'nulls_last': True} if nulls_last else {'nulls_first': True}
+    value = F('sort_value')
+    value = value.desc(**nulls) if descending else value.asc(**nulls)
+    return [value, '-pk' if descending else 'pk']
+
+
+def _cursor_value(value):
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+def paginate_keyset(queryset, sort=None, direction=None, cursor=None,
+                    per_page=PRODUCTS_PER_PAGE):
+    """
+    Return one page of the queryset ordered by the given sort key.
+    Products are ordered by id when no sort key is given.
+    """
+    if sort in SORT_EXPRESSIONS:
+        expression, nullable = SORT_EXPRESSIONS[sort]
+    else:
+        sort, expression, nullable = None, F('pk'), False
+    descending = sort is not None and direction == 'desc'
+    queryset = queryset.annotate(sort_value=expression)
+
+    payload = decode_sort_cursor(cursor, sort)
+    backwards = payload is not None and payload.get('d') == 'p'
+
+    # Walking backwards flips the ordering, including null placement
+    page_descending = descending != backwards
+    nulls_last = not backwards
+    if payload is not None:
+        queryset = queryset.filter(_after(
+            payload.get('v'), payload['id'], page_descending, nullable,
+            nulls_last,
+        ))
+    queryset = queryset.order_by(
+        *_ordering(sort, page_descending, nullable, nulls_last)
+    )
+
+    rows = list(queryset[:per_page + 1])
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return Page(rows)
+
+    def make_cursor(row, page_direction):
+        return encode_cursor({
+            's': sort,
+            'v': _cursor_value(row.sort_value),
+            'id': row.pk,
+            'd': page_direction,
+        })
+
+    next_cursor = previous_cursor = None
+    if has_more or backwards:
+        next_cursor = make_cursor(rows[-1], 'n')
+    if (has_more and backwards) or (payload is not None and not backwards):
+        previous_cursor = make_cursor(rows[0], 'p')
+    return Page(rows, next_cursor, previous_cursor)
+
+
+def paginate_ranked(queryset, ranked_ids, cursor=None,
+                    per_page=PRODUCTS_PER_PAGE):
+    """
+    Return one page of search results in ranking order. The ranked id list
+    is already bounded, so the cursor is simply a position within it.
+    """
+    payload = decode_cursor(cursor) or {}
+    offset = payload.get('o', 0)
+    if not isinstance(offset, int) or offset < 0:
+        offset = 0
+
+    page_ids = ranked_ids[offset:offset + per_page]
+    products = queryset.in_bulk(page_ids)
+    rows = [products[pk] for pk in page_ids if pk in products]
+
+    next_cursor = previous_cursor = None
+    if offset + per_page < len(ranked_ids):
+        next_cursor = encode_cursor({'o': offset + per_page})
+    if offset > 0:
+        previous_cursor = encode_cursor({'o': max(offset - per_page, 0)})
+    return Page(rows, next_cursor, previous_cursor)
+
+
+def cached_count(queryset, params):
+    """
+    Count the queryset once and reuse the result until the catalogue
+    changes. The key comes from the normalised listing parameters that
+    filter it, since neither the sort nor the cursor changes the count.
+    """
+    key = catalogue_cache_key('products:count', {
+        name: params[name] for name in ('categories', 'q', 'price', 'rating')
+    })
+    count = cache.get(key)
+    if count is None:
+        count = queryset.order_by().count()
+        cache.set(key, count, COUNT_CACHE_TIMEOUT)
+    return count
@@ -0,0 +1,37 @@
+"""
+Synthetic catalogue data for the tests and benchmarks that measure
+query counts and query plans at different catalogue sizes.
+"""
+from decimal import Decimal
+from django.core.cache import cache
+from .models import Category, Product
+from .search import rebuild_index
+
+SAMPLE_CATEGORIES = ('sample_a', 'sample_b', 'sample_c', 'sample_d')
+
+
+def seed_catalogue(size):
+    """
+    Replace the catalogue with `size` generated products spread over
+    the sample categories, some without a rating
+    """
+    Product.objects.all().delete()
+    Category.objects.all().delete()
+    categories = Category.objects.bulk_create([
+        Category(name=name, friendly_name=name.replace('_', ' ').title())
+        for name in SAMPLE_CATEGORIES
+    ])
+    Product.objects.bulk_create([
+        Product(
+            pk=number,
+            sku=f'sample{number}',
+            name=f'Sample product {number}',
+            description='A generated product',
+            price=Decimal(number % 90 + 10),
+            rating=Decimal(number % 5) if number % 7 else None,
+            category=categories[number % len(categories)],
+        )
+        for number in range(1, size + 1)
+    ], batch_size=1000)
+    rebuild_index()
+    cache.clear()
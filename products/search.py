@@ -0,0 +1,312 @@
+"""
+Full-text search over the product catalogue.
+
+The index lives in the ``products_search`` table, which is created by
+migration 0004 and is backend specific:
+
+* SQLite: an FTS5 virtual table using the porter stemmer, ranked with bm25()
+* Postgres: a weighted tsvector column with a GIN index, ranked with
+  ts_rank_cd()
+
+Any other backend falls back to an unranked ``icontains`` scan.
+
+Queries support plain terms (all must match), "quoted phrases" and
+prefix terms ending in ``*``.
+"""
+import re
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+SEARCH_TABLE = 'products_search'
+SEARCH_RESULTS_LIMIT = getattr(settings, 'SEARCH_RESULTS_LIMIT', 500)
+
+# name, description, sku, category - a match in the name counts most
+SQLITE_COLUMN_WEIGHTS = (10.0, 1.0, 5.0, 3.0)
+
+TOKEN_RE = re.compile(r'\w+')
+QUERY_RE = re.compile(r'"([^"]*)"|(\w+)(\*?)')
+
+
+def tokenize(text):
+    """
+    Split text into lower case word tokens
+    """
+    return TOKEN_RE.findall((text or '').lower())
+
+
+def parse_query(query):
+    """
+    Parse a search string into a list of (kind, tokens) clauses
+    where kind is one of 'term', 'prefix' or 'phrase'
+    """
+    clauses = []
+    for phrase, word, star in QUERY_RE.findall(query or ''):
+        if phrase:
+            tokens = tokenize(phrase)
+            if len(tokens) == 1:
+                clauses.append(('term', tokens))
+            elif tokens:
+                clauses.append(('phrase', tokens))
+        elif word:
+            clauses.append(('prefix' if star else 'term', tokenize(word)))
+    return clauses
+
+
+class BaseSearchBackend:
+    """
+    Interface shared by the database specific search backends
+    """
+    def search(self, clauses, limit):
+        raise NotImplementedError
+
+    def matches(self, clauses):
+        """
+        Return a filter for every matching product, without the limit
+        that search() ranks within
+        """
+        raise NotImplementedError
+
+    def index(self, product_ids):
+        raise NotImplementedError
+
+    def remove(self, product_ids):
+        raise NotImplementedError
+
+    def rebuild(self):
+        raise NotImplementedError
+
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    """
+    FTS5 backed search for SQLite
+    """
+    DOCUMENT_SQL = (
+        f'INSERT INTO {SEARCH_TABLE} '
+        '(rowid, name, description, sku, category) '
+        'SELECT p.id, p.name, p.description, COALESCE(p.sku, \'\'), '
+        'COALESCE(c.friendly_name, \'\') '
+        'FROM products_product p '
+        'LEFT JOIN products_category c ON c.id = p.category_id'
+    )
+
+    def _match_expression(self, clauses):
+        parts = []
+        for kind, tokens in clauses:
+            quoted = '"%s"' % ' '.join(tokens)
+            parts.append(f'{quoted}*' if kind == 'prefix' else quoted)
+        return ' '.join(parts)
+
+    def search(self, clauses, limit):
+        weights = ', '.join(str(w) for w in SQLITE_COLUMN_WEIGHTS)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {SEARCH_TABLE} '
+                f'WHERE {SEARCH_TABLE} MATCH %s '
+                f'ORDER BY bm25({SEARCH_TABLE}, {weights}), rowid '
+                'LIMIT %s',
+                [self._match_expression(clauses), limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def matches(self, clauses):
+        return Q(pk__in=RawSQL(
+            f'SELECT rowid FROM {SEARCH_TABLE} '
+            f'WHERE {SEARCH_TABLE} MATCH %s',
+            [self._match_expression(clauses)],
+        ))
+
+    def index(self, product_ids):
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({placeholders})',
+                product_ids,
+            )
+            cursor.execute(
+                f'{self.DOCUMENT_SQL} WHERE p.id IN ({placeholders})',
+                product_ids,
+            )
+
+    def remove(self, product_ids):
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({placeholders})',
+                product_ids,
+            )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+            cursor.execute(self.DOCUMENT_SQL)
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) "
+                "VALUES ('optimize')"
+            )
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    tsvector/GIN backed search for Postgres
+    """
+    DOCUMENT_SQL = (
+        f'INSERT INTO {SEARCH_TABLE} (product_id, document) '
+        'SELECT p.id, '
+        "setweight(to_tsvector('english', p.name), 'A') || "
+        "setweight(to_tsvector('simple', COALESCE(p.sku, '')), 'A') || "
+        "setweight(to_tsvector('english', "
+        "COALESCE(c.friendly_name, '')), 'B') || "
+        "setweight(to_tsvector('english', p.description), 'C') "
+        'FROM products_product p '
+        'LEFT JOIN products_category c ON c.id = p.category_id'
+    )
+    UPSERT_SQL = (
+        ' ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document'
+    )
+
+    def _tsquery(self, clauses):
+        # Tokens only ever contain word characters, so they are safe
+        # to join into tsquery syntax
+        parts = []
+        for kind, tokens in clauses:
+            if kind == 'phrase':
+                parts.append('(%s)' % ' <-> '.join(tokens))
+            elif kind == 'prefix':
+                parts.append(f'{tokens[0]}:*')
+            else:
+                parts.append(tokens[0])
+        return ' & '.join(parts)
+
+    def search(self, clauses, limit):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT product_id FROM {SEARCH_TABLE}, '
+                "to_tsquery('english', %s) query "
+                'WHERE document @@ query '
+                'ORDER BY ts_rank_cd(document, query, 1) DESC, product_id '
+                'LIMIT %s',
+                [self._tsquery(clauses), limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def matches(self, clauses):
+        return Q(pk__in=RawSQL(
+            f'SELECT product_id FROM {SEARCH_TABLE} '
+            "WHERE document @@ to_tsquery('english', %s)",
+            [self._tsquery(clauses)],
+        ))
+
+    def index(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'{self.DOCUMENT_SQL} WHERE p.id = ANY(%s){self.UPSERT_SQL}',
+                [list(product_ids)],
+            )
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {SEARCH_TABLE} WHERE product_id = ANY(%s)',
+                [list(product_ids)],
+            )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {SEARCH_TABLE}')
+            cursor.execute(self.DOCUMENT_SQL)
+
+
+class FallbackSearchBackend(BaseSearchBackend):
+    """
+    Unranked search for databases without a full-text index
+    """
+    def search(self, clauses, limit):
+        from .models import Product
+
+        products = Product.objects.filter(self.matches(clauses))
+        return list(products.order_by('id').values_list('id', flat=True)[
+            :limit
+        ])
+
+    def matches(self, clauses):
+        condition = Q()
+        for kind, tokens in clauses:
+            text = ' '.join(tokens)
+            condition &= (
+                Q(name__icontains=text)
+                | Q(description__icontains=text)
+                | Q(sku__icontains=text)
+                | Q(category__friendly_name__icontains=text)
+            )
+        return condition
+
+    def index(self, product_ids):
+        pass
+
+    def remove(self, product_ids):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_backend():
+    """
+    Return the search backend for the default database
+    """
+    return BACKENDS.get(connection.vendor, FallbackSearchBackend)()
+
+
+def search_products(query, limit=None):
+    """
+    Return the ids of products matching the query, best match first
+    """
+    clauses = parse_query(query)
+    if not clauses:
+        return []
+    return get_backend().search(clauses, limit or SEARCH_RESULTS_LIMIT)
+
+
+def filter_search(queryset, query):
+    """
+    Narrow the queryset to all the products matching the query, however
+    many there are. A query with no words in it matches nothing.
+    """
+    clauses = parse_query(query)
+    if not clauses:
+        return queryset.none()
+    return queryset.filter(get_backend().matches(clauses))
+
+
+def index_products(product_ids, batch_size=500):
+    """
+    Add or refresh the index entries for the given products
+    """
+    product_ids = list(product_ids)
+    backend = get_backend()
+    for start in range(0, len(product_ids), batch_size):
+        backend.index(product_ids[start:start + batch_size])
+
+
+def remove_products(product_ids):
+    """
+    Drop the index entries for the given products
+    """
+    product_ids = list(product_ids)
+    if product_ids:
+        get_backend().remove(product_ids)
+
+
+def rebuild_index():
+    """
+    Rebuild the whole index from the products table
+    """
+    get_backend().rebuild()
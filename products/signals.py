@@ -0,0 +1,92 @@
+from django.db import transaction
+from django.db.models.signals import (
+    post_save, post_delete, pre_delete, pre_save
+)
+from django.dispatch import receiver
+from .models import Product, Category
+from .catalogue import (
+    PRICE_VERSION_FIELDS, bump_catalogue_version, bump_price_version
+)
+from .search import index_products, remove_products
+
+
+@receiver(post_save, sender=Product)
+def index_product_on_save(sender, instance, **kwargs):
+    """
+    Refresh the search index entry for a saved product
+    """
+    transaction.on_commit(lambda: index_products([instance.pk]))
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product_on_delete(sender, instance, **kwargs):
+    """
+    Drop the search index entry for a deleted product
+    """
+    product_id = instance.pk
+    transaction.on_commit(lambda: remove_products([product_id]))
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_on_save(sender, instance, **kwargs):
+    """
+    Category names are indexed with their products, so refresh them all
+    """
+    product_ids = list(instance.product_set.values_list('id', flat=True))
+    transaction.on_commit(lambda: index_products(product_ids))
+
+
+@receiver(pre_delete, sender=Category)
+def collect_category_products(sender, instance, **kwargs):
+    """
+    Remember the category's products before they are detached from it
+    """
+    instance._indexed_product_ids = list(
+        instance.product_set.values_list('id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Category)
+def reindex_category_on_delete(sender, instance, **kwargs):
+    """
+    Refresh the products that were in a deleted category
+    """
+    product_ids = getattr(instance, '_indexed_product_ids', [])
+    transaction.on_commit(lambda: index_products(product_ids))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def bump_version_on_change(sender, **kwargs):
+    """
+    Invalidate cached listings once a catalogue change is committed
+    """
+    transaction.on_commit(bump_catalogue_version)
+
+
+@receiver(pre_save, sender=Product)
+def bump_price_version_on_change(sender, instance, raw=False, **kwargs):
+    """
+    Invalidate cached bag summaries once a change to a product's price,
+    or anything else a bag shows of it, is committed
+    """
+    if raw or instance.pk is None:
+        return
+    saved = Product.objects.filter(pk=instance.pk).values_list(
+        *PRICE_VERSION_FIELDS
+    ).first()
+    current = tuple(
+        getattr(instance, field) for field in PRICE_VERSION_FIELDS
+    )
+    if saved is not None and saved != current:
+        transaction.on_commit(bump_price_version)
+
+
+@receiver(post_delete, sender=Product)
+def bump_price_version_on_delete(sender, **kwargs):
+    """
+    Deleted products drop out of bags, so cached summaries must go too
+    """
+    transaction.on_commit(bump_price_version)
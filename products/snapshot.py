@@ -0,0 +1,248 @@
+"""
+An in-memory, column oriented snapshot of the catalogue.
+
+When CATALOGUE_ENGINE is 'snapshot', each worker keeps one immutable
+snapshot of every product as parallel arrays, along with the row order
+for every supported sort. Category, price and rating filters, sorting
+and pagination are then answered without touching the database.
+
+The catalogue version is read from the cache at most once every
+SNAPSHOT_VERSION_CHECK_INTERVAL seconds, since with the database cache
+each read is a query. The snapshot is rebuilt when the version has
+changed, so listings can lag a catalogue change by that long, and is
+swapped in whole so readers never see a half built one.
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from django.conf import settings
+from .catalogue import get_catalogue_version
+from .facets import PRICE_BUCKET_MAP, RATING_BUCKET_MAP, UNRATED
+from .models import Category, Product
+from .pagination import (
+    PRODUCTS_PER_PAGE, decode_sort_cursor, encode_cursor
+)
+
+CATALOGUE_ENGINE = getattr(settings, 'CATALOGUE_ENGINE', 'orm')
+SNAPSHOT_VERSION_CHECK_INTERVAL = getattr(
+    settings, 'SNAPSHOT_VERSION_CHECK_INTERVAL', 1
+)
+NULL_RATING = float('nan')
+
+
+class CatalogueSnapshot:
+    """
+    Parallel arrays of product data plus presorted row orders.
+    Row i of every array describes the same product.
+    """
+    def __init__(self, version, products, categories):
+        self.version = version
+        self.ids = array('q')
+        self.prices = array('q')
+        self.ratings = array('d')
+        self.category_ids = array('q')
+        self.names = []
+
+        for pk, price, rating, category_id, name in products:
+            self.ids.append(pk)
+            self.prices.append(int(price * 100))
+            self.ratings.append(
+                NULL_RATING if rating is None else float(rating)
+            )
+            self.category_ids.append(category_id or 0)
+            self.names.append(name.lower())
+        self.names = tuple(self.names)
+        self.rows_by_id = {pk: row for row, pk in enumerate(self.ids)}
+
+        self.categories = {category.name: category for category in categories}
+        category_names = {
+            category.pk: category.name for category in categories
+        }
+        self.row_category_names = tuple(
+            category_names.get(category_id)
+            for category_id in self.category_ids
+        )
+
+        self.orderings = {}
+        self.ranks = {}
+        for sort, values in (
+            (None, self.ids),
+            ('name', self.names),
+            ('price', self.prices),
+            ('rating', [
+                None if rating != rating else rating
+                for rating in self.ratings
+            ]),
+            ('category', self.row_category_names),
+        ):
+            for direction in ('asc', 'desc'):
+                order = self._sorted_rows(values, direction == 'desc')
+                ranks = array('l', [0]) * len(order)
+                for rank, row in enumerate(order):
+                    ranks[row] = rank
+                self.orderings[(sort, direction)] = order
+                self.ranks[(sort, direction)] = ranks
+
+    def _sorted_rows(self, values, descending):
+        """
+        Order rows by value and then id, both in the same direction,
+        with nulls last, matching the ordering used by the database path
+        """
+        # Rows are loaded in id order and sort() is stable, so equal
+        # values stay in id order; reversing flips both together
+        rows = [row for row in range(len(values)) if values[row] is not None]
+        nulls = [row for row in range(len(values)) if values[row] is None]
+        rows.sort(key=values.__getitem__)
+        if descending:
+            rows.reverse()
+            nulls.reverse()
+        return array('l', rows + nulls)
+
+    def _range_check(self, values, bucket, scale):
+        """
+        Build a row check for a facet bucket's [low, high) range.
+        NaN ratings fail every comparison, so unrated rows never match.
+        """
+        key, label, low, high = bucket
+        low = float('-inf') if low is None else low * scale
+        high = float('inf') if high is None else high * scale
+        return lambda row: low <= values[row] < high
+
+    def _cursor_value(self, sort, row):
+        if sort == 'name':
+            return self.names[row]
+        if sort == 'price':
+            pence = self.prices[row]
+            return f'{pence // 100}.{pence % 100:02d}'
+        if sort == 'rating':
+            rating = self.ratings[row]
+            return None if rating != rating else f'{rating:.2f}'
+        if sort == 'category':
+            return self.row_category_names[row]
+        return self.ids[row]
+
+    def listing(self, params, per_page=PRODUCTS_PER_PAGE):
+        """
+        Answer a normalised listing request, returning the same structure
+        as the database listing path
+        """
+        sort = params['sort']
+        direction = params['direction'] or 'asc'
+        order = self.orderings[(sort, direction)]
+        ranks = self.ranks[(sort, direction)]
+
+        categories = None
+        checks = []
+        if params['categories']:
+            categories = [
+                self.categories[name] for name in params['categories']
+                if name in self.categories
+            ]
+            wanted = {category.pk for category in categories}
+            category_ids = self.category_ids
+            checks.append(lambda row: category_ids[row] in wanted)
+        if params.get('price'):
+            checks.append(self._range_check(
+                self.prices, PRICE_BUCKET_MAP[params['price']], 100
+            ))
+        if params.get('rating') == UNRATED[0]:
+            ratings = self.ratings
+            checks.append(lambda row: ratings[row] != ratings[row])
+        elif params.get('rating'):
+            checks.append(self._range_check(
+                self.ratings, RATING_BUCKET_MAP[params['rating']], 1
+            ))
+        filtered = bool(checks)
+        if filtered:
+            order = [
+                row for row in order if all(check(row) for check in checks)
+            ]
+
+        start = 0
+        payload = decode_sort_cursor(params['cursor'], sort)
+        if payload is not None and payload['id'] in self.rows_by_id:
+            rank = ranks[self.rows_by_id[payload['id']]]
+            if not filtered:
+                position = rank + 1
+            else:
+                # The filtered rows keep their relative order, so their
+                # ranks are sorted and can be searched directly
+                position = bisect_right([ranks[row] for row in order], rank)
+            if payload.get('d') == 'p':
+                start = max(position - 1 - per_page, 0)
+            else:
+                start = position
+
+        rows = order[start:start + per_page]
+
+        def make_cursor(row, page_direction):
+            return encode_cursor({
+                's': sort,
+                'v': self._cursor_value(sort, row),
+                'id': self.ids[row],
+                'd': page_direction,
+            })
+
+        next_cursor = previous_cursor = None
+        if rows and start + per_page < len(order):
+            next_cursor = make_cursor(rows[-1], 'n')
+        if rows and start > 0:
+            previous_cursor = make_cursor(rows[0], 'p')
+
+        return {
+            'ids': [self.ids[row] for row in rows],
+            'count': len(order),
+            'ranked_count': None,
+            'next_cursor': next_cursor,
+            'previous_cursor': previous_cursor,
+            'categories': categories,
+        }
+
+
+def build_snapshot(version=None):
+    """
+    Load every product into a new snapshot
+    """
+    if version is None:
+        version = get_catalogue_version()
+    products = Product.objects.order_by('id').values_list(
+        'id', 'price', 'rating', 'category_id', 'name'
+    )
+    return CatalogueSnapshot(
+        version, products.iterator(chunk_size=2000), list(Category.objects.all())
+    )
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+# When this worker last read the catalogue version
+_version_checked_at = None
+
+
+def get_snapshot():
+    """
+    Return this worker's snapshot, rebuilding it if the catalogue changed.
+    While one thread rebuilds, the others keep serving the old snapshot.
+    """
+    global _snapshot, _version_checked_at
+    snapshot = _snapshot
+    now = time.monotonic()
+    if snapshot is not None and _version_checked_at is not None and (
+        now - _version_checked_at < SNAPSHOT_VERSION_CHECK_INTERVAL
+    ):
+        return snapshot
+
+    version = get_catalogue_version()
+    _version_checked_at = now
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+
+    if _snapshot_lock.acquire(blocking=snapshot is None):
+        try:
+            if _snapshot is None or _snapshot.version != version:
+                _snapshot = build_snapshot(version)
+            snapshot = _snapshot
+        finally:
+            _snapshot_lock.release()
+    return snapshot
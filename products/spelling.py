@@ -0,0 +1,261 @@
+"""
+Spelling suggestions for searches that find nothing.
+
+The vocabulary is every word in the product names, descriptions and
+category names, counted by how often it appears. A symmetric delete
+index maps each word with up to MAX_DISTANCE letters removed back to the
+word, so the candidates for a misspelling are found by removing letters
+from it too and looking the results up, with no scan of the vocabulary.
+Candidates are then checked with a true edit distance, and the closest,
+most common one wins.
+
+Each worker keeps one index. When the catalogue version changes it
+updates a copy with the products and categories changed since it last
+looked, and swaps the copy in once it is done. Words of deleted products
+stay until the next full rebuild, which happens at most every
+SPELLING_REBUILD_INTERVAL seconds.
+"""
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .catalogue import get_catalogue_version
+from .models import Category, Product
+from .search import tokenize
+
+MAX_DISTANCE = 2
+MIN_WORD_LENGTH = 3
+SPELLING_TIME_BUDGET = getattr(settings, 'SPELLING_TIME_BUDGET', 0.01)
+SPELLING_AUTOCORRECT = getattr(settings, 'SPELLING_AUTOCORRECT', False)
+SPELLING_REBUILD_INTERVAL = getattr(
+    settings, 'SPELLING_REBUILD_INTERVAL', 60 * 60
+)
+# Rows updated this close to the last read are read again, so a write
+# committed while the index was being updated is not missed
+CLOCK_MARGIN = timedelta(seconds=5)
+
+
+def max_distance(word):
+    """
+    Return how many edits a word may be from its correction.
+    Short words allow fewer, or nearly any word would match them.
+    """
+    return 1 if len(word) <= 4 else MAX_DISTANCE
+
+
+def _deletes(word, distance):
+    """
+    Return every variant of word with up to distance letters removed
+    """
+    variants = {word}
+    edge = {word}
+    for _ in range(distance):
+        edge = {
+            variant[:i] + variant[i + 1:]
+            for variant in edge if len(variant) > 1
+            for i in range(len(variant))
+        }
+        variants |= edge
+    return variants
+
+
+def edit_distance(a, b, limit):
+    """
+    Return the Damerau-Levenshtein (optimal string alignment) distance
+    between a and b, or limit + 1 once it is certain to exceed limit
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous_row = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous_row, row = previous_row, row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            row[j] = min(
+                previous_row[j] + 1,
+                row[j - 1] + 1,
+                previous_row[j - 1] + cost,
+            )
+            if (
+                i > 1 and j > 1 and a[i - 1] == b[j - 2]
+                and a[i - 2] == b[j - 1]
+            ):
+                row[j] = min(row[j], before[j - 2] + 1)
+        if min(row) > limit:
+            return limit + 1
+    return row[-1]
+
+
+class SpellingIndex:
+    """
+    A word frequency table with a symmetric delete index over it
+    """
+    def __init__(self):
+        self.counts = Counter()
+        self.deletes = {}
+        self.indexed = set()
+        # The words each product and category added to counts, so a
+        # changed one can be counted again without counting it twice
+        self.sources = {}
+        self.version = None
+        self.built_at = time.monotonic()
+        self.updated_to = None
+
+    def _words(self, *texts):
+        words = Counter()
+        for text in texts:
+            for word in tokenize(text):
+                if len(word) >= MIN_WORD_LENGTH and not word.isdigit():
+                    words[word] += 1
+        return words
+
+    def set_source(self, key, *texts):
+        """
+        Count the words of one product or category, replacing whatever
+        it contributed before
+        """
+        words = self._words(*texts)
+        for word, count in self.sources.get(key, {}).items():
+            self.counts[word] -= count
+            if self.counts[word] <= 0:
+                del self.counts[word]
+        for word, count in words.items():
+            if word not in self.indexed:
+                # Readers may be looking words up while this runs, so
+                # the delete index is only ever appended to
+                for variant in _deletes(word, MAX_DISTANCE):
+                    self.deletes.setdefault(variant, []).append(word)
+                self.indexed.add(word)
+            self.counts[word] += count
+        self.sources[key] = words
+
+    def copy(self):
+        """
+        Return a copy to update while readers keep using this index. The
+        delete index is shared, as it is only ever appended to and words
+        missing from an index's counts are skipped.
+        """
+        index = SpellingIndex()
+        index.counts = self.counts.copy()
+        index.deletes = self.deletes
+        index.indexed = self.indexed.copy()
+        index.sources = self.sources.copy()
+        index.version = self.version
+        index.built_at = self.built_at
+        index.updated_to = self.updated_to
+        return index
+
+    def update(self, version, since=None):
+        """
+        Count the words of products and categories changed since the
+        given time, or of all of them
+        """
+        started = timezone.now()
+        products = Product.objects.all()
+        categories = Category.objects.all()
+        if since is not None:
+            products = products.filter(updated_at__gt=since)
+            categories = categories.filter(updated_at__gt=since)
+        rows = products.values_list('pk', 'name', 'description')
+        for pk, name, description in rows.iterator(chunk_size=2000):
+            self.set_source(('product', pk), name, description)
+        for pk, name, friendly_name in categories.values_list(
+            'pk', 'name', 'friendly_name'
+        ):
+            self.set_source(
+                ('category', pk), name.replace('_', ' '), friendly_name
+            )
+        self.version = version
+        self.updated_to = started - CLOCK_MARGIN
+
+    def correct_word(self, word, deadline):
+        """
+        Return the closest common word to a misspelt one, or None
+        """
+        limit = max_distance(word)
+        best = None
+        best_key = None
+        seen = set()
+        for variant in _deletes(word, limit):
+            for candidate in self.deletes.get(variant, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                if candidate not in self.counts:
+                    # No longer in the catalogue
+                    continue
+                distance = edit_distance(word, candidate, limit)
+                if distance > limit:
+                    continue
+                key = (distance, -self.counts[candidate], candidate)
+                if best_key is None or key < best_key:
+                    best, best_key = candidate, key
+            if time.monotonic() > deadline:
+                break
+        return best
+
+    def correct(self, query, budget=SPELLING_TIME_BUDGET):
+        """
+        Return the query with its unknown words corrected, or None if
+        there is nothing to correct. Gives up once the time budget for
+        the query is spent.
+        """
+        deadline = time.monotonic() + budget
+        words = tokenize(query)
+        corrected = []
+        changed = False
+        for word in words:
+            replacement = None
+            if (
+                len(word) >= MIN_WORD_LENGTH and not word.isdigit()
+                and word not in self.counts and time.monotonic() < deadline
+            ):
+                replacement = self.correct_word(word, deadline)
+            if replacement:
+                changed = True
+            corrected.append(replacement or word)
+        return ' '.join(corrected) if changed else None
+
+
+_spelling = None
+_spelling_lock = threading.Lock()
+
+
+def get_spelling_index():
+    """
+    Return this worker's index, bringing it up to date with the
+    catalogue. While one thread updates it, the others keep using it
+    as it was.
+    """
+    global _spelling
+    version = get_catalogue_version()
+    index = _spelling
+    if index is not None and index.version == version:
+        return index
+
+    if _spelling_lock.acquire(blocking=index is None):
+        try:
+            index = _spelling
+            if index is None or (
+                time.monotonic() - index.built_at > SPELLING_REBUILD_INTERVAL
+            ):
+                rebuilt = SpellingIndex()
+                rebuilt.update(version)
+                _spelling = index = rebuilt
+            elif index.version != version:
+                updated = index.copy()
+                updated.update(version, since=index.updated_to)
+                _spelling = index = updated
+        finally:
+            _spelling_lock.release()
+    return index
+
+
+def suggest_query(query):
+    """
+    Return a corrected version of a search query, or None
+    """
+    return get_spelling_index().correct(query)
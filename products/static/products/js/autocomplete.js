@@ -0,0 +1,52 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const inputs = document.querySelectorAll('input[data-autocomplete-url]');
+    const datalist = document.getElementById('search-suggestions');
+    if (!inputs.length || !datalist) return;
+
+    let timer = null;
+    let controller = null;
+    let suggestions = {};
+
+    function showSuggestions(data) {
+        suggestions = {};
+        datalist.innerHTML = '';
+        data.categories.concat(data.products).forEach(function(item) {
+            if (suggestions[item.label]) return;
+            suggestions[item.label] = item.url;
+            const option = document.createElement('option');
+            option.value = item.label;
+            datalist.appendChild(option);
+        });
+    }
+
+    inputs.forEach(function(input) {
+        input.addEventListener('input', function(event) {
+            // Picking a suggestion goes straight to its page
+            const url = suggestions[input.value];
+            if (url && event.inputType !== 'insertText') {
+                window.location.href = url;
+                return;
+            }
+
+            clearTimeout(timer);
+            const query = input.value.trim();
+            if (!query) {
+                showSuggestions({products: [], categories: []});
+                return;
+            }
+            // Wait for a pause in typing, and drop any answer still
+            // coming back for an older prefix
+            timer = setTimeout(function() {
+                if (controller) controller.abort();
+                controller = new AbortController();
+                const params = new URLSearchParams({q: query});
+                fetch(`${input.dataset.autocompleteUrl}?${params}`, {
+                    signal: controller.signal,
+                })
+                    .then(response => response.json())
+                    .then(showSuggestions)
+                    .catch(function() {});
+            }, 150);
+        });
+    });
+});
@@ -0,0 +1,52 @@
+from django import template
+from django.core.files.storage import default_storage
+from products.images import current_derivatives
+
+register = template.Library()
+
+# The rendered width of each kind of image at each breakpoint
+SIZES = {
+    'thumb': '(min-width: 768px) 150px, 25vw',
+    'card': '(min-width: 1200px) 25vw, (min-width: 992px) 33vw, 50vw',
+    'detail': '(min-width: 992px) 33vw, (min-width: 768px) 50vw, 100vw',
+}
+
+# Listing cards above the fold load straight away, the rest lazily
+EAGER_IMAGES = 4
+
+
+def _srcset(variants, extension):
+    widths = {}
+    for variant in variants.values():
+        widths[variant['width']] = variant[extension]
+    return ', '.join(
+        f'{default_storage.url(name)} {width}w'
+        for width, name in sorted(widths.items())
+    )
+
+
+@register.inclusion_tag('products/includes/product_image.html')
+def product_image(product, size='card', css_class='', position=0):
+    """
+    Render a product's image as a picture element offering its WebP and
+    JPEG derivatives, falling back to the original image
+    """
+    context = {
+        'product': product,
+        'css_class': css_class,
+        'sizes': SIZES[size],
+        'lazy': position >= EAGER_IMAGES,
+        'picture': None,
+    }
+    derivatives = current_derivatives(product)
+    if derivatives:
+        variants = derivatives['variants']
+        fallback = variants[size]
+        context['picture'] = {
+            'webp_srcset': _srcset(variants, 'webp'),
+            'srcset': _srcset(variants, 'jpeg'),
+            'src': default_storage.url(fallback['jpeg']),
+            'width': fallback['width'],
+            'height': fallback['height'],
+        }
+    return context
@@ -1,3 +1,999 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import re
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from boutique_ado.query_budget import LOCAL_CACHES
+from checkout.models import Order, OrderLineItem
+from .catalogue import (
+    CATALOGUE_VERSION_KEY, bump_catalogue_version, get_catalogue_version,
+)
+from .autocomplete import PRECOMPUTED_RUN, PrefixIndex, normalise
+from .images import update_derivatives
+from .importer import (
+    CatalogueImporter, ImportFormatError, read_csv, read_json_array,
+    read_ndjson,
+)
+from .facets import get_facets
+from .listing import build_listing, listing_params
+from .models import Category, Product
+from .pagination import SORT_EXPRESSIONS, encode_cursor
+from .sample_data import SAMPLE_CATEGORIES, seed_catalogue
+from .search import BACKENDS, rebuild_index, search_products
+from .snapshot import (
+    SNAPSHOT_VERSION_CHECK_INTERVAL, build_snapshot, get_snapshot,
+)
+from .spelling import SpellingIndex, get_spelling_index
 
-# Create your tests here.
+CATALOGUE_SIZES = (10, 100, 1000)
+
+# (label, url name, url args, query params, staff only, queries)
+VIEW_QUERIES = (
+    ('product listing', 'products:products', [], {}, False, 6),
+    (
+        'product listing by category', 'products:products', [],
+        {'category': 'sample_a,sample_b', 'sort': 'price'}, False, 7,
+    ),
+    ('product search', 'products:products', [], {'q': 'sample'}, False, 8),
+    ('product detail', 'products:product_detail', [1], {}, False, 3),
+    (
+        'product admin changelist', 'admin:products_product_changelist',
+        [], {}, True, 5,
+    ),
+)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class QueryBudgetTests(TestCase):
+    """
+    The catalogue views run the same number of queries however many
+    products there are. The cache is cleared before each request, so
+    these are the queries of a cold page.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_superuser('budget', 'budget@example.com', 'x')
+
+    def test_view_queries(self):
+        for size in CATALOGUE_SIZES:
+            seed_catalogue(size)
+            for label, name, args, params, staff, queries in VIEW_QUERIES:
+                with self.subTest(label, size=size):
+                    if staff:
+                        self.client.login(username='budget', password='x')
+                    cache.clear()
+                    with self.assertNumQueries(queries):
+                        response = self.client.get(
+                            reverse(name, args=args), params
+                        )
+                    self.assertEqual(response.status_code, 200)
+                    self.client.logout()
+
+    def test_listing_with_a_bag(self):
+        seed_catalogue(1000)
+        session = self.client.session
+        session['bag'] = {str(pk): 1 for pk in range(1, 21)}
+        session.save()
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse('products:products'))
+        self.assertEqual(response.status_code, 200)
+
+
+def _sqlite_full_scan(plan):
+    # SQLite reports walking the table or an index in order as a SCAN,
+    # which stops at the LIMIT; it only reads every row when it then has
+    # to sort them itself
+    return (
+        any(line.startswith('SCAN products_product') for line in plan)
+        and 'USE TEMP B-TREE FOR ORDER BY' in plan
+    )
+
+
+def _postgres_full_scan(plan):
+    return any(
+        re.search(r'Seq Scan on products_product\b', line) for line in plan
+    )
+
+
+# Checks for plans that read every row of the products table
+FULL_SCANS = {
+    'sqlite': _sqlite_full_scan,
+    'postgresql': _postgres_full_scan,
+}
+
+# Category names live on the joined table, so without a category filter
+# no products index can supply that order; the listing cache covers it
+EXPECTED_FULL_SCANS = {('category', False)}
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class CatalogueVersionTests(TestCase):
+    """
+    A lost version key starts again above every version seen, even when
+    the clock is behind it
+    """
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.dict('products.catalogue._seen_versions')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lost_version_moves_forward(self):
+        version = get_catalogue_version()
+        for count in range(3):
+            bump_catalogue_version()
+        cache.delete(CATALOGUE_VERSION_KEY)
+        with mock.patch('products.catalogue.time.time_ns', return_value=0):
+            self.assertEqual(get_catalogue_version(), version + 4)
+            self.assertEqual(bump_catalogue_version(), version + 5)
+
+    def test_version_follows_the_clock(self):
+        with mock.patch(
+            'products.catalogue.time.time_ns', return_value=10 ** 30
+        ):
+            self.assertEqual(get_catalogue_version(), 10 ** 27)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class ImageDerivativeTests(TestCase):
+    """
+    Recording a product's derivatives invalidates the pages cached
+    when the product itself was saved
+    """
+    def test_derivatives_bump_the_catalogue_version(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(
+                sku='i1', name='Imageless', description='', price=1
+            )
+        version = get_catalogue_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(update_derivatives(product), {})
+        self.assertGreater(get_catalogue_version(), version)
+        product.refresh_from_db()
+        self.assertEqual(product.image_derivatives, {})
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class CatalogueIndexTests(TestCase):
+    """
+    Every listing query seeks through an index rather than reading the
+    whole products table
+    """
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalogue(5000)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def _explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                return [row[-1].strip() for row in cursor.fetchall()]
+            cursor.execute(f'EXPLAIN {sql}')
+            return [row[0].strip() for row in cursor.fetchall()]
+
+    def _page_queries(self, params):
+        """
+        Run the listing and return the SQL of its page queries
+        """
+        with CaptureQueriesContext(connection) as context:
+            build_listing(params)
+        return [
+            query['sql'] for query in context.captured_queries
+            if 'ORDER BY' in query['sql']
+        ]
+
+    def test_listing_queries_use_an_index(self):
+        full_scan = FULL_SCANS.get(connection.vendor)
+        if full_scan is None:
+            self.skipTest(
+                f'Query plans cannot be checked on {connection.vendor}'
+            )
+        for sort in (None, *SORT_EXPRESSIONS):
+            for direction in (('asc', 'desc') if sort else (None,)):
+                for categories in (None, list(SAMPLE_CATEGORIES[:2])):
+                    params = listing_params(
+                        sort, direction, categories, None, None
+                    )
+                    # Check the second page too, which seeks past a
+                    # cursor rather than starting at the top
+                    queries = self._page_queries(params)
+                    params['cursor'] = build_listing(params)['next_cursor']
+                    queries += self._page_queries(params)
+                    if (sort, bool(categories)) in EXPECTED_FULL_SCANS:
+                        continue
+                    for sql in queries:
+                        with self.subTest(
+                            sort=sort, direction=direction,
+                            categories=categories,
+                        ):
+                            plan = self._explain(sql)
+                            self.assertFalse(
+                                full_scan(plan),
+                                f'Sequential scan:\n{sql}\n' + '\n'.join(plan),
+                            )
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class KeysetPaginationTests(TestCase):
+    """
+    Walking the cursors visits every product once, in the same order as
+    an ordinary sort, from both listing engines
+    """
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalogue(100)
+
+    def setUp(self):
+        cache.clear()
+
+    def _expected(self, sort, descending, categories=None):
+        products = Product.objects.select_related('category')
+        if categories:
+            products = products.filter(category__name__in=categories)
+
+        def key(product):
+            value = {
+                'name': product.name.lower(),
+                'price': product.price,
+                'rating': product.rating,
+                'category': product.category and product.category.name,
+            }.get(sort, product.pk)
+            # Nulls come last in either direction
+            return ((value is None) != descending, value or 0, product.pk)
+
+        return [
+            product.pk for product in
+            sorted(products, key=key, reverse=descending)
+        ]
+
+    def _walk(self, listing, params):
+        """
+        Follow the next cursors to the end and the previous cursors back
+        to the start, returning the ids seen each way
+        """
+        forwards, pages = [], []
+        result = listing(params)
+        while True:
+            forwards += result['ids']
+            pages.append(result['ids'])
+            if not result['next_cursor']:
+                break
+            result = listing(dict(params, cursor=result['next_cursor']))
+        backwards = [result['ids']]
+        while result['previous_cursor']:
+            result = listing(dict(params, cursor=result['previous_cursor']))
+            backwards.insert(0, result['ids'])
+        return forwards, pages, backwards
+
+    def test_cursors_walk_the_whole_listing(self):
+        snapshot = build_snapshot()
+        engines = {'orm': build_listing, 'snapshot': snapshot.listing}
+        for sort in (None, *SORT_EXPRESSIONS):
+            for direction in (('asc', 'desc') if sort else (None,)):
+                for categories in (None, ['sample_a']):
+                    params = listing_params(
+                        sort, direction, categories, None, None
+                    )
+                    expected = self._expected(
+                        sort, direction == 'desc', categories
+                    )
+                    for engine, listing in engines.items():
+                        with self.subTest(
+                            engine=engine, sort=sort, direction=direction,
+                            categories=categories,
+                        ):
+                            forwards, pages, backwards = self._walk(
+                                listing, params
+                            )
+                            self.assertEqual(forwards, expected)
+                            self.assertEqual(backwards, pages)
+
+    def test_invalid_cursors_start_at_the_first_page(self):
+        first_page = build_listing(listing_params(
+            'price', 'asc', None, None, None
+        ))['ids']
+        cursors = [
+            'not base64!',
+            encode_cursor(['a list']),
+            encode_cursor({'s': 'name', 'v': 'sample', 'id': 1}),
+            encode_cursor({'s': 'price', 'v': 'abc', 'id': 1}),
+            encode_cursor({'s': 'price', 'v': [1], 'id': 1}),
+            encode_cursor({'s': 'price', 'v': '10.00', 'id': [1]}),
+            encode_cursor({'s': 'price', 'v': None, 'id': 1}),
+        ]
+        snapshot = build_snapshot()
+        for cursor in cursors:
+            params = listing_params('price', 'asc', None, None, cursor)
+            with self.subTest(cursor=cursor):
+                self.assertEqual(build_listing(params)['ids'], first_page)
+                self.assertEqual(snapshot.listing(params)['ids'], first_page)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class SnapshotRefreshTests(TestCase):
+    """
+    Workers read the catalogue version at most once per check interval,
+    and rebuild their snapshot when it has moved
+    """
+    def setUp(self):
+        cache.clear()
+        for name in ('_snapshot', '_version_checked_at'):
+            patcher = mock.patch(f'products.snapshot.{name}', None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        with self.captureOnCommitCallbacks(execute=True):
+            seed_catalogue(10)
+
+    def test_version_is_checked_once_per_interval(self):
+        with mock.patch('products.snapshot.time.monotonic', return_value=0):
+            snapshot = get_snapshot()
+            with self.captureOnCommitCallbacks(execute=True):
+                Product.objects.get(pk=1).save()
+            with self.assertNumQueries(0), mock.patch(
+                'products.snapshot.get_catalogue_version'
+            ) as get_version:
+                self.assertIs(get_snapshot(), snapshot)
+            get_version.assert_not_called()
+
+        with mock.patch(
+            'products.snapshot.time.monotonic',
+            return_value=SNAPSHOT_VERSION_CHECK_INTERVAL,
+        ):
+            refreshed = get_snapshot()
+            self.assertIsNot(refreshed, snapshot)
+            self.assertEqual(refreshed.version, get_catalogue_version())
+            self.assertIs(get_snapshot(), refreshed)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class SearchTests(TestCase):
+    """
+    The full-text index ranks name matches first and understands quoted
+    phrases and prefix terms
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.coats = Category.objects.create(name='coats', friendly_name='Coats')
+        cls.jacket = Product.objects.create(
+            sku='j1', name='Waterproof jacket', price=10, category=cls.coats,
+            description='A light coat for the rain.',
+        )
+        cls.raincoat = Product.objects.create(
+            sku='r1', name='Rain coat', price=10, category=cls.coats,
+            description='Light, but not a jacket: a waterproof coat.',
+        )
+        cls.jumper = Product.objects.create(
+            sku='w1', name='Wool jumper', price=10,
+            description='Warmer than a jacket.',
+        )
+        rebuild_index()
+
+    def setUp(self):
+        if connection.vendor not in BACKENDS:
+            self.skipTest(f'No search index on {connection.vendor}')
+
+    def test_name_matches_rank_first(self):
+        ranked = search_products('jacket')
+        self.assertEqual(len(ranked), 3)
+        self.assertEqual(ranked[0], self.jacket.pk)
+        self.assertEqual(search_products('coat')[0], self.raincoat.pk)
+
+    def test_all_terms_must_match(self):
+        self.assertEqual(
+            set(search_products('light coat')),
+            {self.jacket.pk, self.raincoat.pk},
+        )
+        self.assertEqual(search_products('wool jacket'), [self.jumper.pk])
+        self.assertEqual(search_products('wool rain'), [])
+
+    def test_quoted_phrases(self):
+        self.assertEqual(search_products('"light coat"'), [self.jacket.pk])
+        self.assertEqual(search_products('"coat light"'), [])
+        # Words are stemmed inside phrases too
+        self.assertEqual(search_products('"rain coats"'), [self.raincoat.pk])
+
+    def test_prefix_terms(self):
+        self.assertEqual(search_products('water'), [])
+        self.assertEqual(
+            set(search_products('water*')),
+            {self.jacket.pk, self.raincoat.pk},
+        )
+        self.assertEqual(search_products('jump*'), [self.jumper.pk])
+
+    def test_index_follows_saves(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.jumper.name = 'Wool cardigan'
+            self.jumper.save()
+        self.assertEqual(search_products('cardigan'), [self.jumper.pk])
+        self.assertEqual(search_products('jumper'), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.coats.friendly_name = 'Outerwear'
+            self.coats.save()
+        self.assertEqual(
+            set(search_products('outerwear')),
+            {self.jacket.pk, self.raincoat.pk},
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.raincoat.delete()
+        self.assertEqual(search_products('rain'), [self.jacket.pk])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class SearchListingTests(TestCase):
+    """
+    Searches are counted by their filters, and a search with no words in
+    it finds nothing
+    """
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalogue(10)
+
+    def test_queries_without_words_find_nothing(self):
+        for query in ('***', '!!!', '""', '" "', '*'):
+            with self.subTest(query=query):
+                response = self.client.get(
+                    reverse('products:products'), {'q': query}
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(list(response.context['products']), [])
+                listing = build_listing(listing_params(
+                    'price', 'asc', None, query, None
+                ))
+                self.assertEqual((listing['ids'], listing['count']), ([], 0))
+
+    def test_count_is_shared_by_every_page_and_sort(self):
+        params = listing_params(None, None, None, 'sample', None)
+        count = build_listing(params)['count']
+        self.assertEqual(count, 10)
+        with CaptureQueriesContext(connection) as context:
+            for sort in SORT_EXPRESSIONS:
+                build_listing(dict(params, sort=sort, direction='asc'))
+        self.assertFalse(any(
+            'COUNT(' in query['sql'] for query in context.captured_queries
+        ))
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class FacetTests(TestCase):
+    """
+    Each facet counts what choosing one of its options would give, with
+    every other active filter applied
+    """
+    @classmethod
+    def setUpTestData(cls):
+        shirts = Category.objects.create(name='shirts', friendly_name='Shirts')
+        coats = Category.objects.create(name='coats', friendly_name='Coats')
+        for sku, category, price, rating in (
+            ('s1', shirts, 10, 4.5),
+            ('s2', shirts, 30, 3.5),
+            ('c1', coats, 60, None),
+            ('c2', coats, 120, 2),
+            ('n1', None, 20, 4),
+        ):
+            Product.objects.create(
+                sku=sku, name=f'Sample {sku}', description='', price=price,
+                rating=rating, category=category,
+            )
+        rebuild_index()
+
+    def setUp(self):
+        cache.clear()
+
+    def _counts(self, categories=None, price=None, rating=None, query=None):
+        params = listing_params(
+            None, None, categories, query, None, price, rating
+        )
+        facets = get_facets(params)
+        counts = {
+            name: {option['key']: option['count'] for option in options}
+            for name, options in facets.items()
+        }
+        return counts, build_listing(params)['count']
+
+    def test_counts_without_filters(self):
+        counts, total = self._counts()
+        self.assertEqual(total, 5)
+        self.assertEqual(counts['category'], {'coats': 2, 'shirts': 2})
+        self.assertEqual(counts['price'], {
+            'under-25': 2, '25-50': 1, '50-100': 1, '100-plus': 1,
+        })
+        self.assertEqual(counts['rating'], {
+            '4-plus': 2, '3-4': 1, 'under-3': 1, 'unrated': 1,
+        })
+
+    def test_facets_ignore_their_own_filter(self):
+        counts, total = self._counts(categories=['shirts'])
+        self.assertEqual(total, 2)
+        self.assertEqual(counts['category'], {'coats': 2, 'shirts': 2})
+        self.assertEqual(counts['price'], {
+            'under-25': 1, '25-50': 1, '50-100': 0, '100-plus': 0,
+        })
+        self.assertEqual(counts['rating'], {
+            '4-plus': 1, '3-4': 1, 'under-3': 0, 'unrated': 0,
+        })
+
+    def test_filters_combine(self):
+        counts, total = self._counts(
+            categories=['shirts', 'coats'], price='under-25'
+        )
+        self.assertEqual(total, 1)
+        self.assertEqual(counts['category'], {'shirts': 1})
+        self.assertEqual(counts['price']['50-100'], 1)
+        self.assertEqual(counts['rating']['4-plus'], 1)
+
+        counts, total = self._counts(rating='unrated')
+        self.assertEqual(total, 1)
+        self.assertEqual(counts['category'], {'coats': 1})
+        self.assertEqual(counts['price']['50-100'], 1)
+        self.assertEqual(sum(counts['rating'].values()), 5)
+
+    def test_counts_follow_the_search(self):
+        counts, total = self._counts(query='s1')
+        self.assertEqual(total, 1)
+        self.assertEqual(counts['category'], {'shirts': 1})
+        counts, total = self._counts(query='sample', price='100-plus')
+        self.assertEqual(total, 1)
+        self.assertEqual(counts['category'], {'coats': 1})
+        self.assertEqual(sum(counts['price'].values()), 5)
+
+    def test_options_link_to_their_filter(self):
+        response = self.client.get(
+            reverse('products:products'), {'category': 'shirts'}
+        )
+        facets = response.context['facets']
+        urls = {option['key']: option for option in facets['category']}
+        self.assertTrue(urls['shirts']['active'])
+        self.assertNotIn('category=', urls['shirts']['url'])
+        self.assertIn('category=coats%2Cshirts', urls['coats']['url'])
+        price = facets['price'][0]
+        self.assertIn('price=under-25', price['url'])
+
+
+class ImporterTests(TestCase):
+    """
+    Feeds import by SKU in batches, whatever their format
+    """
+    def _import(self, items, batch_size=1000):
+        importer = CatalogueImporter(batch_size=batch_size)
+        for item in items:
+            importer.add(item)
+        importer.flush()
+        return importer
+
+    def _read_fixture(self, name):
+        with open(f'products/fixtures/{name}', encoding='utf-8') as stream:
+            return list(read_json_array(stream))
+
+    def test_bundled_fixtures_import_and_reimport(self):
+        fixtures = (
+            self._read_fixture('categories.json')
+            + self._read_fixture('products.json')
+        )
+        importer = self._import(fixtures, batch_size=50)
+        product_count = sum(
+            1 for item in fixtures if item['model'] == 'products.product'
+        )
+        self.assertEqual(importer.imported, product_count)
+        self.assertEqual(importer.skipped, 0)
+        self.assertEqual(Product.objects.count(), product_count)
+        self.assertFalse(Product.objects.filter(category=None).exists())
+
+        # A second import updates the same products
+        self._import(fixtures)
+        self.assertEqual(Product.objects.count(), product_count)
+
+    def test_json_array_items_may_span_chunks(self):
+        items = [
+            {'sku': f'sku{number}', 'name': f'Name {number}', 'price': 1}
+            for number in range(20)
+        ]
+        items += [12345, 678]
+        for read_size in (1, 7):
+            with mock.patch('products.importer.READ_SIZE', read_size):
+                read = list(read_json_array(io.StringIO(json.dumps(items))))
+            self.assertEqual(read, items)
+
+    def test_malformed_json_arrays_are_rejected(self):
+        feeds = (
+            '{"sku": 1}', '[{"sku": 1}', '[{"sku": }]', '[1,,2 3]', '[1 2]',
+            '[,1]', '[1,]', '[1]]',
+        )
+        for feed in feeds:
+            with self.subTest(feed=feed):
+                with self.assertRaises(ImportFormatError):
+                    list(read_json_array(io.StringIO(feed)))
+
+    def test_ndjson_and_csv_feeds(self):
+        ndjson = io.StringIO(
+            '{"sku": "a1", "name": "A", "price": "1.50", '
+            '"category": "shirts"}\n\n'
+            '{"sku": "b2", "name": "B", "price": 2}\n'
+        )
+        feed_csv = io.StringIO(
+            'sku,name,price,rating,has_sizes,category\n'
+            'a1,A again,1.75,4.5,yes,shirts\n'
+            'c3,C,3,,no,\n'
+        )
+        self._import(read_ndjson(ndjson))
+        self._import(read_csv(feed_csv))
+        products = {
+            product.sku: product for product in Product.objects.all()
+        }
+        self.assertEqual(set(products), {'a1', 'b2', 'c3'})
+        self.assertEqual(products['a1'].name, 'A again')
+        self.assertEqual(str(products['a1'].price), '1.75')
+        self.assertTrue(products['a1'].has_sizes)
+        self.assertIsNone(products['c3'].rating)
+        self.assertEqual(Category.objects.filter(name='shirts').count(), 1)
+
+    def test_invalid_rows_are_skipped(self):
+        importer = self._import([
+            {'name': 'No SKU', 'price': 1},
+            {'sku': 'x1', 'name': 'Bad price', 'price': 'cheap'},
+            {'sku': 'x2', 'name': 'Too dear', 'price': 10 ** 6},
+            {'sku': 'x3', 'name': 'Fine', 'price': '9.99'},
+            'not an object',
+        ])
+        self.assertEqual(importer.imported, 1)
+        self.assertEqual(importer.skipped, 4)
+        self.assertEqual(len(importer.errors), 4)
+        self.assertEqual(
+            list(Product.objects.values_list('sku', flat=True)), ['x3']
+        )
+
+    def test_prices_are_rounded_before_the_range_check(self):
+        importer = self._import([
+            {'sku': 'r1', 'name': 'Rounds up', 'price': '9999.994'},
+            {'sku': 'r2', 'name': 'Rounds over', 'price': '9999.995'},
+            {'sku': 'r3', 'name': 'Not finite', 'price': 'Infinity'},
+        ])
+        self.assertEqual(importer.skipped, 2)
+        self.assertEqual(
+            str(Product.objects.get(sku='r1').price), '9999.99'
+        )
+
+    def test_numeric_category_names_in_feeds(self):
+        other = Category.objects.create(name='other')
+        self._import(read_csv(io.StringIO(
+            'sku,name,price,category\n'
+            f'n1,N,1,{other.pk}\n'
+            'n2,N,1,2024\n'
+        )))
+        products = {
+            product.sku: product
+            for product in Product.objects.select_related('category')
+        }
+        self.assertEqual(products['n1'].category.name, str(other.pk))
+        self.assertEqual(products['n2'].category.name, '2024')
+        self.assertEqual(Category.objects.count(), 3)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class ProductExportTests(TestCase):
+    """
+    Products stream out of the admin and the command in the flat format
+    the importer reads back
+    """
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_superuser('export', 'export@example.com', 'x')
+        shirts = Category.objects.create(name='shirts')
+        cls.products = [
+            Product.objects.create(
+                sku='e1', name='Shirt, "striped"', description='Cotton',
+                price='12.50', rating='4.20', has_sizes=True,
+                category=shirts,
+            ),
+            Product.objects.create(
+                sku='e2', name='Mug', description='', price=3,
+            ),
+        ]
+
+    def _admin_export(self, export_format, products):
+        self.client.login(username='export', password='x')
+        return self.client.post(
+            reverse('admin:products_product_changelist'),
+            {
+                'action': f'export_{export_format}',
+                '_selected_action': [product.pk for product in products],
+            },
+        )
+
+    def test_admin_csv_export(self):
+        response = self._admin_export('csv', self.products)
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn(
+            'attachment; filename="products-', response['Content-Disposition']
+        )
+        body = b''.join(response.streaming_content).decode()
+        rows = list(csv.DictReader(io.StringIO(body)))
+        self.assertEqual([row['sku'] for row in rows], ['e1', 'e2'])
+        self.assertEqual(rows[0]['name'], 'Shirt, "striped"')
+        self.assertEqual(rows[0]['category'], 'shirts')
+        self.assertEqual(rows[0]['price'], '12.50')
+        self.assertEqual(rows[1]['category'], '')
+
+        # The export imports back unchanged
+        Product.objects.all().delete()
+        importer = CatalogueImporter()
+        for item in read_csv(io.StringIO(body)):
+            importer.add(item)
+        importer.flush()
+        self.assertEqual(importer.imported, 2)
+        shirt = Product.objects.get(sku='e1')
+        self.assertEqual(shirt.name, 'Shirt, "striped"')
+        self.assertEqual(str(shirt.rating), '4.20')
+        self.assertTrue(shirt.has_sizes)
+
+    def test_admin_ndjson_export_of_a_selection(self):
+        response = self._admin_export('ndjson', self.products[1:])
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        records = [
+            json.loads(line) for line in
+            b''.join(response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(records, [{
+            'sku': 'e2', 'name': 'Mug', 'description': '', 'category': None,
+            'price': '3.00', 'rating': None, 'has_sizes': False,
+            'image_url': None, 'image': '',
+        }])
+
+    def test_export_command(self):
+        stdout = io.StringIO()
+        call_command(
+            'export_products', format='ndjson', chunk_size=1, stdout=stdout
+        )
+        records = [
+            json.loads(line) for line in stdout.getvalue().splitlines()
+        ]
+        self.assertEqual([record['sku'] for record in records], ['e1', 'e2'])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class ConditionalGetTests(TestCase):
+    """
+    Catalogue pages are revalidated until the catalogue or the release
+    changes
+    """
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalogue(10)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_etag_follows_the_release(self):
+        url = reverse('products:products')
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with mock.patch('products.conditional.RELEASE', 'next release'):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class CatalogueFixtureTests(TestCase):
+    """
+    The bundled fixtures load, and catalogue pages are dated from them
+    """
+    def test_fixtures_load(self):
+        call_command('loaddata', 'categories', 'products', verbosity=0)
+        self.assertTrue(Product.objects.exists())
+        self.assertFalse(Product.objects.filter(updated_at=None).exists())
+        self.assertFalse(Category.objects.filter(updated_at=None).exists())
+
+        response = self.client.get(reverse('products:products'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('Last-Modified'))
+
+    def test_saving_moves_updated_at(self):
+        product = Product.objects.create(sku='u1', name='U', price=1)
+        updated_at = product.updated_at
+        product.save(update_fields=['name'])
+        product.refresh_from_db()
+        self.assertGreater(product.updated_at, updated_at)
+
+
+class PrefixIndexTests(TestCase):
+    """
+    Prefixes match the start of any word, best ranked entry first
+    """
+    def test_word_prefixes(self):
+        index = PrefixIndex([
+            ('Bootcut Jeans', 1),
+            ('Jean Jacket', 2),
+            ('Blue jeans, bootcut', 3),
+            ('Sandals', 4),
+        ])
+        self.assertEqual(
+            [value for label, value in index.search('jea')], [1, 2, 3]
+        )
+        self.assertEqual(
+            [value for label, value in index.search('  BOOTcut ')], [1, 3]
+        )
+        self.assertEqual(
+            [value for label, value in index.search('jeans boot')], [3]
+        )
+        self.assertEqual(index.search('ean'), [])
+        self.assertEqual(index.search('!!'), [])
+        self.assertEqual(len(index.search('j', limit=2)), 2)
+
+    def test_precomputed_answers_match_a_scan(self):
+        entries = [
+            (f'Sample {word} {number}', number)
+            for number, word in enumerate(
+                ['shirt', 'shoe', 'shorts', 'sock'] * (PRECOMPUTED_RUN // 2)
+            )
+        ]
+        index = PrefixIndex(entries)
+        self.assertIn('s', index.precomputed)
+        self.assertIn('sh', index.precomputed)
+        for prefix in ('s', 'sa', 'sh', 'sho', 'sample s', 'so', '5'):
+            with self.subTest(prefix=prefix):
+                expected = [
+                    entry for entry in entries
+                    if any(
+                        word.startswith(prefix) for word in [
+                            ' '.join(normalise(entry[0]).split()[start:])
+                            for start in range(3)
+                        ]
+                    )
+                ][:8]
+                self.assertEqual(index.search(prefix), expected)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class AutocompleteTests(TestCase):
+    """
+    The endpoint suggests products and categories, best sellers first,
+    and follows catalogue changes
+    """
+    @classmethod
+    def setUpTestData(cls):
+        jackets = Category.objects.create(
+            name='jackets', friendly_name='Jackets'
+        )
+        jeans = Category.objects.create(name='jeans', friendly_name='Jeans')
+        cls.products = {
+            sku: Product.objects.create(
+                sku=sku, name=name, description='', price=10,
+                category=category,
+            )
+            for sku, name, category in (
+                ('j1', 'Denim jacket', jackets),
+                ('j2', 'Rain jacket', jackets),
+                ('d1', 'Slim jeans', jeans),
+                ('d2', 'Jazz shoes', None),
+            )
+        }
+        order = Order.objects.create(
+            full_name='A', email='a@example.com', phone_number='1',
+            country='GB', town_or_city='Town', street_address1='1 Street',
+        )
+        for sku, quantity in (('j2', 5), ('d1', 9), ('j1', 1)):
+            OrderLineItem.objects.create(
+                order=order, product=cls.products[sku], quantity=quantity
+            )
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('products.autocomplete._autocomplete', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _suggest(self, query, **params):
+        response = self.client.get(
+            reverse('products:autocomplete'), {'q': query, **params}
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_best_sellers_first(self):
+        result = self._suggest('j')
+        self.assertEqual(result['query'], 'j')
+        self.assertEqual(
+            [product['label'] for product in result['products']],
+            ['Slim jeans', 'Rain jacket', 'Denim jacket', 'Jazz shoes'],
+        )
+        self.assertEqual(
+            result['products'][0]['url'],
+            reverse('products:product_detail', args=[self.products['d1'].pk]),
+        )
+        self.assertEqual(
+            [category['label'] for category in result['categories']],
+            ['Jeans', 'Jackets'],
+        )
+        self.assertTrue(
+            result['categories'][0]['url'].endswith('?category=jeans')
+        )
+
+    def test_limits(self):
+        self.assertEqual(len(self._suggest('j', limit=1)['products']), 1)
+        self.assertEqual(len(self._suggest('j', limit=0)['products']), 1)
+        self.assertEqual(len(self._suggest('j', limit='x')['products']), 4)
+        self.assertEqual(self._suggest(''), {
+            'query': '', 'products': [], 'categories': [],
+        })
+
+    def test_new_products_are_suggested(self):
+        self.assertEqual(self._suggest('parka')['products'], [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(
+                sku='p1', name='Parka', description='', price=10
+            )
+        self.assertEqual(
+            [product['label'] for product in self._suggest('par')['products']],
+            ['Parka'],
+        )
+
+
+class SpellingIndexTests(TestCase):
+    """
+    Updating the index counts each product's words once, in a copy that
+    replaces the index readers already have
+    """
+    def test_updates_replace_a_products_words(self):
+        category = Category.objects.create(name='jackets')
+        product = Product.objects.create(
+            sku='w1', name='Waterproof jacket', description='Waterproof',
+            price=10, category=category,
+        )
+        index = SpellingIndex()
+        index.update(1)
+        self.assertEqual(index.counts['waterproof'], 2)
+
+        for version in (2, 3):
+            index.update(version, since=index.updated_to)
+        self.assertEqual(index.counts['waterproof'], 2)
+
+        product.name = 'Windproof jacket'
+        product.description = ''
+        product.save()
+        index.update(4, since=index.updated_to)
+        self.assertNotIn('waterproof', index.counts)
+        self.assertEqual(index.counts['windproof'], 1)
+        self.assertEqual(index.counts['jacket'], 1)
+        self.assertEqual(index.correct('windprof jakcet'), 'windproof jacket')
+        self.assertIsNone(index.correct('waterproof'))
+
+    @override_settings(CACHES=LOCAL_CACHES)
+    def test_readers_keep_the_index_they_have(self):
+        cache.clear()
+        patcher = mock.patch('products.spelling._spelling', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(
+                sku='w1', name='Waterproof jacket', description='',
+                price=10,
+            )
+        index = get_spelling_index()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = 'Windproof jacket'
+            product.save()
+        updated = get_spelling_index()
+        self.assertIsNot(updated, index)
+        self.assertEqual(updated.counts['windproof'], 1)
+        self.assertNotIn('waterproof', updated.counts)
+        self.assertEqual(index.counts['waterproof'], 1)
+        self.assertNotIn('windproof', index.counts)
+        self.assertIsNone(index.correct('windprof'))
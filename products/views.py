@@ -2,11 +2,19 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
-from django.db.models.functions import Lower
 from django.core.exceptions import PermissionDenied
-from .models import Product, Category
+from django.http import JsonResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import require_GET
+from .models import Product
 from .forms import ProductForm
+from .autocomplete import (
+    AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_MAX_LIMIT, get_autocomplete
+)
+from .conditional import catalogue_conditional
+from .facets import get_facets
+from .listing import get_listing, listing_params
+from .spelling import SPELLING_AUTOCORRECT, suggest_query
 
 
 # Create your views here.
@@ -14,12 +22,12 @@ def superuser_required(user):
     return user.is_superuser
 
 
+@catalogue_conditional
 def all_products(request):
     """
     A view to show all products,
     including sorting and searching queries
     """
-    products = Product.objects.all()
     query = None
     categories = None
     sort = None
@@ -27,24 +35,11 @@ def all_products(request):
 
     if request.GET:
         if 'sort' in request.GET:
-            sortkey = request.GET['sort']
-            sort = sortkey
-            if sortkey == 'name':
-                sortkey = 'lower_name'
-                products = products.annotate(lower_name=Lower('name'))
-            if sortkey == 'category':
-                sortkey = 'category__name'
-
-            if 'direction' in request.GET:
-                direction = request.GET['direction']
-                if direction == 'desc':
-                    sortkey = f'-{sortkey}'
-            products = products.order_by(sortkey)
+            sort = request.GET['sort']
+            direction = request.GET.get('direction')
 
         if 'category' in request.GET:
             categories = request.GET['category'].split(',')
-            products = products.filter(category__name__in=categories)
-            categories = Category.objects.filter(name__in=categories)
 
         if 'q' in request.GET:
             query = request.GET['q']
@@ -54,28 +49,129 @@ def all_products(request):
                     )
                 return redirect(reverse('products:products'))
 
-            queries = (
-                Q(name__icontains=query) | Q(description__icontains=query)
-                )
-            products = products.filter(queries)
+    params = listing_params(
+        sort, direction, categories, query, request.GET.get('cursor'),
+        request.GET.get('price'), request.GET.get('rating'),
+    )
+    listing = get_listing(params)
+
+    # Offer a corrected search when nothing matched, or show its
+    # results straight away if autocorrection is on
+    suggestion = None
+    corrected_from = None
+    if query and not listing['count']:
+        corrected_query = suggest_query(query)
+        if corrected_query:
+            corrected_params = dict(params, q=corrected_query)
+            corrected_listing = get_listing(corrected_params)
+            if corrected_listing['count'] and SPELLING_AUTOCORRECT:
+                corrected_from, query = query, corrected_query
+                params, listing = corrected_params, corrected_listing
+            elif corrected_listing['count']:
+                suggestion = corrected_query
+
+    facets = get_facets(params)
+    for name, facet in facets.items():
+        for option in facet:
+            option['url'] = _facet_url(request, params, name, option)
+    products = Product.objects.select_related('category').in_bulk(
+        listing['ids']
+    )
 
     current_sorting = f'{sort}_{direction}'
 
     context = {
-        'products': products,
+        'products': [products[pk] for pk in listing['ids'] if pk in products],
+        'product_count': listing['count'],
+        'ranked_count': listing.get('ranked_count'),
+        'next_page_url': _page_url(request, listing['next_cursor']),
+        'previous_page_url': _page_url(request, listing['previous_cursor']),
         'search_term': query,
-        'current_categories': categories,
+        'suggestion': suggestion,
+        'suggestion_url': _suggestion_url(request, suggestion),
+        'corrected_from': corrected_from,
+        'current_categories': listing['categories'],
         'current_sorting': current_sorting,
+        'facets': facets,
+        'filtered': bool(
+            query or listing['categories'] or params['price']
+            or params['rating']
+        ),
     }
 
     return render(request, 'products/products.html', context)
 
 
+def _page_url(request, cursor):
+    """
+    Build the listing url for another page, keeping the current filters
+    """
+    if cursor is None:
+        return None
+    params = request.GET.copy()
+    params['cursor'] = cursor
+    return f'{request.path}?{params.urlencode()}'
+
+
+def _suggestion_url(request, suggestion):
+    """
+    Build the listing url searching for a suggested correction instead
+    """
+    if suggestion is None:
+        return None
+    params = request.GET.copy()
+    params.pop('cursor', None)
+    params['q'] = suggestion
+    return f'{request.path}?{params.urlencode()}'
+
+
+def _facet_url(request, params, name, option):
+    """
+    Build the listing url that toggles a facet option on or off
+    """
+    query_params = request.GET.copy()
+    query_params.pop('cursor', None)
+    if name == 'category':
+        selected = set(params['categories'] or [])
+        selected ^= {option['key']}
+        value = ','.join(sorted(selected))
+    else:
+        value = None if option['active'] else option['key']
+
+    if value:
+        query_params[name] = value
+    else:
+        query_params.pop(name, None)
+    return f'{request.path}?{query_params.urlencode()}'
+
+
+@require_GET
+@cache_control(max_age=60)
+def autocomplete(request):
+    """
+    A view returning search suggestions for a prefix as JSON
+    """
+    query = request.GET.get('q', '')[:100]
+    try:
+        limit = int(request.GET.get('limit', AUTOCOMPLETE_LIMIT))
+    except ValueError:
+        limit = AUTOCOMPLETE_LIMIT
+    limit = min(max(limit, 1), AUTOCOMPLETE_MAX_LIMIT)
+
+    return JsonResponse({
+        'query': query,
+        **get_autocomplete().suggest(query, limit),
+    })
+
+
+@catalogue_conditional
 def product_detail(request, product_id):
     """
     A view to show individual products
     """
-    product = get_object_or_404(Product, pk=product_id)
+    product = get_object_or_404(
+        Product.objects.select_related('category'), pk=product_id
+        )
 
     context = {
         'product': product,